@@ -1,34 +1,118 @@
+import io
 import os
 import sys
-import random
-import string
-from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory
-from flask_socketio import SocketIO, emit
+import threading
+import uuid
+from flask import Flask, Response, render_template, request, redirect, url_for, send_file, send_from_directory, jsonify, abort
+from flask_socketio import SocketIO, emit, join_room
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
 import master
 
-# Define the folders where we will perform steganography.
-UPLOAD_FOLDER_ENCODE = os.path.abspath('./uploads/encode')
-UPLOAD_FOLDER_DECODE = os.path.abspath('./uploads/decode')
+# Only these extensions are allowed for encoding: those of the carriers (PNG, BMP, WebP and
+# TIFF images, and WAV sounds) and JPEG images, which are encoded as PNG.
+ALLOWED_EXTENSIONS_ENCODE = master.carriers.supportedExtensions(readOnly=True)
 
-# Create the folders if they do not exist.
-Path(UPLOAD_FOLDER_ENCODE).mkdir(parents=True, exist_ok=True)
-Path(UPLOAD_FOLDER_DECODE).mkdir(parents=True, exist_ok=True)
+# Only these extensions are allowed for decoding.
+ALLOWED_EXTENSIONS_DECODE = master.carriers.supportedExtensions()
 
-# Only these extensions are allowed for encoding.
-ALLOWED_EXTENSIONS_ENCODE = ['.jpg', '.jpeg', '.jpe', '.png', '.JPG', '.JPEG', '.JPE', '.PNG']
+# Number of least significant bits per channel that can be used to hide the message.
+# Up to 4 bits fit in 8-bit images, and up to 8 bits in 16-bit images.
+ALLOWED_BITS_PER_CHANNEL = [1, 2, 3, 4, 5, 6, 7, 8]
 
-# Only these extensions are allowed for decoding.
-ALLOWED_EXTENSIONS_DECODE = ['.png', '.PNG']
+# Compression codecs that can be requested for the message ('auto' picks the best one).
+ALLOWED_COMPRESSION = ['none', 'auto', 'zlib', 'lzma', 'bz2']
+
+# Parity bytes per codeword of the error correcting code that can be requested for the
+# message ('' for none): more of them correct more wrong bits, and take more room.
+ALLOWED_PARITY = ['', '16', '32', '64']
+
+# Presets, compression levels and filters of the PNG writer that can be requested for the
+# encoded image ('' keeps what the preset, or PIL, does).
+ALLOWED_PNG_PRESETS = [''] + list(master.pngwriter.PRESETS)
+ALLOWED_PNG_LEVELS = [''] + [str(level) for level in master.pngwriter.LEVELS]
+ALLOWED_PNG_FILTERS = [''] + master.pngwriter.FILTER_NAMES
+
+# Number of worker processes that run the encode and decode jobs (by default, one per CPU),
+# and number of jobs that can wait for a free process before new ones are rejected.
+JOB_PROCESSES = int(os.environ.get('JOB_PROCESSES', '0')) or None
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', '8'))
+
+# Seconds that a client should wait before trying again when the queue of jobs is full.
+RETRY_AFTER = 5
+
+# Largest request accepted, in bytes. Bigger uploads are rejected as soon as their length is
+# known, or as soon as that many bytes were read from an upload sent in chunks.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(64 * 1024 * 1024)))
+
+# Largest message accepted in the form of an encode request, in bytes.
+MAX_MESSAGE_BYTES = int(os.environ.get('MAX_MESSAGE_BYTES', str(16 * 1024 * 1024)))
+
+# Largest image accepted, in pixels. Its size is read from its header, before any job runs.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(64 * 1024 * 1024)))
+
+# Directory where the uploaded images are stored while their jobs run. Uploads are copied
+# there in chunks, and the jobs read them from there instead of receiving their bytes.
+UPLOAD_DIRECTORY = os.path.abspath(os.environ.get('UPLOAD_DIRECTORY', './uploads'))
+
+# Number of encoded images that can be sent as they are written at once (see streamEncode).
+# Each one is encoded by a thread of this process instead of the pool of jobs.
+STREAM_SLOTS = int(os.environ.get('STREAM_SLOTS', '2'))
+
+# Directory where the results of the jobs are cached, and maximum size in bytes of the cache.
+# A request for a cached result is answered from the cache without running a job.
+CACHE_DIRECTORY = os.path.abspath(os.environ.get('CACHE_DIRECTORY', './cache'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Extensions of the cached results, by the kind of result, and how each kind is sent. Encoded
+# carriers keep the format of the uploaded one, and have the extension of its backend (PNG
+# when the format is not known).
+EXTENSION_ENCODED = '.png'
+EXTENSION_TEXT = '.txt'
+EXTENSION_BINARY = '.bin'
+EXTENSIONS_ENCODED = {backend['extensions'][0]: backend['mimetype'] for backend in master.carriers.BACKENDS.values()}
+RESULT_MIMETYPES = {**EXTENSIONS_ENCODED, EXTENSION_TEXT: 'text/plain; charset=utf-8', EXTENSION_BINARY: 'application/octet-stream'}
+RESULT_NAMES = {**{extension: 'encoded' + extension for extension in EXTENSIONS_ENCODED}, EXTENSION_TEXT: 'secret.txt', EXTENSION_BINARY: 'secret.bin'}
+
+# Mimetype of the ranges of a decoded message sent while its job is still running, since
+# whether the message is text is only known once it is whole.
+RANGE_MIMETYPE = 'application/octet-stream'
+
+# When set, a request with ?profile=1 runs its job under cProfile, and the report can be
+# fetched from /jobs/<id>/profile. Profiling slows the jobs down, so it is off by default.
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+
+# Level of the messages logged by the encoder and decoder: debug, info or error.
+master.utils.logLevel = master.utils.LOG_LEVELS[os.environ.get('LOG_LEVEL', 'info')]
+
+# Content type of the metrics, in the text format of Prometheus.
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 # Create the app.
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER_ENCODE'] = UPLOAD_FOLDER_ENCODE
-app.config['UPLOAD_FOLDER_DECODE'] = UPLOAD_FOLDER_DECODE
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+app.config['MAX_FORM_MEMORY_SIZE'] = MAX_MESSAGE_BYTES
 socketio = SocketIO(app)
 
+# Create the cache of results, and the pool that runs the jobs. The ID of each job is the
+# key of its result in the cache, which tells nothing of the request without its secret.
+resultCache = master.ResultCache(CACHE_DIRECTORY, CACHE_MAX_BYTES)
+jobPool = master.JobPool(JOB_PROCESSES, JOB_QUEUE_DEPTH, lambda status: onJobEvent(status))
+
+# Uploaded images of the jobs that have not finished yet, by the ID of their job. Those of
+# the decode jobs are kept with their key and passphrase, since ranges of their messages are
+# decoded from them meanwhile.
+pendingUploads = {}
+pendingDecodes = {}
+
+# Slots of the encoded images being sent as they are written.
+streamSlots = threading.BoundedSemaphore(STREAM_SLOTS)
+
+# Keep a histogram of the time spent in each stage of the jobs, for /metrics.
+spanMetrics = master.instrument.PrometheusSink()
+master.instrument.sinks.append(spanMetrics)
+
 
 @app.route('/')
 def index():
@@ -43,6 +127,8 @@ def encode():
 			if not 'file' in request.files:
 				print('ERROR: no image file has been provided')
 				return redirect(request.url)
+		except RequestEntityTooLarge:
+			raise
 		except Exception as exception:
 			print(exception)
 			return redirect(request.url)
@@ -72,22 +158,67 @@ def encode():
 		else:
 			message = request.form['message']
 		
-		# Decide some input filenames and store the files at the appropriate locations.
-		randomId = createRandomId()
-		finalImageFilename = os.path.join(app.config['UPLOAD_FOLDER_ENCODE'], randomId + 'original' + fileExtension)
-		image.save(finalImageFilename)
-		finalMsgFilename = os.path.join(app.config['UPLOAD_FOLDER_ENCODE'], randomId + 'message.txt')
-		with open(finalMsgFilename, 'w') as file:
-			file.write(message)
-		
-		# Decide a name for the output image and call the encoding algorithm.
-		partialOutputFilename = randomId + 'encoded.png'
-		outputFilename = os.path.join(app.config['UPLOAD_FOLDER_ENCODE'], partialOutputFilename)
-		if master.encode(finalImageFilename, finalMsgFilename, outputFilename) != 0:
-			print('ERROR: there was a problem encoding')
+		# Check the number of bits per channel used to hide the message.
+		try:
+			bitsPerChannel = int(request.form.get('bits', '1'))
+		except ValueError:
+			print('ERROR: the number of bits per channel is not valid')
 			return redirect(request.url)
-		
-		return redirect(url_for('encoded', filename=partialOutputFilename))
+		if bitsPerChannel not in ALLOWED_BITS_PER_CHANNEL:
+			print('ERROR: the number of bits per channel is not valid')
+			return redirect(request.url)
+
+		# Check the compression requested for the message, if any.
+		compress = request.form.get('compress', 'none')
+		if compress not in ALLOWED_COMPRESSION:
+			print('ERROR: the compression codec is not valid')
+			return redirect(request.url)
+
+		# Check the options of the PNG writer, if any: trading speed for size of the image.
+		pngPreset = request.form.get('png_preset', '')
+		pngLevel = request.form.get('png_level', '')
+		pngFilter = request.form.get('png_filter', '')
+		if pngPreset not in ALLOWED_PNG_PRESETS or pngLevel not in ALLOWED_PNG_LEVELS or pngFilter not in ALLOWED_PNG_FILTERS:
+			print('ERROR: the options of the PNG writer are not valid')
+			return redirect(request.url)
+		pngPreset = pngPreset or None
+		pngLevel = int(pngLevel) if pngLevel else None
+		pngFilter = pngFilter or None
+
+		# Check the error correcting code requested for the message, if any.
+		parity = request.form.get('parity', '')
+		if parity not in ALLOWED_PARITY:
+			print('ERROR: the error correcting code is not valid')
+			return redirect(request.url)
+		parity = int(parity) if parity else None
+
+		# The message is scattered across the image when a key is given, and encrypted when
+		# a passphrase is given.
+		scatterKey = requestKey()
+		passphrase = requestPassphrase()
+
+		# Check the size of the image before anything is done with it.
+		if not isImageAllowed(image.stream):
+			return tooLarge()
+
+		# Answer from the cache if the same image and message were already encoded with the same
+		# options. Otherwise store the image, and either encode it here to send it as it is
+		# written, or submit a job that encodes it.
+		messageData = message.encode('utf-8')
+		key = resultCache.key('encode', image.stream, messageData, bitsPerChannel, compress, master.writerOptions(pngPreset, pngLevel, pngFilter), scatterKey, passphrase, parity)
+		profile = isProfiling()
+		if not profile and resultCache.lookup(key) != None:
+			if isStreaming():
+				return sendCachedFile(resultCache.filename(key))
+			return cachedResponse('encode', key)
+		imageFilename = storeUpload(image, fileExtension)
+		if imageFilename == None:
+			abort(500)
+		if isStreaming() and not profile:
+			options = {'bitsPerChannel': bitsPerChannel, 'compress': compress, 'pngPreset': pngPreset, 'pngLevel': pngLevel, 'pngFilter': pngFilter, 'key': scatterKey, 'passphrase': passphrase, 'parity': parity}
+			return streamEncode(key, imageFilename, messageData, options)
+		jobId = submitJob('encode', master.encodeBytes, imageFilename, messageData, bitsPerChannel, compress, pngPreset, pngLevel, pngFilter, scatterKey, passphrase, parity, jobId=key, profile=profile)
+		return jobResponse('encode', jobId)
 	
 	else:
 		return render_template('encode.html')
@@ -101,6 +232,8 @@ def decode():
 			if not 'file' in request.files:
 				print('ERROR: no image file has been provided')
 				return redirect(request.url)
+		except RequestEntityTooLarge:
+			raise
 		except Exception as exception:
 			print(exception)
 			return redirect(request.url)
@@ -123,38 +256,329 @@ def decode():
 		else:
 			print('The image has a valid extension')
 		
-		# Decide a filename for the input image and store it.
-		randomId = createRandomId()
-		finalImageFilename = os.path.join(app.config['UPLOAD_FOLDER_DECODE'], randomId + 'encoded' + fileExtension)
-		image.save(finalImageFilename)
-
-		# Create a name for the decoded text and call the decode algorithm.
-		partialOutputFilename = randomId + 'secret.txt'
-		outputFilename = os.path.join(app.config['UPLOAD_FOLDER_DECODE'], partialOutputFilename)
-		if master.decode(finalImageFilename, outputFilename) != 0:
-			print('ERROR: there was a problem decoding')
-			return redirect(request.url)
-		
-		# If decoding went well, redirect the user to see the text.
-		return redirect(url_for('decoded', filename=partialOutputFilename))
+		# Check the size of the image before anything is done with it.
+		if not isImageAllowed(image.stream):
+			return tooLarge()
+
+		# Answer from the cache if the same image was already decoded, or store the image and
+		# submit a job that decodes it. The messages hidden with a key or a passphrase are
+		# never stored in the cache: they are only kept by the pool of jobs, until dropped.
+		scatterKey = requestKey()
+		passphrase = requestPassphrase()
+		key = resultCache.key('decode', image.stream, scatterKey, passphrase)
+		profile = isProfiling()
+		if not profile and not isSecret(scatterKey, passphrase) and resultCache.lookup(key) != None:
+			return cachedResponse('decode', key)
+		imageFilename = storeUpload(image, fileExtension)
+		if imageFilename == None:
+			abort(500)
+		pendingDecodes[key] = (scatterKey, passphrase)
+		jobId = submitJob('decode', master.decodeBytes, imageFilename, scatterKey, passphrase, jobId=key, profile=profile)
+		if jobId == None:
+			pendingDecodes.pop(key, None)
+		return jobResponse('decode', jobId)
 
 	else:
 		return render_template('decode.html')
 
-@app.route('/encoded/<filename>')
-def encoded(filename):
-	return send_from_directory(app.config['UPLOAD_FOLDER_ENCODE'], filename)
+@app.route('/jobs/<jobId>')
+def job(jobId):
+	status = jobPool.status(jobId)
+	if status == None:
+		abort(404)
+	return jsonify(status)
+
+@app.route('/jobs/<jobId>/profile')
+def jobProfile(jobId):
+	report = jobPool.profile(jobId)
+	if report == None:
+		abort(404)
+	return Response(report, mimetype='text/plain')
+
+@app.route('/encoded/<key>')
+def encoded(key):
+	return sendResult(key)
+
+@app.route('/decoded/<key>')
+def decoded(key):
+	return sendResult(key)
 
-@app.route('/decoded/<filename>')
-def decoded(filename):
-	return send_from_directory(app.config['UPLOAD_FOLDER_DECODE'], filename)
+@app.route('/cache')
+def cacheStats():
+	return jsonify(resultCache.stats())
+
+@app.route('/metrics')
+def metrics():
+	return Response(spanMetrics.render() + renderCounters(), content_type=METRICS_MIMETYPE)
+
+# When a client follows a job, send it the events of the job from now on,
+# and its current status in case the job already finished.
+@socketio.on('follow')
+def follow(jobId):
+	status = jobPool.status(jobId)
+	if status != None:
+		join_room(jobId)
+		emit('job', status)
 
 @app.route('/about')
 def about():
 	return render_template('about.html')
 
-def createRandomId():
-	return ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=20)) + '_'
+# Sends the result with the given key: from the cache if it is there, or from the pool of
+# jobs if it is not (the result may be too big for the cache). The decoded messages are
+# sent as text when they are, or as a file to download otherwise. Both answer requests for
+# a range of the result. While a decode job is running, a request for a range of its
+# message is answered by decoding only that range (see sendPendingRange).
+def sendResult(key):
+	filename = resultCache.filename(key)
+	if filename != None:
+		return sendCachedFile(filename)
+	status = jobPool.status(key)
+	if status == None:
+		abort(404)
+
+	# The job must have finished well to have a result.
+	if status['state'] == master.jobs.STATE_FAILED:
+		return jsonify(status), 422
+	elif status['state'] != master.jobs.STATE_DONE:
+		if request.range != None and key in pendingDecodes:
+			return sendPendingRange(key, status)
+		return jsonify(status), 202
+	result = jobPool.result(key)
+	extension = resultExtension(status['name'], result)
+	return send_file(io.BytesIO(result), mimetype=RESULT_MIMETYPES[extension], as_attachment=extension == EXTENSION_BINARY, download_name=RESULT_NAMES[extension])
+
+# Sends the range requested of the message of a decode job that has not finished, so that
+# a client can preview the beginning of a big message, or resume its download, without
+# waiting for the job. When the message was hidden without a key or a passphrase in an image
+# whose rows can be decoded in order, the range is decoded here, from the rows that hold it
+# only. Otherwise the whole image may have to be decoded, so a job of the pool decodes the
+# range, and the client gets the status of the decode job until the range is ready. Only a
+# single range from a given byte on is supported: other requests get the status of the job.
+def sendPendingRange(key, status):
+	ranges = request.range.ranges
+	if request.range.units != 'bytes' or len(ranges) != 1 or ranges[0][0] < 0:
+		return jsonify(status), 202
+	start, stop = ranges[0]
+	scatterKey, passphrase = pendingDecodes[key]
+	imageFilename = pendingUploads.get(key)
+	if imageFilename == None:
+		return jsonify(status), 202
+	rangeId = resultCache.key('range', key, start, stop)
+	rangeStatus = jobPool.status(rangeId)
+	if rangeStatus == None and isRangeInline(imageFilename, scatterKey, passphrase):
+		error, data, length = master.decodeRangeBytes(imageFilename, start, (stop or sys.maxsize) - start)
+		if error != master.utils.ERROR_OK:
+			return jsonify(status), 202
+	elif rangeStatus == None:
+		jobPool.submit('range', master.decodeRangeJob, imageFilename, start, (stop or sys.maxsize) - start, scatterKey, passphrase, jobId=rangeId)
+		return jsonify(status), 202
+	elif rangeStatus['state'] != master.jobs.STATE_DONE:
+		return jsonify(status), 202
+	else:
+		data, length = jobPool.result(rangeId)
+
+	# The length of the whole message is unknown until it is restored if it is compressed.
+	total = '*' if length == None else str(length)
+	if len(data) == 0:
+		response = Response(status=416)
+		response.headers['Content-Range'] = 'bytes */{}'.format(total)
+		return response
+	response = Response(data, status=206, mimetype=RANGE_MIMETYPE)
+	response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, start + len(data) - 1, total)
+	response.headers['Accept-Ranges'] = 'bytes'
+	return response
+
+# Decides if a range of the message hidden in an uploaded image can be decoded in the thread
+# of the request: without a key or a passphrase, which take the whole image or a slow
+# derivation, and from an image whose rows can be decoded in order. Only its header is read.
+def isRangeInline(imageFilename, scatterKey, passphrase):
+	if isSecret(scatterKey, passphrase):
+		return False
+	carrier = master.carriers.openCarrier(imageFilename)
+	return carrier != None and carrier['image'] != None and master.utils.isRowDecodable(carrier['image'])
+
+# Sends a file of the cache, without reading it here.
+def sendCachedFile(filename):
+	extension = os.path.splitext(filename)[1]
+	return send_from_directory(CACHE_DIRECTORY, filename, mimetype=RESULT_MIMETYPES[extension], as_attachment=extension == EXTENSION_BINARY, download_name=RESULT_NAMES[extension])
+
+# Returns the extension of the result of a job.
+def resultExtension(name, result):
+	if name == 'encode':
+		return master.carriers.extensionOfBytes(result) or EXTENSION_ENCODED
+	try:
+		result.decode('utf-8')
+	except UnicodeDecodeError:
+		return EXTENSION_BINARY
+	return EXTENSION_TEXT
+
+# Stores the result of each job that finishes well in the cache, unless it is a message
+# hidden with a key or a passphrase, forgets the images of the decode jobs that finished,
+# and sends the progress of the jobs to the clients that follow them through the socket.
+# The jobs that decode a range of a message are only kept by the pool, for sendPendingRange.
+def onJobEvent(status):
+	if status['name'] == 'range':
+		return
+	secrets = (None, None)
+	if status['state'] in [master.jobs.STATE_DONE, master.jobs.STATE_FAILED]:
+		secrets = pendingDecodes.pop(status['id'], secrets)
+		removeUpload(pendingUploads.pop(status['id'], None))
+	if status['state'] == master.jobs.STATE_DONE and not isSecret(*secrets):
+		result = jobPool.result(status['id'])
+		resultCache.put(status['id'], result, resultExtension(status['name'], result))
+	socketio.emit('job', status, to=status['id'])
+
+# Submits a job whose first argument is the filename of an uploaded image, which is removed
+# once the job finishes. The image is removed right away if the job is not submitted, or if
+# the same job is already running with its own copy of the image. Returns the ID of the job,
+# like JobPool.submit.
+def submitJob(name, function, imageFilename, *arguments, jobId, profile=False):
+	if jobId in pendingUploads:
+		removeUpload(imageFilename)
+		return jobPool.submit(name, function, pendingUploads[jobId], *arguments, jobId=jobId, profile=profile)
+	pendingUploads[jobId] = imageFilename
+	submitted = jobPool.submit(name, function, imageFilename, *arguments, jobId=jobId, profile=profile)
+	if submitted == None:
+		removeUpload(pendingUploads.pop(jobId, None))
+	return submitted
+
+# Encodes the image and sends it as it is written, instead of submitting a job: the first
+# bytes are sent as soon as the encoder starts writing the image, and the rest as the rows
+# are compressed, through a pipe that bounds the memory taken by a slow client. The image is
+# stored in the cache as it is sent, unless it is too big for it. A failure before the first
+# byte is answered like a failed job, and a failure after it breaks the connection, so that
+# the client never takes a truncated image for a whole one.
+def streamEncode(key, imageFilename, messageData, options):
+	if not streamSlots.acquire(blocking=False):
+		removeUpload(imageFilename)
+		return busyResponse()
+
+	# The image is sent in the format of the uploaded one. The slot and the image are released
+	# by the thread of the encoder, once it ends.
+	extension = master.carriers.outputExtension(imageFilename)
+	def encodeInto(output):
+		try:
+			return master.encode(imageFilename, io.BytesIO(messageData), output, **options)
+		finally:
+			streamSlots.release()
+			removeUpload(imageFilename)
+	encodePipe = master.Pipe().start(encodeInto)
+	first = encodePipe.read()
+	if first == None:
+		print('ERROR: the image could not be encoded')
+		return jsonify({'id': key, 'state': master.jobs.STATE_FAILED, 'error': encodePipe.result if encodePipe.exception == None else master.utils.ERROR_JOB}), 422
+
+	partial = resultCache.begin(key, extension)
+	def generate():
+		try:
+			piece = first
+			while piece != None:
+				partial.write(piece)
+				yield piece
+				piece = encodePipe.read()
+			if encodePipe.exception != None or encodePipe.result != master.utils.ERROR_OK:
+				raise RuntimeError('the image could not be encoded after {} bytes were sent'.format(partial.size))
+			partial.commit()
+		finally:
+			encodePipe.cancel()
+			partial.discard()
+	return Response(generate(), mimetype=RESULT_MIMETYPES[extension], headers={'Content-Disposition': 'inline; filename={}'.format(RESULT_NAMES[extension])})
+
+# Decides if the uploaded image is small enough to be encoded or decoded, reading only its
+# header. Images that cannot be opened are left to the job, which reports them. Sounds are
+# measured in samples.
+def isImageAllowed(stream):
+	carrier = master.carriers.openCarrier(stream)
+	stream.seek(0)
+	return carrier == None or carrier['size'][0] * carrier['size'][1] <= MAX_IMAGE_PIXELS
+
+# Stores the uploaded image in the directory of uploads, copying it in chunks, with the given
+# extension. Returns its filename, or None if it could not be stored.
+def storeUpload(image, extension):
+	filename = os.path.join(UPLOAD_DIRECTORY, uuid.uuid4().hex + extension.lower())
+	try:
+		os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+		image.stream.seek(0)
+		image.save(filename)
+	except OSError as exception:
+		print(exception)
+		removeUpload(filename)
+		return None
+	return filename
+
+# Removes an uploaded image, if it is still there.
+def removeUpload(filename):
+	if filename == None:
+		return
+	try:
+		os.remove(filename)
+	except OSError:
+		pass
+
+# Responds to a request that is too big to be handled: its upload, message or image.
+@app.errorhandler(RequestEntityTooLarge)
+def tooLarge(error=None):
+	print('ERROR: the request is too large')
+	return jsonify({'error': 'the request is too large: up to {} bytes and {} pixels are accepted'.format(MAX_UPLOAD_BYTES, MAX_IMAGE_PIXELS)}), 413
+
+# Asks the client to come back later, when the server is too busy to take the request.
+def busyResponse():
+	response = jsonify({'error': 'the server is busy, please try again later'})
+	response.headers['Retry-After'] = str(RETRY_AFTER)
+	return response, 503
+
+# Responds to the submission of a job with its ID and where to follow it, or asks
+# the client to come back later if the queue of jobs is full.
+def jobResponse(name, jobId):
+	if jobId == None:
+		print('ERROR: the queue of jobs is full')
+		return busyResponse()
+	return jsonify({'id': jobId, 'state': jobPool.status(jobId)['state'], 'status': url_for('job', jobId=jobId), 'result': resultUrl(name, jobId)}), 202
+
+# Responds to a request whose result is already in the cache.
+def cachedResponse(name, key):
+	return jsonify({'id': key, 'state': master.jobs.STATE_DONE, 'result': resultUrl(name, key)}), 200
+
+# Returns the key that scatters the message across the image, given in the form of the
+# current request, or None if there is none.
+def requestKey():
+	return request.form.get('key', '') or None
+
+# Returns the passphrase that encrypts the message, given in the form of the current
+# request, or None if there is none.
+def requestPassphrase():
+	return request.form.get('passphrase', '') or None
+
+# Decides if a message is hidden with a key or a passphrase, which keep its result out of the cache.
+def isSecret(scatterKey, passphrase):
+	return scatterKey != None or passphrase != None
+
+# Decides if the encoded image of the current request must be sent as it is written, as
+# asked with ?stream=1 or with the stream field of the form.
+def isStreaming():
+	return request.args.get('stream') == '1' or request.form.get('stream') == '1'
+
+# Decides if the job of the current request must run under cProfile.
+def isProfiling():
+	return PROFILING and request.args.get('profile') == '1'
+
+# Returns the counters of the cache and the number of jobs in each state, in the text
+# format of Prometheus.
+def renderCounters():
+	lines = []
+	stats = resultCache.stats()
+	for name, metricType in [('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')]:
+		metric = 'lsb_cache_' + name + ('_total' if metricType == 'counter' else '')
+		lines += ['# TYPE {} {}'.format(metric, metricType), '{} {}'.format(metric, stats[name])]
+	counts = jobPool.counts()
+	lines += ['# TYPE lsb_jobs gauge'] + ['lsb_jobs{{state="{}"}} {}'.format(state, counts[state]) for state in sorted(counts) if state != 'capacity']
+	lines += ['# TYPE lsb_jobs_capacity gauge', 'lsb_jobs_capacity {}'.format(counts['capacity'])]
+	return '\n'.join(lines) + '\n'
+
+# Returns the URL of the result of a request.
+def resultUrl(name, key):
+	return url_for('encoded' if name == 'encode' else 'decoded', key=key)
 
 if __name__ == '__main__':
 	app.debug = True
@@ -0,0 +1,125 @@
+import os
+import time
+
+from encode import encodeAlgorithm
+from decode import decodeAlgorithm
+import carriers
+import pool
+import utils
+
+# Batch modes.
+MODE_ENCODE = 'encode'
+MODE_DECODE = 'decode'
+
+# Extension of the messages decoded from a directory of images.
+DECODED_EXTENSION = '.bin'
+
+# Prefix of the files being written. Outputs are renamed to their final name only once
+# they are complete, so that an interrupted batch never leaves a file that looks complete.
+PARTIAL_PREFIX = '.partial-'
+
+# Builds the items of a batch from a directory of images. When encoding, the same message
+# file is hidden inside every image; when decoding, msgFilename is not used. Each output
+# is stored in outputDirectory with the name of its image, and when encoding, the extension
+# of the backend that writes it. Returns None if the directory cannot be read.
+def itemsFromDirectory(mode, imgDirectory, msgFilename, outputDirectory):
+	try:
+		imgFilenames = carriers.listFiles(imgDirectory)
+	except OSError as exception:
+		utils.log(exception)
+		return None
+	items = []
+	for imgFilename in imgFilenames:
+		root = os.path.splitext(os.path.basename(imgFilename))[0]
+		if mode == MODE_ENCODE:
+			items.append((imgFilename, msgFilename, os.path.join(outputDirectory, root + carriers.outputExtension(imgFilename))))
+		else:
+			items.append((imgFilename, os.path.join(outputDirectory, root + DECODED_EXTENSION)))
+	return items
+
+# Builds the items of a batch from a manifest file. Each line holds the tab separated
+# image, message and output filenames when encoding, or the image and message filenames
+# when decoding. Empty lines and lines starting with '#' are skipped, and relative paths
+# are relative to the directory of the manifest. Returns None if the manifest is not valid.
+def itemsFromManifest(mode, manifestFilename):
+	baseDirectory = os.path.dirname(os.path.abspath(manifestFilename))
+	numFields = 3 if mode == MODE_ENCODE else 2
+	items = []
+	try:
+		with open(manifestFilename, 'r') as manifest:
+			for lineNumber, line in enumerate(manifest, 1):
+				line = line.rstrip('\r\n')
+				if line.strip() == '' or line.startswith('#'):
+					continue
+				fields = line.split('\t')
+				if len(fields) != numFields:
+					utils.log('ERROR: line {} of the manifest must have {} fields separated by tabs'.format(lineNumber, numFields))
+					return None
+				items.append(tuple(os.path.join(baseDirectory, field) for field in fields))
+	except Exception as exception:
+		utils.log(exception)
+		return None
+	return items
+
+# Runs every item of the batch in a pool of processes and logs the result code of each one
+# as it finishes, followed by a summary. With resume, the items whose output already exists
+# are skipped. The options are passed to the encode or decode algorithm. Returns a dictionary from
+# each result code to the number of items that got it.
+def batchAlgorithm(mode, items, processes=None, resume=False, **options):
+
+	# Skip the items that are already complete.
+	if resume:
+		pendingItems = [item for item in items if not os.path.exists(item[-1])]
+		utils.log('Skipping {} items already completed'.format(len(items) - len(pendingItems)))
+		items = pendingItems
+
+	# Create the output directories.
+	for outputDirectory in set(os.path.dirname(item[-1]) for item in items):
+		if outputDirectory != '':
+			os.makedirs(outputDirectory, exist_ok=True)
+
+	# Run the items and log their results as they finish.
+	results = {}
+	numBytes = 0
+	start = time.perf_counter()
+	arguments = ((mode, item, options) for item in items)
+	for error, item, itemBytes in pool.imapUnordered(runItem, arguments, processes):
+		results[error] = results.get(error, 0) + 1
+		numBytes += itemBytes
+		utils.log('{}\t{}\t{}'.format(error, item[0], item[-1]))
+
+	# Log a summary with the throughput of the batch.
+	elapsed = max(time.perf_counter() - start, 1e-9)
+	utils.log('{} items in {:.2f} s: {:.2f} images/s, {:.2f} MB/s'.format(len(items), elapsed, len(items) / elapsed, numBytes / elapsed / 1e6))
+	for error in sorted(results):
+		utils.log('\tresult {}: {} items'.format(error, results[error]))
+	return results
+
+# Runs one item of the batch inside a worker process, writing its output under a partial
+# name that is renamed once complete. Returns the result code, the item and the number
+# of bytes read (image and message files).
+def runItem(mode, item, options):
+	utils.silent = True
+	outputFilename = item[-1]
+	partialFilename = os.path.join(os.path.dirname(outputFilename), PARTIAL_PREFIX + os.path.basename(outputFilename))
+	if mode == MODE_ENCODE:
+		error = encodeAlgorithm(item[0], item[1], partialFilename, **options)
+	else:
+		error = decodeAlgorithm(item[0], partialFilename, **options)
+
+	# Publish the output, or remove what was left of it.
+	try:
+		if error == utils.ERROR_OK:
+			os.replace(partialFilename, outputFilename)
+		elif os.path.exists(partialFilename):
+			os.remove(partialFilename)
+	except OSError:
+		error = utils.ERROR_SAVE_IMG if mode == MODE_ENCODE else utils.ERROR_SAVE_MSG
+	return error, item, sum(fileSize(filename) for filename in item[:-1])
+
+# Returns the size of a file, or 0 if it cannot be read.
+def fileSize(filename):
+	try:
+		return os.path.getsize(filename)
+	except OSError:
+		return 0
@@ -0,0 +1,480 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy
+from PIL import Image
+
+from encode import encodeAlgorithm
+from decode import decodeAlgorithm
+import capacity
+import carriers
+import container
+import decode
+import encode
+import pngwriter
+import utils
+
+# Version of the format of the results. Results with another version are not compared.
+RESULTS_VERSION = 1
+
+# Directory with the images used by the tests, which are benchmarked as carriers too.
+TEST_FILES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files')
+
+# Synthetic carriers: sides of the square images, and PIL modes (I;16 is 16-bit grayscale).
+SYNTHETIC_SIDES = [256, 1024, 2048]
+SYNTHETIC_MODES = ['L', 'RGB', 'RGBA', 'I;16']
+
+# Sizes in bytes of the payloads hidden in each carrier (those that do not fit are skipped),
+# and numbers of bits per channel used to hide them.
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+BITS_PER_CHANNEL = [1, 4]
+
+# Size in bytes of the payload hidden in each carrier written with each backend of carriers.py,
+# or half the capacity of the carrier with one bit per channel, if it is smaller.
+BACKEND_PAYLOAD_SIZE = 64 * 1024
+
+# Length in seconds, sample rate and channels of the synthetic sound written as WAV.
+SOUND_SECONDS = 10
+SOUND_RATE = 44100
+SOUND_CHANNELS = 2
+
+# Smaller sets of carriers and payloads, for a quick run.
+QUICK_SIDES = [256, 1024]
+QUICK_PAYLOAD_SIZES = [1024, 64 * 1024]
+
+# Number of times each case is run by default. The median of the runs is reported.
+DEFAULT_REPEAT = 3
+
+# Relative slowdown of the wall time of a case above which it is reported as a regression.
+DEFAULT_THRESHOLD = 0.1
+
+# Commands whose start-up time is measured, each one in a new interpreter started from this
+# directory, and the budget in seconds that the median of their runs must stay under. The
+# command line must print its help, and the modules must be imported, without loading NumPy
+# and PIL, whose own import is measured as a reference, with no budget.
+STARTUP_COMMANDS = {
+	'interpreter': ['-c', 'pass'],
+	'help': ['lab.py', '--help'],
+	'import': ['-c', 'import encode, decode, batch, worker'],
+	'numpy-pil': ['-c', 'import numpy, PIL.Image'],
+}
+STARTUP_BUDGETS = {'help': 0.5, 'import': 0.5}
+
+# Seed of the random generator of the synthetic carriers and payloads, so that every run
+# benchmarks the same data.
+SEED = 1234
+
+
+# Runs the benchmark, or compares two results files, as requested in the command line.
+def main():
+	arguments = createParser().parse_args()
+	if arguments.compare and arguments.results:
+		return compareFiles(arguments.compare, arguments.results, arguments.threshold)
+
+	if arguments.startup:
+		results = {'version': RESULTS_VERSION, 'python': platform.python_version(), 'platform': platform.platform(), 'startup': measureStartup(arguments.repeat)}
+	elif arguments.png:
+		results = runPngBenchmark(arguments.repeat)
+	elif arguments.carriers:
+		results = runBackendBenchmark(arguments.repeat)
+	else:
+		results = runBenchmark(arguments.quick, arguments.repeat)
+	if arguments.output:
+		with open(arguments.output, 'w') as outputFile:
+			json.dump(results, outputFile, indent=1)
+	else:
+		json.dump(results, sys.stdout, indent=1)
+		print()
+
+	# Compare with the baseline, if one was given, and check the budgets of the start-up time.
+	error = 0
+	if arguments.compare and not arguments.png and not arguments.carriers and not arguments.startup:
+		with open(arguments.compare, 'r') as baselineFile:
+			error = compareResults(json.load(baselineFile), results, arguments.threshold)
+	if 'startup' in results:
+		error = checkStartup(results['startup']) or error
+	return error
+
+
+# Creates the parser of the command line arguments of the benchmark.
+def createParser():
+	parser = argparse.ArgumentParser(prog='benchmark.py', description='Measure the encode and decode throughput over the test images and synthetic carriers.')
+	parser.add_argument('-o', '--output', help='file where the JSON results are written (default: standard output)')
+	parser.add_argument('--compare', metavar='BASELINE', help='JSON results of a previous run, to report the cases that got slower')
+	parser.add_argument('--results', help='JSON results to compare with the baseline, instead of running the benchmark')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+		help='relative slowdown reported as a regression (default: {})'.format(DEFAULT_THRESHOLD))
+	parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='number of runs of each case (default: {})'.format(DEFAULT_REPEAT))
+	parser.add_argument('--quick', action='store_true', help='benchmark smaller carriers and payloads')
+	parser.add_argument('--png', action='store_true', help='measure instead the time and size of the images written with each preset of the PNG writer')
+	parser.add_argument('--carriers', action='store_true', help='measure instead the encode and decode time and the size of the carriers written with each backend (PNG, BMP, WebP, TIFF and WAV)')
+	parser.add_argument('--startup', action='store_true', help='only measure the start-up time of the command line and of the imports, which is also measured with the cases')
+	return parser
+
+
+# Runs every case, each one in a new process, so that its peak memory is its own.
+# Returns a dictionary with the results, ready to be stored as JSON.
+def runBenchmark(quick=False, repeat=DEFAULT_REPEAT):
+	directory = tempfile.mkdtemp(prefix='benchmark-')
+	try:
+		carriers = listCarriers(directory, QUICK_SIDES if quick else SYNTHETIC_SIDES)
+		cases = listCases(carriers, QUICK_PAYLOAD_SIZES if quick else PAYLOAD_SIZES)
+		context = multiprocessing.get_context('spawn')
+		results = []
+		with context.Pool(1, maxtasksperchild=1) as pool:
+			for case in cases:
+				result = pool.apply(runCase, (case, directory, repeat))
+				print('{}\t{:.2f} MB/s encode\t{:.2f} MB/s decode'.format(result['name'], result['encode']['mbps'], result['decode']['mbps']), file=sys.stderr)
+				results.append(result)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	return {
+		'version': RESULTS_VERSION,
+		'python': platform.python_version(),
+		'numpy': numpy.__version__,
+		'pillow': Image.__version__,
+		'platform': platform.platform(),
+		'repeat': repeat,
+		'startup': measureStartup(repeat),
+		'cases': results,
+	}
+
+
+# Writes every image of the tests with each preset of the PNG writer (and as PIL writes it
+# by default), to pick between latency and bandwidth. Returns a dictionary with the median
+# time and the size of each image with each preset, ready to be stored as JSON.
+def runPngBenchmark(repeat=DEFAULT_REPEAT):
+	utils.silent = True
+	presets = {'pil': None}
+	presets.update({name: pngwriter.writerOptions(name) for name in pngwriter.PRESETS})
+	results = []
+	for carrier in carriers.listFiles(TEST_FILES_DIRECTORY):
+		image = utils.decodeImage(utils.openImage(carrier))
+		array = utils.extractArrayFromImage(image)
+		result = {'name': os.path.basename(carrier), 'mode': image.mode, 'size': list(image.size), 'rawBytes': array.nbytes, 'presets': {}}
+		for name, options in presets.items():
+			runs = []
+			for run in range(repeat):
+				output = io.BytesIO()
+				start = time.perf_counter()
+				if pngwriter.saveArray(output, image.mode, image.size, array, options) != 0:
+					raise RuntimeError('could not write {} with the preset {}'.format(carrier, name))
+				runs.append(time.perf_counter() - start)
+			seconds = statistics.median(runs)
+			result['presets'][name] = {'seconds': seconds, 'bytes': len(output.getvalue()), 'mbps': array.nbytes / seconds / 1e6}
+			print('{}\t{}\t{:.3f} s\t{} bytes'.format(result['name'], name, seconds, len(output.getvalue())), file=sys.stderr)
+		results.append(result)
+	return {
+		'version': RESULTS_VERSION,
+		'python': platform.python_version(),
+		'numpy': numpy.__version__,
+		'pillow': Image.__version__,
+		'platform': platform.platform(),
+		'repeat': repeat,
+		'presets': {name: options for name, options in presets.items()},
+		'images': results,
+	}
+
+
+# Hides a payload in every image of the tests, and in a synthetic sound, and writes the encoded
+# carrier with each backend of carriers.py that can store it, to pick between the time to
+# encode and decode and the size of the transfer. Returns a dictionary with the median times
+# and the size of each carrier with each backend, ready to be stored as JSON.
+def runBackendBenchmark(repeat=DEFAULT_REPEAT):
+	utils.silent = True
+	directory = tempfile.mkdtemp(prefix='benchmark-')
+	results = []
+	try:
+		generator = numpy.random.default_rng(SEED)
+		for source in carriers.listFiles(TEST_FILES_DIRECTORY) + [syntheticSound(generator, directory)]:
+			carrier = carriers.openCarrier(source)
+			carriers.closeCarrier(carrier)
+			payloadSize = min(BACKEND_PAYLOAD_SIZE, capacity.capacityBits(carrier['channels']) // 16)
+			payload = generator.integers(0, 256, payloadSize, dtype=numpy.uint8).tobytes()
+			result = {'name': os.path.basename(source), 'mode': carrier['mode'] or carrier['format'], 'size': list(carrier['size']), 'payloadSize': payloadSize, 'backends': {}}
+			for name, backend in carriers.BACKENDS.items():
+				if not carriers.canWrite(carrier, name):
+					continue
+				result['backends'][name] = runBackend(source, payload, os.path.join(directory, 'output' + backend['extensions'][0]), repeat)
+				print('{}\t{}\t{:.3f} s encode\t{:.3f} s decode\t{} bytes'.format(result['name'], name, result['backends'][name]['encodeSeconds'], result['backends'][name]['decodeSeconds'], result['backends'][name]['bytes']), file=sys.stderr)
+			results.append(result)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	return {
+		'version': RESULTS_VERSION,
+		'python': platform.python_version(),
+		'numpy': numpy.__version__,
+		'pillow': Image.__version__,
+		'platform': platform.platform(),
+		'repeat': repeat,
+		'carriers': results,
+	}
+
+
+# Encodes the payload inside the source carrier into outputFilename, whose extension picks the
+# backend, and decodes it back, repeat times. Returns the median time of each one, and the size
+# of the encoded carrier.
+def runBackend(source, payload, outputFilename, repeat):
+	encodeRuns = []
+	decodeRuns = []
+	for run in range(repeat):
+		start = time.perf_counter()
+		if encodeAlgorithm(source, io.BytesIO(payload), outputFilename) != utils.ERROR_OK:
+			raise RuntimeError('could not encode {} into {}'.format(source, outputFilename))
+		encodeRuns.append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		message = io.BytesIO()
+		if decodeAlgorithm(outputFilename, message) != utils.ERROR_OK or message.getvalue() != payload:
+			raise RuntimeError('could not decode {}'.format(outputFilename))
+		decodeRuns.append(time.perf_counter() - start)
+	return {'encodeSeconds': statistics.median(encodeRuns), 'decodeSeconds': statistics.median(decodeRuns), 'bytes': os.path.getsize(outputFilename)}
+
+
+# Creates a 16-bit PCM sound inside directory, with a tone and some noise. Returns its filename.
+def syntheticSound(generator, directory):
+	times = numpy.arange(SOUND_SECONDS * SOUND_RATE) / SOUND_RATE
+	tone = numpy.sin(2 * numpy.pi * 440 * times)[:, None] * 8000 + generator.normal(0, 500, (len(times), SOUND_CHANNELS))
+	filename = os.path.join(directory, 'synthetic_sound.wav')
+	with wave.open(filename, 'wb') as writer:
+		writer.setnchannels(SOUND_CHANNELS)
+		writer.setsampwidth(2)
+		writer.setframerate(SOUND_RATE)
+		writer.writeframes(numpy.clip(tone, -32768, 32767).astype('<i2').tobytes())
+	return filename
+
+
+# Runs each start-up command repeat times in a new interpreter. Returns a dictionary with the
+# median time of each command and its budget, if it has one.
+def measureStartup(repeat=DEFAULT_REPEAT):
+	directory = os.path.dirname(os.path.abspath(__file__))
+	results = {}
+	for name, arguments in STARTUP_COMMANDS.items():
+		runs = []
+		for run in range(repeat):
+			start = time.perf_counter()
+			subprocess.run([sys.executable] + arguments, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+			runs.append(time.perf_counter() - start)
+		results[name] = {'seconds': statistics.median(runs), 'budget': STARTUP_BUDGETS.get(name)}
+		print('startup/{}	{:.3f} s'.format(name, results[name]['seconds']), file=sys.stderr)
+	return results
+
+
+# Prints the start-up time of every command with a budget, and returns 1 if any of them
+# is over its budget, or 0 otherwise.
+def checkStartup(startup):
+	overBudget = 0
+	for name, result in startup.items():
+		if result['budget'] == None:
+			continue
+		over = result['seconds'] > result['budget']
+		overBudget += over
+		print('startup/{}	{:.3f} s	budget {:.3f} s{}'.format(name, result['seconds'], result['budget'], '\tOVER BUDGET' if over else ''))
+	return 1 if overBudget > 0 else 0
+
+
+# Returns the list of carriers: the images of the tests, and synthetic images of each
+# mode and side, which are created inside directory.
+def listCarriers(directory, sides):
+	filenames = carriers.listFiles(TEST_FILES_DIRECTORY)
+	generator = numpy.random.default_rng(SEED)
+	for side in sides:
+		for mode in SYNTHETIC_MODES:
+			filename = os.path.join(directory, 'synthetic_{}_{}.png'.format(mode.replace(';', ''), side))
+			syntheticImage(generator, mode, side).save(filename)
+			filenames.append(filename)
+	return filenames
+
+
+# Creates a square image with a smooth gradient and some noise, like a photograph.
+def syntheticImage(generator, mode, side):
+	rows, columns = numpy.mgrid[0:side, 0:side]
+	if mode == 'I;16':
+		values = (rows * 65535 // side + generator.integers(0, 256, (side, side))) % 65536
+		return Image.fromarray(values.astype(numpy.uint16))
+	bands = len(Image.new(mode, (1, 1)).getbands())
+	values = (rows[..., None] + columns[..., None] * (numpy.arange(bands) + 1)) * 255 // side + generator.integers(0, 16, (side, side, bands))
+	values = (values % 256).astype(numpy.uint8)
+	return Image.fromarray(values[..., 0] if bands == 1 else values, mode)
+
+
+# Returns the cases to run: each carrier with each payload size and number of bits per
+# channel, as long as the payload fits inside the carrier.
+def listCases(carriers, payloadSizes):
+	cases = []
+	for carrier in carriers:
+		bits = capacity.imageCapacity(carrier)
+		for payloadSize in payloadSizes:
+			for bitsPerChannel in BITS_PER_CHANNEL:
+				if bits != None and bits.get(bitsPerChannel, 0) // 8 >= payloadSize:
+					cases.append({
+						'name': '{}/{}B/{}bit'.format(os.path.basename(carrier), payloadSize, bitsPerChannel),
+						'carrier': carrier,
+						'payloadSize': payloadSize,
+						'bitsPerChannel': bitsPerChannel,
+					})
+	return cases
+
+
+# Runs one case inside a worker process: the whole encode and decode algorithms, and each
+# of their stages on their own. Returns a dictionary with the median of the wall times of
+# the runs, the median time of each stage, the throughput of the payload and the peak memory.
+def runCase(case, directory, repeat):
+	utils.silent = True
+	resetPeakRss()
+	baselineRss = peakRss()
+	payload = numpy.random.default_rng(SEED).integers(0, 256, case['payloadSize'], dtype=numpy.uint8).tobytes()
+	outputFilename = os.path.join(directory, 'output.png')
+	stagesFilename = os.path.join(directory, 'stages.png')
+
+	encodeRuns = []
+	decodeRuns = []
+	for run in range(repeat):
+		start = time.perf_counter()
+		if encodeAlgorithm(case['carrier'], io.BytesIO(payload), outputFilename, case['bitsPerChannel']) != utils.ERROR_OK:
+			raise RuntimeError('could not encode the case {}'.format(case['name']))
+		encodeRuns.append({'wall': time.perf_counter() - start, 'stages': encodeStages(case['carrier'], payload, stagesFilename, case['bitsPerChannel'])})
+
+		start = time.perf_counter()
+		message = io.BytesIO()
+		if decodeAlgorithm(outputFilename, message) != utils.ERROR_OK or message.getvalue() != payload:
+			raise RuntimeError('could not decode the case {}'.format(case['name']))
+		decodeRuns.append({'wall': time.perf_counter() - start, 'stages': decodeStages(outputFilename)})
+
+	with Image.open(case['carrier']) as image:
+		mode, size = image.mode, image.size
+	return dict(case,
+		mode=mode,
+		size=list(size),
+		encode=summarize(encodeRuns, case['payloadSize']),
+		decode=summarize(decodeRuns, case['payloadSize']),
+		peakRssKB=peakRss(),
+		baselineRssKB=baselineRss,
+	)
+
+
+# Times each stage of the array engine of the encoder: open the image, extract its channel
+# values, pack the header and the payload into channel values, embed them, and save the image.
+def encodeStages(imgFilename, payload, outputFilename, bitsPerChannel):
+	times = {}
+	with stage(times, 'open'):
+		image = utils.openImage(imgFilename)
+		if not utils.isDeepImage(image):
+			image.load()
+	with stage(times, 'extract'):
+		array = utils.extractArrayFromImage(image)
+	with stage(times, 'pack'):
+		extensions = container.layoutExtensions(bitsPerChannel)
+		header = container.packHeader(len(payload), container.checksum(payload), extensions=extensions)
+		headerValues = encode.bytesToChannelValues(header)
+		payloadValues = encode.bytesToChannelValues(payload, bitsPerChannel)
+	with stage(times, 'embed'):
+		encode.writeChannelValues(array, headerValues)
+		encode.writeChannelValues(array, payloadValues, len(headerValues), bitsPerChannel)
+	with stage(times, 'save'):
+		utils.saveArray(outputFilename, image.mode, image.size, array)
+	return times
+
+
+# Times each stage of the decoder: open the image, extract its channel values, find the
+# header of the message, and extract and verify the payload.
+def decodeStages(imgFilename):
+	times = {}
+	with stage(times, 'open'):
+		image = utils.openImage(imgFilename)
+		if not utils.isDeepImage(image):
+			image.load()
+	with stage(times, 'extract'):
+		array = utils.extractArrayFromImage(image)
+	with stage(times, 'find'):
+		secretMessage = decode.findSecretMessageInArray(array)
+	with stage(times, 'restore'):
+		for chunk in decode.restoreMessage(secretMessage):
+			pass
+	return times
+
+
+# Adds the time spent inside the block to times[name].
+@contextlib.contextmanager
+def stage(times, name):
+	start = time.perf_counter()
+	yield
+	times[name] = times.get(name, 0) + time.perf_counter() - start
+
+
+# Returns the median wall time of the runs, the median time of each stage, and the
+# throughput of the payload in MB/s for the median wall time.
+def summarize(runs, payloadSize):
+	wall = statistics.median(run['wall'] for run in runs)
+	return {
+		'wall': wall,
+		'minWall': min(run['wall'] for run in runs),
+		'stages': {name: statistics.median(run['stages'][name] for run in runs) for name in runs[0]['stages']},
+		'mbps': payloadSize / wall / 1e6,
+	}
+
+
+# Returns the peak resident memory of this process, in KB. On Linux it is read from /proc,
+# since getrusage keeps the peak of the process that started this one across exec.
+def peakRss():
+	try:
+		with open('/proc/self/status', 'r') as status:
+			for line in status:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Resets the peak resident memory of this process to its current memory, where supported.
+def resetPeakRss():
+	try:
+		with open('/proc/self/clear_refs', 'w') as clearRefs:
+			clearRefs.write('5')
+	except OSError:
+		pass
+
+
+# Compares the results stored in two files. Returns what compareResults returns.
+def compareFiles(baselineFilename, resultsFilename, threshold):
+	with open(baselineFilename, 'r') as baselineFile, open(resultsFilename, 'r') as resultsFile:
+		return compareResults(json.load(baselineFile), json.load(resultsFile), threshold)
+
+
+# Prints the change of the wall time of every case found in both results, and returns 1 if
+# any of them got slower than the threshold allows, or 0 otherwise.
+def compareResults(baseline, results, threshold):
+	if baseline.get('version') != RESULTS_VERSION or results.get('version') != RESULTS_VERSION:
+		print('ERROR: the results have different versions', file=sys.stderr)
+		return 1
+	baselineCases = {case['name']: case for case in baseline['cases']}
+	regressions = 0
+	for case in results['cases']:
+		baselineCase = baselineCases.get(case['name'])
+		if baselineCase == None:
+			continue
+		for operation in ['encode', 'decode']:
+			change = case[operation]['wall'] / baselineCase[operation]['wall'] - 1
+			regression = change > threshold
+			regressions += regression
+			print('{}\t{}\t{:+.1%}{}'.format(case['name'], operation, change, '\tREGRESSION' if regression else ''))
+	print('{} regressions above {:.0%}'.format(regressions, threshold))
+	return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,271 @@
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+import uuid
+
+import utils
+
+# Maximum size in bytes of the results stored in the cache when none is requested.
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Prefix of the files being written into the cache. They are renamed to their key once complete.
+PARTIAL_PREFIX = '.partial-'
+
+# Seconds since their last write after which the partial files are left by a process that stopped.
+# Younger ones may still be written by another process sharing the directory.
+STALE_PARTIAL_SECONDS = 60 * 60
+
+# Name of the file that holds the secret of the keys inside the directory of the cache, and its size in bytes.
+SECRET_NAME = '.secret'
+SECRET_BYTES = 32
+
+# Returns the key of the result of a request: an HMAC, under the given secret, of its kind
+# (like 'encode') and of its parts, which are the bytes it reads and its options, in order.
+# The keys are shown to the clients, so without the secret nothing of the parts, like a
+# passphrase, can be guessed from them. The bytes may also be given as binary file objects,
+# which are read in chunks from their current position and then rewound to it: they give
+# the same key as their bytes.
+def resultKey(secret, kind, *parts):
+	digest = hmac.new(secret, kind.encode('utf-8'), hashlib.sha256)
+	for part in parts:
+		if utils.isFileObject(part):
+			position = part.tell()
+			digest.update(utils.fileLength(part).to_bytes(8, 'big'))
+			for chunk in utils.readChunks(part):
+				digest.update(chunk)
+			part.seek(position)
+			continue
+		if not isinstance(part, (bytes, bytearray)):
+			part = repr(part).encode('utf-8')
+
+		# The length of each part goes first, so that different parts never give the same bytes.
+		digest.update(len(part).to_bytes(8, 'big'))
+		digest.update(part)
+	return digest.hexdigest()
+
+# Stores the results of requests in files inside a directory, named by their key and an
+# extension that tells their kind. When the results take more than maxBytes, the least
+# recently used ones are removed. The order of use survives restarts through the
+# modification time of the files, and so do the keys, through the secret stored with them.
+# Hits and misses are counted for monitoring.
+class ResultCache:
+
+	def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		self.entries = collections.OrderedDict()
+		self.numBytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+		self.secret = self.loadSecret()
+		self.load()
+
+	# Returns the key of the result of a request in this cache (see resultKey).
+	def key(self, kind, *parts):
+		return resultKey(self.secret, kind, *parts)
+
+	# Reads the secret of the keys from the directory, or creates it at random, readable only
+	# by its owner. If it cannot be stored, a secret of this process is used instead: the
+	# results stored before are not found again, but they are still evicted in time.
+	def loadSecret(self):
+		filename = os.path.join(self.directory, SECRET_NAME)
+		try:
+			with open(filename, 'rb') as secretFile:
+				secret = secretFile.read()
+			if len(secret) == SECRET_BYTES:
+				return secret
+		except FileNotFoundError:
+			pass
+		except OSError as exception:
+			utils.log(exception)
+		secret = os.urandom(SECRET_BYTES)
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			partialFilename = filename + '-' + uuid.uuid4().hex
+			with os.fdopen(os.open(partialFilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as secretFile:
+				secretFile.write(secret)
+			os.replace(partialFilename, filename)
+		except OSError as exception:
+			utils.log(exception)
+		return secret
+
+	# Finds the results already stored in the directory, from the least to the most recently used.
+	# The partial results left by a previous process that stopped while writing them, that is
+	# not written for STALE_PARTIAL_SECONDS, are removed.
+	def load(self):
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return
+		for name in names:
+			if name.startswith(PARTIAL_PREFIX):
+				self.removeStalePartial(name)
+		names = [name for name in names if not name.startswith(PARTIAL_PREFIX) and not name.startswith(SECRET_NAME)]
+		files = []
+		for name in names:
+			try:
+				stat = os.stat(os.path.join(self.directory, name))
+			except OSError:
+				continue
+			files.append((stat.st_mtime, name, stat.st_size))
+		with self.lock:
+			for mtime, name, size in sorted(files):
+				self.entries[os.path.splitext(name)[0]] = (name, size)
+				self.numBytes += size
+			self.evict()
+
+	# Looks for the result with the given key, counting a hit or a miss. Returns the name of
+	# its file inside the directory, or None if it is not stored.
+	def lookup(self, key):
+		filename = self.filename(key)
+		with self.lock:
+			if filename == None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		return filename
+
+	# Returns the name of the file of the result with the given key inside the directory,
+	# or None if it is not stored, and marks it as the most recently used.
+	def filename(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry == None:
+				return None
+			self.entries.move_to_end(key)
+		try:
+			os.utime(os.path.join(self.directory, entry[0]))
+		except OSError:
+			pass
+		return entry[0]
+
+	# Stores the result with the given key in a file with the given extension, and removes
+	# the least recently used results if the cache grows too big. Results bigger than the
+	# whole cache are not stored. Returns the name of the file, or None if it was not stored.
+	def put(self, key, data, extension):
+		if len(data) > self.maxBytes:
+			return None
+		partial = self.begin(key, extension)
+		partial.write(data)
+		return partial.commit()
+
+	# Starts storing the result with the given key as it is produced, in pieces. Returns a
+	# PartialResult, which must be committed once the result is complete, or discarded.
+	def begin(self, key, extension):
+		return PartialResult(self, key, extension)
+
+	# Adds the complete file of a result, already named after its key, to the entries.
+	def add(self, key, name, size):
+		with self.lock:
+			previous = self.entries.pop(key, None)
+			if previous != None:
+				self.numBytes -= previous[1]
+				if previous[0] != name:
+					self.removeFile(previous[0])
+			self.entries[key] = (name, size)
+			self.numBytes += size
+			self.evict()
+
+	# Returns a dictionary with the counters of the cache.
+	def stats(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'entries': len(self.entries),
+				'bytes': self.numBytes,
+				'maxBytes': self.maxBytes,
+			}
+
+	# Removes the least recently used results until the cache fits in maxBytes.
+	# The lock must be held.
+	def evict(self):
+		while self.numBytes > self.maxBytes and len(self.entries) > 0:
+			key, (name, size) = self.entries.popitem(last=False)
+			self.numBytes -= size
+			self.evictions += 1
+			self.removeFile(name)
+
+	# Removes a file from the directory, if it is still there.
+	def removeFile(self, name):
+		try:
+			os.remove(os.path.join(self.directory, name))
+		except OSError:
+			pass
+
+	# Removes a partial file from the directory if it was not written for STALE_PARTIAL_SECONDS.
+	def removeStalePartial(self, name):
+		try:
+			mtime = os.stat(os.path.join(self.directory, name)).st_mtime
+		except OSError:
+			return
+		if time.time() - mtime >= STALE_PARTIAL_SECONDS:
+			self.removeFile(name)
+
+
+# A result being written into the cache as it is produced. Until it is committed it is a
+# partial file that is never found, and it is dropped as soon as it grows bigger than the
+# whole cache, so that big results are written and then thrown away at most once.
+class PartialResult:
+
+	def __init__(self, cache, key, extension):
+		self.cache = cache
+		self.key = key
+		self.name = key + extension
+		self.filename = os.path.join(cache.directory, PARTIAL_PREFIX + uuid.uuid4().hex)
+		self.size = 0
+		try:
+			os.makedirs(cache.directory, exist_ok=True)
+			self.file = open(self.filename, 'wb')
+		except OSError as exception:
+			utils.log(exception)
+			self.file = None
+
+	# Writes the next piece of the result. Returns False once the result will not be stored.
+	def write(self, data):
+		if self.file == None:
+			return False
+		self.size += len(data)
+		if self.size > self.cache.maxBytes:
+			self.discard()
+			return False
+		try:
+			self.file.write(data)
+		except OSError as exception:
+			utils.log(exception)
+			self.discard()
+			return False
+		return True
+
+	# Stores the complete result under its key. Returns the name of its file, or None if it
+	# was not stored.
+	def commit(self):
+		if self.file == None:
+			return None
+		try:
+			self.file.close()
+			self.file = None
+			os.replace(self.filename, os.path.join(self.cache.directory, self.name))
+		except OSError as exception:
+			utils.log(exception)
+			self.cache.removeFile(os.path.basename(self.filename))
+			return None
+		self.cache.add(self.key, self.name, self.size)
+		return self.name
+
+	# Drops the result, unless it was already committed.
+	def discard(self):
+		if self.file == None:
+			return
+		self.file.close()
+		self.file = None
+		try:
+			os.remove(self.filename)
+		except OSError:
+			pass
@@ -0,0 +1,125 @@
+import bisect
+import json
+import os
+
+import carriers
+import container
+import utils
+
+# Name of the file, inside a directory of carriers, where the index of their capacity is stored.
+INDEX_FILENAME = '.carriers.json'
+
+# Version of the index file. An index with another version is rebuilt.
+INDEX_VERSION = 2
+
+# Modes whose values are not integers: they are encoded through the list of pixels,
+# which only supports one bit per channel.
+PIXEL_LIST_MODES = ['1', 'F']
+
+# Returns a dictionary with the width, height, mode, bits per channel and number of channel
+# values of the image stored in filename, reading only its header. Sounds have a width of
+# frames, a height of channels and the mode WAV. Returns None if it cannot be opened.
+def readImageInfo(filename):
+	carrier = carriers.openCarrier(filename)
+	if carrier == None:
+		return None
+	carriers.closeCarrier(carrier)
+	width, height = carrier['size']
+	return {'width': width, 'height': height, 'mode': carrier['mode'] or carrier['format'], 'bitDepth': carrier['bitDepth'], 'channels': carrier['channels']}
+
+# Returns the number of channel values taken by the header of a payload hidden with
+# bitsPerChannel bits per channel.
+def headerChannels(bitsPerChannel=1):
+	return len(container.packHeader(0, 0, extensions=container.layoutExtensions(bitsPerChannel))) * 8
+
+# Returns the number of bits of payload that fit inside numChannels channel values when
+# the payload takes bitsPerChannel bits of each one, after the header that describes it.
+def capacityBits(numChannels, bitsPerChannel=1):
+	return max(numChannels - headerChannels(bitsPerChannel), 0) * bitsPerChannel
+
+# Returns a dictionary from each number of bits per channel that the image supports to the
+# number of bits of payload that fit inside it. Only the header of the image is read.
+# Returns None if the image cannot be opened.
+def imageCapacity(imgFilename):
+	info = readImageInfo(imgFilename)
+	if info == None:
+		return None
+	return {bitsPerChannel: capacityBits(info['channels'], bitsPerChannel) for bitsPerChannel in supportedBitsPerChannel(info)}
+
+# Returns the numbers of bits per channel supported by the image described by info, as
+# returned by readImageInfo: up to half the bits of each channel.
+def supportedBitsPerChannel(info):
+	if info['mode'] in PIXEL_LIST_MODES:
+		return range(1, 2)
+	return range(1, container.maxBitsPerChannel(info['bitDepth']) + 1)
+
+# Returns the number of channel values needed to hide a payload of payloadLength bytes
+# with bitsPerChannel bits per channel, header included.
+def channelsNeeded(payloadLength, bitsPerChannel=1):
+	return headerChannels(bitsPerChannel) + -(-payloadLength * 8 // bitsPerChannel)
+
+# Loads the index of the carriers inside the directory, updating the entries of the
+# images that were added, changed or removed since it was stored, and saves it back.
+# Only the headers of the new or changed images are read. The entries of the index are
+# sorted by number of channel values, and each one records the path of the image, its
+# modification time, its size in bytes, its width, height and mode, and its number of
+# channel values and bits per channel. Returns None if the directory cannot be read.
+def loadIndex(directory):
+	indexFilename = os.path.join(directory, INDEX_FILENAME)
+
+	# Read the stored entries by name, if there are any.
+	stored = {}
+	try:
+		with open(indexFilename, 'r') as indexFile:
+			index = json.load(indexFile)
+		if index.get('version') == INDEX_VERSION:
+			stored = {entry['path']: entry for entry in index['carriers']}
+	except (OSError, ValueError, KeyError, AttributeError):
+		pass
+
+	# Keep the entries whose image did not change, and read the header of the others.
+	entries = []
+	changed = False
+	try:
+		imgFilenames = carriers.listFiles(directory)
+	except OSError as exception:
+		utils.log(exception)
+		return None
+	for imgFilename in imgFilenames:
+		name = os.path.basename(imgFilename)
+		try:
+			stat = os.stat(imgFilename)
+		except OSError:
+			continue
+		entry = stored.get(name)
+		if entry == None or entry['mtime'] != stat.st_mtime or entry['fileSize'] != stat.st_size:
+			info = readImageInfo(imgFilename)
+			if info == None:
+				continue
+			entry = dict(info, path=name, mtime=stat.st_mtime, fileSize=stat.st_size)
+			changed = True
+		entries.append(entry)
+	entries.sort(key=lambda entry: (entry['channels'], entry['path']))
+	changed = changed or len(entries) != len(stored)
+
+	# Save the index back when something changed. The index is only a cache, so failing to
+	# save it is not an error.
+	if changed:
+		try:
+			with open(indexFilename, 'w') as indexFile:
+				json.dump({'version': INDEX_VERSION, 'carriers': entries}, indexFile)
+		except OSError as exception:
+			utils.log(exception)
+	return {'directory': directory, 'carriers': entries, 'channels': [entry['channels'] for entry in entries]}
+
+# Returns the filename of the smallest carrier of the index where a payload of payloadLength
+# bytes fits with bitsPerChannel bits per channel, or None if none is big enough.
+# The carrier is found with a binary search over the sorted entries.
+def smallestCarrier(index, payloadLength, bitsPerChannel=1):
+	position = bisect.bisect_left(index['channels'], channelsNeeded(payloadLength, bitsPerChannel))
+	while position < len(index['carriers']):
+		entry = index['carriers'][position]
+		if bitsPerChannel in supportedBitsPerChannel(entry):
+			return os.path.join(index['directory'], entry['path'])
+		position += 1
+	return None
@@ -0,0 +1,135 @@
+import hashlib
+import importlib.util
+import os
+import struct
+
+import container
+import utils
+
+# Ciphers that can encrypt the payload. The value of each one is recorded in the header,
+# so it must never change.
+CIPHER_CHACHA20_POLY1305 = 1
+
+# Parameters of scrypt, which derives the key from the passphrase: log2 of its cost, its
+# block size and its parallelization. They are recorded in the header with a random salt,
+# and the ones read from a header are only accepted up to the maximum cost.
+KDF_LOG2_COST = 15
+KDF_BLOCK_SIZE = 8
+KDF_PARALLELIZATION = 1
+KDF_MAX_LOG2_COST = 20
+KDF_MAX_BLOCK_SIZE = 16
+KDF_MAX_PARALLELIZATION = 4
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+# The payload is encrypted in records of RECORD_SIZE bytes of the message, each one followed
+# by its tag. The nonce of each record is a random prefix followed by the index of the record
+# (4 bytes) and a flag set only in the last one (1 byte), so that records cannot be
+# reordered, dropped or truncated without failing the tag.
+RECORD_SIZE = utils.CHUNK_SIZE
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+NONCE_FORMAT = '>{}sIB'.format(NONCE_PREFIX_SIZE)
+
+# Decides if the payload can be encrypted and decrypted, i.e., if the cryptography package is
+# installed. The package is only loaded to encrypt or decrypt (see newAead).
+def isAvailable():
+	return importlib.util.find_spec('cryptography') != None
+
+# Returns the AEAD that encrypts and decrypts the records with the key.
+def newAead(key):
+	from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+	return ChaCha20Poly1305(key)
+
+# Returns new parameters to encrypt a payload, with a random salt and nonce prefix.
+def newParameters():
+	return {
+		'cipher': CIPHER_CHACHA20_POLY1305,
+		'log2Cost': KDF_LOG2_COST,
+		'blockSize': KDF_BLOCK_SIZE,
+		'parallelization': KDF_PARALLELIZATION,
+		'salt': os.urandom(SALT_SIZE),
+		'noncePrefix': os.urandom(NONCE_PREFIX_SIZE),
+		'recordSize': RECORD_SIZE,
+	}
+
+# Decides if the parameters read from a header can be used to decrypt the payload.
+def isSupported(parameters):
+	return (parameters['cipher'] == CIPHER_CHACHA20_POLY1305 and 1 <= parameters['log2Cost'] <= KDF_MAX_LOG2_COST
+		and 1 <= parameters['blockSize'] <= KDF_MAX_BLOCK_SIZE and 1 <= parameters['parallelization'] <= KDF_MAX_PARALLELIZATION
+		and parameters['recordSize'] > 0)
+
+# Derives the key of the cipher from the passphrase (a string or bytes) with scrypt.
+def deriveKey(passphrase, parameters):
+	if isinstance(passphrase, str):
+		passphrase = passphrase.encode('utf-8')
+	cost = 1 << parameters['log2Cost']
+	memory = 128 * parameters['blockSize'] * (cost + parameters['parallelization'] + 2)
+	return hashlib.scrypt(passphrase, salt=parameters['salt'], n=cost, r=parameters['blockSize'], p=parameters['parallelization'], maxmem=memory + (1 << 20), dklen=KEY_SIZE)
+
+# Returns the length of the encrypted payload for a payload of the given length.
+def encryptedLength(length, recordSize=RECORD_SIZE):
+	return length + max(-(-length // recordSize), 1) * TAG_SIZE
+
+# Returns the length of the payload encrypted into a payload of the given length, the
+# inverse of encryptedLength.
+def decryptedLength(length, recordSize=RECORD_SIZE):
+	return length - max(-(-length // (recordSize + TAG_SIZE)), 1) * TAG_SIZE
+
+# Encrypts an iterable of chunks of any size with the passphrase and the parameters
+# returned by newParameters, yielding one encrypted record at a time.
+def encryptChunks(chunks, passphrase, parameters):
+	aead = newAead(deriveKey(passphrase, parameters))
+	associatedData = container.packCipher(parameters)
+	for index, record, last in records(chunks, parameters['recordSize']):
+		yield aead.encrypt(nonce(parameters, index, last), record, associatedData)
+
+# Decrypts an iterable of chunks of an encrypted payload with the passphrase and the
+# parameters recorded in its header, yielding the chunks of the payload as each record is
+# verified. Raises ValueError as soon as a record does not match its tag: with a wrong
+# passphrase, that is the first one.
+def decryptChunks(chunks, passphrase, parameters):
+	aead = newAead(deriveKey(passphrase, parameters))
+	associatedData = container.packCipher(parameters)
+	for index, record, last in records(chunks, parameters['recordSize'] + TAG_SIZE):
+		yield decryptRecord(aead, parameters, index, record, last, associatedData)
+
+# Decrypts the bytes [offset, offset + length) of an encrypted payload of payloadLength bytes,
+# read through readBytes(offset, numBytes). Each record has its own tag and nonce, so only the
+# records that hold those bytes are read and verified. Raises ValueError like decryptChunks.
+def decryptRange(readBytes, payloadLength, passphrase, parameters, offset, length):
+	aead = newAead(deriveKey(passphrase, parameters))
+	associatedData = container.packCipher(parameters)
+	recordSize = parameters['recordSize']
+	sealedSize = recordSize + TAG_SIZE
+	lastIndex = max(-(-payloadLength // sealedSize), 1) - 1
+	data = bytearray()
+	for index in range(offset // recordSize, min(-(-(offset + length) // recordSize), lastIndex + 1)):
+		record = readBytes(index * sealedSize, min(sealedSize, payloadLength - index * sealedSize))
+		data += decryptRecord(aead, parameters, index, record, index == lastIndex, associatedData)
+	start = offset % recordSize
+	return bytes(data[start : start + length])
+
+# Decrypts and verifies a record. Raises ValueError if it does not match its tag.
+def decryptRecord(aead, parameters, index, record, last, associatedData):
+	from cryptography.exceptions import InvalidTag
+	try:
+		return aead.decrypt(nonce(parameters, index, last), record, associatedData)
+	except InvalidTag:
+		raise ValueError('the message could not be decrypted: the passphrase is wrong or the message is corrupted')
+
+# Regroups the chunks into records of recordSize bytes, and yields the index of each one,
+# the record and whether it is the last one. There is always at least one record.
+def records(chunks, recordSize):
+	index = 0
+	previous = None
+	for record in utils.rechunk(chunks, recordSize):
+		if previous != None:
+			yield index, previous, False
+			index += 1
+		previous = record
+	yield index, previous or b'', True
+
+# Returns the nonce of a record.
+def nonce(parameters, index, last):
+	return struct.pack(NONCE_FORMAT, parameters['noncePrefix'], index, 1 if last else 0)
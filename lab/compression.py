@@ -0,0 +1,128 @@
+import bz2
+import lzma
+import zlib
+
+import utils
+
+# Codecs that can compress the message before it is hidden. The value of each one
+# is recorded in the header, so it must never change.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+
+# Names of the codecs, as accepted by the command line and the web application.
+CODEC_NAMES = {
+	'none': CODEC_NONE,
+	'zlib': CODEC_ZLIB,
+	'lzma': CODEC_LZMA,
+	'bz2': CODEC_BZ2,
+}
+
+# Name of the option that tries every codec on a sample of the message and keeps the best one.
+AUTO = 'auto'
+
+# Compression is skipped when the best codec does not shrink the sample below this ratio.
+MIN_RATIO = 0.9
+
+# Errors raised by the decompressors when the data is not valid (bz2 raises OSError).
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+
+# Returns the codec with the given name, trying every codec on the sample when
+# the name is AUTO. Returns None if the name is not known.
+def selectCodec(name, sample):
+	if name == AUTO:
+		return chooseCodec(sample)
+	return CODEC_NAMES.get(name)
+
+# Returns the name of the codec, as in CODEC_NAMES.
+def codecName(codec):
+	for name, value in CODEC_NAMES.items():
+		if value == codec:
+			return name
+	return None
+
+# Compresses the sample with every codec and returns the one that gives the smallest
+# output. If none of them reaches MIN_RATIO, compressing is not worth it.
+def chooseCodec(sample):
+	bestCodec = CODEC_NONE
+	bestLength = len(sample) * MIN_RATIO
+	for codec in [CODEC_ZLIB, CODEC_LZMA, CODEC_BZ2]:
+		length = sum(len(chunk) for chunk in compressChunks([sample], codec))
+		if length < bestLength:
+			bestCodec = codec
+			bestLength = length
+	return bestCodec
+
+# Creates a compressor object for the codec.
+def newCompressor(codec):
+	if codec == CODEC_ZLIB:
+		return zlib.compressobj(9)
+	elif codec == CODEC_LZMA:
+		return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+	elif codec == CODEC_BZ2:
+		return bz2.BZ2Compressor(9)
+	return None
+
+# Creates a decompressor object for the codec.
+def newDecompressor(codec):
+	if codec == CODEC_ZLIB:
+		return zlib.decompressobj()
+	elif codec == CODEC_LZMA:
+		return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+	elif codec == CODEC_BZ2:
+		return bz2.BZ2Decompressor()
+	return None
+
+# Compresses an iterable of chunks with the codec, yielding the compressed chunks
+# as they are produced. With CODEC_NONE the chunks are yielded untouched.
+def compressChunks(chunks, codec):
+	if codec == CODEC_NONE:
+		yield from chunks
+		return
+	compressor = newCompressor(codec)
+	for chunk in chunks:
+		output = compressor.compress(chunk)
+		if output:
+			yield output
+	yield compressor.flush()
+
+# Decompresses an iterable of chunks with the codec, yielding decompressed chunks of
+# at most utils.CHUNK_SIZE bytes, so that memory is bounded whatever the compression
+# ratio. Raises ValueError if the compressed data is not valid or is truncated.
+def decompressChunks(chunks, codec):
+	if codec == CODEC_NONE:
+		yield from chunks
+		return
+	decompressor = newDecompressor(codec)
+	try:
+		for chunk in chunks:
+			yield from drainDecompressor(decompressor, chunk)
+	except DECOMPRESSION_ERRORS as exception:
+		raise ValueError('the compressed message is not valid: {}'.format(exception))
+	if not decompressor.eof:
+		raise ValueError('the compressed message is truncated')
+
+# Feeds data to the decompressor and yields its output in bounded chunks.
+def drainDecompressor(decompressor, data):
+
+	# zlib keeps the input it could not process in unconsumed_tail. A full output
+	# chunk may leave more output pending even when all the input was consumed.
+	if hasattr(decompressor, 'unconsumed_tail'):
+		while not decompressor.eof:
+			output = decompressor.decompress(data, utils.CHUNK_SIZE)
+			data = decompressor.unconsumed_tail
+			if output:
+				yield output
+			if not data and len(output) < utils.CHUNK_SIZE:
+				return
+		return
+
+	# lzma and bz2 keep it internally, and tell when they need more.
+	output = decompressor.decompress(data, utils.CHUNK_SIZE)
+	if output:
+		yield output
+	while not decompressor.eof and not decompressor.needs_input:
+		output = decompressor.decompress(b'', utils.CHUNK_SIZE)
+		if output:
+			yield output
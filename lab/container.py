@@ -0,0 +1,191 @@
+import struct
+import zlib
+
+# Every message starts with a fixed size header that describes the payload after it:
+#	magic (4 bytes), version (1 byte), flags (1 byte), length of the extensions (2 bytes),
+#	length of the payload in bytes (8 bytes) and CRC-32 checksum of the payload (4 bytes).
+# The header is followed by the extensions, a list of optional (type, length, value)
+# records, and then by the payload itself. All integers are big endian.
+HEADER_MAGIC = b'\x89LSB'
+HEADER_VERSION = 1
+HEADER_FORMAT = '>4sBBHQI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Each extension record starts with its type (1 byte) and the length of its value (2 bytes).
+EXTENSION_FORMAT = '>BH'
+EXTENSION_SIZE = struct.calcsize(EXTENSION_FORMAT)
+
+# Types of the extensions known by this version of the format.
+EXTENSION_BITS_PER_CHANNEL = 1 # Number of least significant bits of each channel that hold the payload (1 byte).
+EXTENSION_CODEC = 2 # Codec that compressed the payload before it was hidden (1 byte, see compression.py).
+EXTENSION_SHARD = 3 # Position of the payload inside a message split across several images (see SHARD_FORMAT).
+EXTENSION_CIPHER = 4 # Cipher that encrypted the payload and parameters of its key derivation (see CIPHER_FORMAT).
+EXTENSION_ERROR_CORRECTION = 5 # Error correcting code that protects the payload (see ERROR_CORRECTION_FORMAT).
+
+# A shard records the ID of the transfer (16 bytes), its index and the number of shards
+# of the transfer (4 bytes each), and the offset of its payload inside the whole payload (8 bytes).
+SHARD_FORMAT = '>16sIIQ'
+
+# An encrypted payload records its cipher (1 byte, see cipher.py), the log2 of the cost,
+# block size and parallelization of scrypt (1 byte each), the salt of scrypt (16 bytes),
+# the prefix of the nonces (7 bytes) and the size of the records of the payload (4 bytes).
+CIPHER_FORMAT = '>BBBB16s7sI'
+CIPHER_FIELDS = ['cipher', 'log2Cost', 'blockSize', 'parallelization', 'salt', 'noncePrefix', 'recordSize']
+
+# A payload protected by an error correcting code records the number of parity bytes of each
+# codeword (1 byte) and the number of codewords interleaved together (2 bytes, see fec.py).
+ERROR_CORRECTION_FORMAT = '>BH'
+ERROR_CORRECTION_FIELDS = ['parity', 'depth']
+
+# The header is always hidden in one bit per channel, so that it can be found before
+# knowing the layout of the payload. The payload may use up to this many bits per channel,
+# and never more than half of the bits of each channel (see maxBitsPerChannel).
+MAX_BITS_PER_CHANNEL = 8
+
+# Flags of the header. With FLAG_ERROR_CORRECTION, the header and its extensions are
+# hidden inside a codeword of an error correcting code, and the payload starts after it.
+# The length and checksum of the header are the ones of the payload before it was protected.
+FLAG_ERROR_CORRECTION = 1
+
+# Flags known by this version of the format. A header with any other flag is rejected.
+KNOWN_FLAGS = FLAG_ERROR_CORRECTION
+
+# Returns the checksum of the payload stored in the header. The checksum
+# can be computed in chunks by passing the previous result.
+def checksum(payload, previous=0):
+	return zlib.crc32(payload, previous)
+
+# Yields the chunks of a payload while computing their checksum, and raises
+# ValueError after the last one if it does not match the expected checksum.
+# No check is done if the expected checksum is None.
+def verifyChunks(chunks, expectedChecksum):
+	payloadChecksum = 0
+	for chunk in chunks:
+		payloadChecksum = checksum(chunk, payloadChecksum)
+		yield chunk
+	if expectedChecksum != None and payloadChecksum != expectedChecksum:
+		raise ValueError('the checksum of the message does not match')
+
+# Builds the bytes of the header for a payload of the given length and checksum.
+# The extensions are given as a dictionary from extension type to its value.
+def packHeader(payloadLength, payloadChecksum, flags=0, extensions={}):
+	extensionBytes = packExtensions(extensions)
+	header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, HEADER_VERSION, flags, len(extensionBytes), payloadLength, payloadChecksum)
+	return header + extensionBytes
+
+# Parses the fixed part of the header. Returns a dictionary with its fields,
+# or None if the bytes provided do not hold a header this version can read.
+def unpackHeader(data):
+	if len(data) < HEADER_SIZE:
+		return None
+	magic, version, flags, extensionsLength, payloadLength, payloadChecksum = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+	if magic != HEADER_MAGIC or version > HEADER_VERSION or flags & ~KNOWN_FLAGS:
+		return None
+	return {
+		'version': version,
+		'flags': flags,
+		'extensionsLength': extensionsLength,
+		'payloadLength': payloadLength,
+		'checksum': payloadChecksum,
+	}
+
+# Serializes a dictionary of extensions into (type, length, value) records.
+def packExtensions(extensions):
+	return b''.join(struct.pack(EXTENSION_FORMAT, extensionType, len(value)) + value for extensionType, value in sorted(extensions.items()))
+
+# Parses the (type, length, value) records of the extensions into a dictionary.
+# Returns None if the records are truncated.
+def unpackExtensions(data):
+	extensions = {}
+	offset = 0
+	while offset < len(data):
+		if offset + EXTENSION_SIZE > len(data):
+			return None
+		extensionType, length = struct.unpack(EXTENSION_FORMAT, data[offset:offset + EXTENSION_SIZE])
+		offset += EXTENSION_SIZE
+		if offset + length > len(data):
+			return None
+		extensions[extensionType] = data[offset:offset + length]
+		offset += length
+	return extensions
+
+# Decides if the bytes provided start with a header of this format.
+def isContainer(data):
+	return data[:len(HEADER_MAGIC)] == HEADER_MAGIC
+
+# Returns the number of bits per channel that a payload may use in channels of bitDepth
+# bits: half of them, so 4 in 8-bit images and 8 in 16-bit images.
+def maxBitsPerChannel(bitDepth):
+	return max(min(bitDepth // 2, MAX_BITS_PER_CHANNEL), 1)
+
+# Returns the extensions that describe a payload hidden with the given number of
+# bits per channel. The default of one bit per channel needs no extension.
+def layoutExtensions(bitsPerChannel):
+	if bitsPerChannel == 1:
+		return {}
+	return {EXTENSION_BITS_PER_CHANNEL: bytes([bitsPerChannel])}
+
+# Returns the number of bits per channel of the payload recorded in the extensions,
+# or None if the recorded value is not valid.
+def bitsPerChannel(extensions):
+	value = extensions.get(EXTENSION_BITS_PER_CHANNEL, b'\x01')
+	if len(value) != 1 or not 1 <= value[0] <= MAX_BITS_PER_CHANNEL:
+		return None
+	return value[0]
+
+# Returns the extensions that record the codec that compressed the payload.
+# An uncompressed payload needs no extension.
+def codecExtensions(codec):
+	if codec == 0:
+		return {}
+	return {EXTENSION_CODEC: bytes([codec])}
+
+# Returns the codec recorded in the extensions, or None if the recorded value is not valid.
+def codec(extensions):
+	value = extensions.get(EXTENSION_CODEC, b'\x00')
+	if len(value) != 1:
+		return None
+	return value[0]
+
+# Returns the extensions that record the position of a shard inside a transfer.
+def shardExtensions(transferId, index, count, offset):
+	return {EXTENSION_SHARD: struct.pack(SHARD_FORMAT, transferId, index, count, offset)}
+
+# Returns a dictionary with the shard recorded in the extensions, or None if there is
+# no shard or the recorded value is not valid.
+def shard(extensions):
+	value = extensions.get(EXTENSION_SHARD)
+	if value == None or len(value) != struct.calcsize(SHARD_FORMAT):
+		return None
+	transferId, index, count, offset = struct.unpack(SHARD_FORMAT, value)
+	if index >= count:
+		return None
+	return {'transferId': transferId, 'index': index, 'count': count, 'offset': offset}
+
+# Packs the parameters of the cipher of a payload.
+def packCipher(parameters):
+	return struct.pack(CIPHER_FORMAT, *[parameters[field] for field in CIPHER_FIELDS])
+
+# Returns the extensions that record the cipher of a payload and its parameters.
+def cipherExtensions(parameters):
+	return {EXTENSION_CIPHER: packCipher(parameters)}
+
+# Returns a dictionary with the parameters of the cipher recorded in the extensions, or None
+# if the payload is not encrypted or the recorded value is not valid.
+def cipher(extensions):
+	value = extensions.get(EXTENSION_CIPHER)
+	if value == None or len(value) != struct.calcsize(CIPHER_FORMAT):
+		return None
+	return dict(zip(CIPHER_FIELDS, struct.unpack(CIPHER_FORMAT, value)))
+
+# Returns the extensions that record the error correcting code of a payload.
+def errorCorrectionExtensions(parity, depth):
+	return {EXTENSION_ERROR_CORRECTION: struct.pack(ERROR_CORRECTION_FORMAT, parity, depth)}
+
+# Returns a dictionary with the parameters of the error correcting code recorded in the
+# extensions, or None if the payload is not protected or the recorded value is not valid.
+def errorCorrection(extensions):
+	value = extensions.get(EXTENSION_ERROR_CORRECTION)
+	if value == None or len(value) != struct.calcsize(ERROR_CORRECTION_FORMAT):
+		return None
+	return dict(zip(ERROR_CORRECTION_FIELDS, struct.unpack(ERROR_CORRECTION_FORMAT, value)))
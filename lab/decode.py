@@ -1,53 +1,505 @@
+import os
+
+import carriers
+import cipher
+import compression
+import container
+import fec
+import instrument
+import scatter
 import utils
 
+numpy = utils.lazyImport('numpy')
+
+# Number of bytes extracted at a time while looking for the end token of legacy images.
+SCAN_CHUNK_BYTES = 4096
+
+# Size in bytes of the first strip of rows decoded to read a range of the message (see RowChannels).
+ROW_STRIP_BYTES = 1 << 20
+
 # Opens the image provided at imgFilename and looks for a hidden message inside
 # the Least Significant Bits of each pixel value. If a properly formatted secret message 
-# is found, it is written to msgFilename.
-def decodeAlgorithm(imgFilename, msgFilename):
+# is found, it is written to msgFilename. Both of them can also be given as binary file objects.
+# The image can also be a WAV sound, or any other carrier of carriers.py.
+# A message scattered with a key is only found with the same key, and an encrypted message
+# is only decrypted with the same passphrase. The wrong bits of a message protected by an
+# error correcting code are corrected, and if stats is a dictionary, their number is stored
+# in it as 'correctedBits'.
+@instrument.spanned('decode')
+def decodeAlgorithm(imgFilename, msgFilename, key=None, passphrase=None, stats=None):
 
 	# Open the image.
-	image = utils.openImage(imgFilename)
-	if image == None:
+	with instrument.span('decode.open'):
+		carrier = carriers.openCarrier(imgFilename)
+	if carrier == None:
 		utils.log('ERROR: could not open the image')
 		return utils.ERROR_OPEN
 	else:
 		utils.log('Image opened correctly')
 
-	# Extract the pixels inside the image.
-	pixels = utils.extractPixelsFromImage(image)
-	if pixels == None:
+	# Extract the channel values inside the image.
+	with instrument.span('decode.extract'):
+		array = carriers.readSamples(carrier)
+	if array is None:
 		utils.log('ERROR: could not extract pixels from image')
 		return utils.ERROR_EXTRACT_PIXELS
 	else:
 		utils.log('Pixels extracted from image')
-	
-	# Extract the binary data in the LSBs of the provided pixels.
-	binaryString = extractBinaryMessageFromPixels(pixels)
-	if binaryString == None:
-		utils.log('ERROR: could not extract the LSBs of the pixels inside the image')
-		return utils.ERROR_EXTRACT_MSG
-	else:
-		utils.log('Extracted the LSBs of all the pixels inside the image')
 
-	# Get the string of the secret message, if there is one.
-	secretMessage = extractSecretMessage(binaryString)
+	# Find the secret message, if there is one. Images whose values are not
+	# integers are decoded through the list of pixels.
+	with instrument.span('decode.key'):
+		order = scatter.keyedOrder(key, array.size)
+	with instrument.span('decode.find'):
+		if not utils.isArrayEmbeddable(array):
+			secretMessage = decodeWithPixelList(carrier['image'], order)
+		else:
+			secretMessage = findSecretMessageInArray(array, order)
 	if secretMessage == None:
 		utils.log('ERROR: no secret message was found inside the image')
 		return utils.ERROR_EXTRACT_MSG
 	else:
-		utils.log('Secret message found inside the image:')
-		utils.log('{}'.format(secretMessage))
+		utils.log('Secret message found inside the image')
+
+	# An encrypted message needs the passphrase, which is checked before reading the payload.
+	if not canDecrypt(secretMessage, passphrase):
+		return utils.ERROR_EXTRACT_MSG
 	
-	# Finally, store the secret message inside the requested file.
-	if utils.writeStringToFile(secretMessage, msgFilename) != 0:
-		utils.log('ERROR: could not write secret message to file {}'.format(msgFilename))
-		return utils.ERROR_SAVE_MSG
+	# Finally, store the secret message inside the requested file as it is extracted.
+	with instrument.span('decode.write'):
+		error = writeSecretMessage(secretMessage, msgFilename, passphrase)
+	if error != utils.ERROR_OK:
+		utils.log('ERROR: could not write secret message to file {}', msgFilename)
+		return error
 	else:
 		utils.log('Secret message written to file')
+
+	# Report the bits corrected by the error correcting code, if the message has one.
+	if secretMessage['corrections'] != None:
+		utils.log('{} wrong bits of the message were corrected', secretMessage['corrections']['bits'])
+		if stats != None:
+			stats['correctedBits'] = secretMessage['corrections']['bits']
 	
 	return utils.ERROR_OK
 
 
+# Opens the image provided at imgFilename and reads the bytes [offset, offset + length) of
+# the hidden message, cut at its end, into msgFilename. Both of them can also be given as
+# binary file objects. A message hidden without a key lies in sequence from the first channel
+# on, so only the rows of the image up to the last one holding those bytes are decoded when
+# the format allows it (see RowChannels); a message scattered with a key is read from the
+# whole image. See readMessageRange for the payloads that are read straight at the range.
+# If stats is a dictionary, the length of the whole message is stored in it as 'length'
+# (None if it is not known without restoring it all), and the bits corrected by the error
+# correcting code so far as 'correctedBits'. Returns an error code, like decodeAlgorithm.
+@instrument.spanned('decode.range')
+def decodeRangeAlgorithm(imgFilename, msgFilename, offset, length, key=None, passphrase=None, stats=None):
+
+	if offset < 0 or length < 0:
+		utils.log('ERROR: the range of the message is not valid')
+		return utils.ERROR_OPTIONS
+
+	# Open the image.
+	with instrument.span('decode.open'):
+		carrier = carriers.openCarrier(imgFilename)
+	if carrier == None:
+		utils.log('ERROR: could not open the image')
+		return utils.ERROR_OPEN
+
+	# Find the secret message, decoding the rows of the image as they are read when it can.
+	# Invalid data raises ValueError.
+	try:
+		with instrument.span('decode.find'):
+			if key == None and carrier['image'] != None and utils.isRowDecodable(carrier['image']):
+				secretMessage = findSecretMessage(RowChannels(imgFilename, carrier['image']))
+			else:
+				array = carriers.readSamples(carrier)
+				if array is None:
+					utils.log('ERROR: could not extract pixels from image')
+					return utils.ERROR_EXTRACT_PIXELS
+				order = scatter.keyedOrder(key, array.size)
+				if not utils.isArrayEmbeddable(array):
+					secretMessage = decodeWithPixelList(carrier['image'], order)
+				else:
+					secretMessage = findSecretMessageInArray(array, order)
+			if secretMessage == None:
+				utils.log('ERROR: no secret message was found inside the image')
+				return utils.ERROR_EXTRACT_MSG
+			if not canDecrypt(secretMessage, passphrase):
+				return utils.ERROR_EXTRACT_MSG
+
+		# Read the range of the message.
+		with instrument.span('decode.read'):
+			data, total = readMessageRange(secretMessage, offset, length, passphrase)
+	except ValueError as exception:
+		utils.log('ERROR: {}'.format(exception))
+		return utils.ERROR_EXTRACT_MSG
+
+	# Store the bytes inside the requested file.
+	messageFile = utils.openBinaryFile(msgFilename, 'wb')
+	if messageFile == None:
+		return utils.ERROR_SAVE_MSG
+	try:
+		messageFile.write(data)
+	except Exception as exception:
+		utils.log(exception)
+		return utils.ERROR_SAVE_MSG
+	finally:
+		utils.closeBinaryFile(messageFile, msgFilename)
+	utils.log('{} bytes of the secret message written to file, from byte {}', len(data), offset)
+
+	if stats != None:
+		stats['length'] = total
+		if secretMessage['corrections'] != None:
+			stats['correctedBits'] = secretMessage['corrections']['bits']
+	return utils.ERROR_OK
+
+
+# Decides if the secret message can be decrypted: an encrypted message needs the passphrase
+# and the cryptography package. Logs why it cannot.
+def canDecrypt(secretMessage, passphrase):
+	if secretMessage['cipher'] != None and passphrase == None:
+		utils.log('ERROR: the message is encrypted, please provide its passphrase')
+		return False
+	if secretMessage['cipher'] != None and not cipher.isAvailable():
+		utils.log('ERROR: the cryptography package is needed to decrypt the message')
+		return False
+	return True
+
+
+# Returns the bytes [offset, offset + length) of the original message, cut at its end, along
+# with the length of the whole message, or None if it is not known without restoring it all.
+# A payload that is neither compressed nor protected by an error correcting code is read
+# straight at the range: if it is encrypted, through the records that hold the range, which
+# are verified against their tags. Other payloads are restored from their beginning up to the
+# end of the range. The checksum covers the whole payload, so it is only verified when the
+# range reaches the end of a restored payload. Raises ValueError when the payload is not valid.
+def readMessageRange(secretMessage, offset, length, passphrase=None):
+	if secretMessage['codec'] != compression.CODEC_NONE or secretMessage['read'] == None:
+		return sliceChunks(restoreMessage(secretMessage, passphrase), offset, length), None
+
+	total = secretMessage['length']
+	if secretMessage['cipher'] != None:
+		total = cipher.decryptedLength(total, secretMessage['cipher']['recordSize'])
+	length = min(length, total - offset)
+	if length <= 0:
+		return b'', total
+	if secretMessage['cipher'] == None:
+		return secretMessage['read'](offset, length), total
+	return cipher.decryptRange(secretMessage['read'], secretMessage['length'], passphrase, secretMessage['cipher'], offset, length), total
+
+
+# Returns the bytes [offset, offset + length) of the data in the chunks, which are only read
+# up to the end of that range.
+def sliceChunks(chunks, offset, length):
+	data = bytearray()
+	position = 0
+	for chunk in chunks:
+		if position >= offset + length:
+			break
+		if position + len(chunk) > offset:
+			data += chunk[max(offset - position, 0) :]
+		position += len(chunk)
+	return bytes(data[:length])
+
+
+# Writes the chunks of the secret message into msgFilename in binary mode as they
+# are extracted, and verifies the checksum of the message when it has one. An encrypted
+# message is decrypted with the passphrase. If the message is not valid, the partially
+# written file is removed.
+def writeSecretMessage(secretMessage, msgFilename, passphrase=None):
+	messageFile = utils.openBinaryFile(msgFilename, 'wb')
+	if messageFile == None:
+		return utils.ERROR_SAVE_MSG
+
+	# Write the chunks as they are restored. Invalid data raises ValueError.
+	error = utils.ERROR_OK
+	try:
+		for chunk in restoreMessage(secretMessage, passphrase):
+			messageFile.write(chunk)
+	except ValueError as exception:
+		utils.log('ERROR: {}'.format(exception))
+		error = utils.ERROR_EXTRACT_MSG
+	except Exception as exception:
+		utils.log(exception)
+		error = utils.ERROR_SAVE_MSG
+	finally:
+		utils.closeBinaryFile(messageFile, msgFilename)
+
+	# A message written into a file object is left to its owner.
+	if utils.isFileObject(msgFilename):
+		return error
+
+	# Do not leave a broken message behind.
+	if error != utils.ERROR_OK:
+		try:
+			os.remove(msgFilename)
+		except OSError:
+			pass
+	return error
+
+
+# Decodes the secret message through the list of pixels of the image.
+# This is the slow path, only used for images whose values are not integers.
+def decodeWithPixelList(image, order=None):
+
+	# Extract the pixels inside the image.
+	pixels = utils.extractPixelsFromImage(image)
+	if pixels == None:
+		utils.log('ERROR: could not extract pixels from image')
+		return None
+
+	# Extract the binary data in the LSBs of the provided pixels.
+	binaryString = extractBinaryMessageFromPixels(pixels)
+	if binaryString == None:
+		utils.log('ERROR: could not extract the LSBs of the pixels inside the image')
+		return None
+
+	# Find the message in those bits, one per element, as if they were channel values.
+	bits = numpy.frombuffer(binaryString.encode('ascii'), dtype=numpy.uint8) - ord('0')
+	return findSecretMessage(bits, order)
+
+
+# Looks for a secret message inside the least significant bits of the array of
+# channel values, taken in sequence or in the given order (see scatter.py).
+# Only the channels holding the message are read.
+def findSecretMessageInArray(array, order=None):
+
+	# Work on a flat view of the array, with one channel value per element.
+	return findSecretMessage(array.reshape(-1), order)
+
+
+# Extracts the whole secret message hidden inside the array of channel values and
+# returns it as bytes, or None if there is no valid message.
+def extractSecretMessageFromArray(array):
+	secretMessage = findSecretMessageInArray(array)
+	if secretMessage == None:
+		return None
+	try:
+		return b''.join(restoreMessage(secretMessage))
+	except ValueError as exception:
+		utils.log('ERROR: {}'.format(exception))
+		return None
+
+
+# Yields the chunks of the original message out of the chunks of the hidden payload:
+# they are verified against the checksum, decrypted with the passphrase if the payload
+# is encrypted, and then decompressed. Raises ValueError when the payload is not valid,
+# as soon as an encrypted record does not match its tag.
+def restoreMessage(secretMessage, passphrase=None):
+	chunks = container.verifyChunks(secretMessage['chunks'], secretMessage['checksum'])
+	if secretMessage.get('cipher') != None:
+		chunks = cipher.decryptChunks(chunks, passphrase, secretMessage['cipher'])
+	return compression.decompressChunks(chunks, secretMessage['codec'])
+
+
+# Receives the flat array of channel values and returns the bytes [byteOffset, byteOffset + numBytes)
+# of the data hidden in the bitsPerChannel least significant bits of the channels starting at channelOffset,
+# taken in sequence or in the given order. Only the channels holding those bytes are read.
+def extractBytesFromArray(channels, byteOffset, numBytes, channelOffset=0, bitsPerChannel=1, order=None):
+
+	# Find the channels that hold the requested bits.
+	firstBit = byteOffset * 8
+	lastBit = (byteOffset + numBytes) * 8
+	firstChannel = firstBit // bitsPerChannel
+	lastChannel = -(-lastBit // bitsPerChannel)
+	if order == None:
+		values = channels[channelOffset + firstChannel : channelOffset + lastChannel]
+	else:
+		values = channels[scatter.channelIndices(order, channelOffset + firstChannel, channelOffset + lastChannel)]
+	values = values & ((1 << bitsPerChannel) - 1)
+
+	# Unpack the bits stored in each channel, most significant first, and pack the requested ones into bytes.
+	bits = values.astype(numpy.uint8)
+	if bitsPerChannel > 1:
+		bits = numpy.unpackbits(bits[:, None], axis=1)[:, 8 - bitsPerChannel:].reshape(-1)
+		bits = bits[firstBit - firstChannel * bitsPerChannel : lastBit - firstChannel * bitsPerChannel]
+	return numpy.packbits(bits).tobytes()
+
+
+# Finds the secret message hidden inside the flat array of channel values, taken in
+# sequence or in the given order.
+# The beginning of the hidden data decides the format: a container header, a container
+# header protected by an error correcting code, or the format token of the images encoded
+# before the header existed.
+# Returns a dictionary with an iterator over the chunks of the message, which are
+# only extracted while iterating, and the checksum they must match (None if unknown).
+# Unless the payload is protected by an error correcting code, it also holds a function
+# that reads any range of the payload, read(offset, length).
+def findSecretMessage(channels, order=None):
+	numBytes = len(channels) // 8
+	start = extractBytesFromArray(channels, 0, min(container.HEADER_SIZE, numBytes), order=order)
+
+	# A protected header is looked for unless the beginning is a header without error
+	# correction, since its wrong bits may hide the magic or the flags.
+	header = container.unpackHeader(start)
+	if (header == None or header['flags'] & container.FLAG_ERROR_CORRECTION) and numBytes >= fec.CODEWORD_SIZE:
+		block = fec.decodeHeader(extractBytesFromArray(channels, 0, fec.CODEWORD_SIZE, order=order))
+		protectedHeader = None if block == None else container.unpackHeader(block[0])
+		if protectedHeader != None and protectedHeader['flags'] & container.FLAG_ERROR_CORRECTION:
+			return findContainerPayload(channels, block[0], order, block[1])
+
+	if container.isContainer(start):
+		return findContainerPayload(channels, start, order)
+	elif start[0:len(utils.FORMAT_TOKEN)] == utils.FORMAT_TOKEN.encode('utf-8'):
+		utils.log('Legacy {} token found, looking for the end of the message', utils.FORMAT_TOKEN)
+		payload = extractTokenPayload(lambda offset, length: extractBytesFromArray(channels, offset, length, order=order), numBytes)
+		if payload == None:
+			return None
+		return {'chunks': iter([payload]), 'read': lambda offset, length: payload[offset : offset + length], 'length': len(payload),
+			'checksum': None, 'codec': compression.CODEC_NONE, 'cipher': None, 'corrections': None, 'extensions': {}}
+	else:
+		utils.log('ERROR: the binary stream does not start with a header or the expected {} token'.format(utils.FORMAT_TOKEN))
+		return None
+
+
+# Parses the container header found at the beginning of the hidden data and
+# describes exactly the payload it declares. A header protected by an error correcting
+# code is given whole, with its extensions, along with the number of bits corrected in it.
+def findContainerPayload(channels, start, order=None, correctedBits=None):
+	header = container.unpackHeader(start)
+	if header == None:
+		utils.log('ERROR: the header of the message is not valid or its version is not supported')
+		return None
+	protected = header['flags'] & container.FLAG_ERROR_CORRECTION != 0
+	if protected and correctedBits == None:
+		utils.log('ERROR: the header of the message has more errors than the error correcting code can correct')
+		return None
+
+	# Read the extensions, which describe how the payload is hidden. A protected header
+	# already holds them, and the payload starts after its codeword.
+	extensionsEnd = container.HEADER_SIZE + header['extensionsLength']
+	extensions = None
+	if protected:
+		payloadChannel = fec.CODEWORD_SIZE * 8
+		if extensionsEnd <= len(start):
+			extensions = container.unpackExtensions(start[container.HEADER_SIZE : extensionsEnd])
+	else:
+		payloadChannel = extensionsEnd * 8
+		if payloadChannel <= len(channels):
+			extensions = container.unpackExtensions(extractBytesFromArray(channels, container.HEADER_SIZE, header['extensionsLength'], order=order))
+	if extensions == None or container.bitsPerChannel(extensions) == None or container.codec(extensions) not in compression.CODEC_NAMES.values():
+		utils.log('ERROR: the header extensions are not valid')
+		return None
+	parameters = container.cipher(extensions)
+	if container.EXTENSION_CIPHER in extensions and (parameters == None or not cipher.isSupported(parameters)):
+		utils.log('ERROR: the cipher of the message is not valid or not supported')
+		return None
+	errorCorrection = container.errorCorrection(extensions)
+	if protected != (container.EXTENSION_ERROR_CORRECTION in extensions) or (protected and (errorCorrection == None
+			or not 0 < errorCorrection['parity'] < fec.CODEWORD_SIZE or errorCorrection['depth'] == 0)):
+		utils.log('ERROR: the error correcting code of the message is not valid or not supported')
+		return None
+	bitsPerChannel = container.bitsPerChannel(extensions)
+
+	# Check that the declared payload fits inside the image before reading it. A protected
+	# payload holds the parity bytes of its codewords as well.
+	hiddenLength = header['payloadLength']
+	if protected:
+		hiddenLength = fec.encodedLength(hiddenLength, errorCorrection['parity'])
+	if hiddenLength * 8 > (len(channels) - payloadChannel) * bitsPerChannel:
+		utils.log('ERROR: the header declares a message longer than the image')
+		return None
+
+	# The chunks of a protected payload are corrected as they are read.
+	readBytes = lambda offset, length: extractBytesFromArray(channels, offset, length, payloadChannel, bitsPerChannel, order)
+	chunks = readChunks(readBytes, hiddenLength)
+	corrections = None
+	if protected:
+		readBytes = None
+		corrections = {'bits': correctedBits}
+		chunks = fec.decodeChunks(chunks, header['payloadLength'], errorCorrection['parity'], errorCorrection['depth'], corrections)
+
+	return {
+		'chunks': chunks,
+		'read': readBytes,
+		'length': header['payloadLength'],
+		'checksum': header['checksum'],
+		'codec': container.codec(extensions),
+		'cipher': parameters,
+		'corrections': corrections,
+		'extensions': extensions,
+	}
+
+
+# The flat channel values of a row decodable image (see utils.isRowDecodable), whose rows
+# are only decoded when their channels are read, in strips. Rows are decoded in order from
+# the first one, so reading the beginning of the image costs the rows read and not the whole
+# image. Strips double in size as they are read, so that reading all the rows in sequence
+# decodes the image a few times at most. Only slices in sequence can be read, which is all
+# that a message hidden without a key needs. Raises ValueError if the rows cannot be decoded.
+class RowChannels:
+
+	def __init__(self, imgFilename, image):
+		self.imgFilename = imgFilename
+		self.image = image
+		self.stride = image.size[0] * len(image.getbands())
+		self.numRows = image.size[1]
+		self.top = 0
+		self.values = None
+		self.stripRows = max(ROW_STRIP_BYTES // self.stride, 1)
+
+	def __len__(self):
+		return self.stride * self.numRows
+
+	def __getitem__(self, key):
+		start, stop, step = key.indices(len(self))
+		stop = max(start, stop)
+		firstRow = start // self.stride
+		lastRow = -(-stop // self.stride)
+		if self.values is None or firstRow < self.top or lastRow * self.stride > self.top * self.stride + len(self.values):
+			self.decodeRows(firstRow, lastRow)
+		return self.values[start - self.top * self.stride : stop - self.top * self.stride]
+
+	# Decodes a strip of rows that starts at firstRow and holds lastRow.
+	def decodeRows(self, firstRow, lastRow):
+
+		# Each decode needs the image again, since PIL only decodes it once.
+		if self.image == None:
+			if utils.isFileObject(self.imgFilename):
+				self.imgFilename.seek(0)
+			self.image = utils.openImage(self.imgFilename)
+		bottom = min(max(lastRow, firstRow + self.stripRows), self.numRows)
+		array = None if self.image == None else utils.extractRowsFromImage(self.image, firstRow, bottom)
+		self.image = None
+		if array is None:
+			raise ValueError('the rows of the image could not be decoded')
+		self.top = firstRow
+		self.values = array.reshape(-1)
+		self.stripRows *= 2
+
+
+# Reads length bytes through readBytes(offset, numBytes), in chunks.
+def readChunks(readBytes, length):
+	offset = 0
+	while offset < length:
+		chunkSize = min(utils.CHUNK_SIZE, length - offset)
+		yield readBytes(offset, chunkSize)
+		offset += chunkSize
+
+
+# Reads the message of a legacy image, framed between two format tokens. The bytes
+# after the first token are read in chunks until the end token shows up.
+def extractTokenPayload(readBytes, numBytes):
+	binaryToken = utils.FORMAT_TOKEN.encode('utf-8')
+
+	# Each search starts early enough to catch a token split between two chunks.
+	byteArray = bytearray()
+	nextTokenPosition = -1
+	offset = len(binaryToken)
+	while nextTokenPosition < 0 and offset < numBytes:
+		searchStart = max(0, len(byteArray) - len(binaryToken) + 1)
+		byteArray += readBytes(offset, min(SCAN_CHUNK_BYTES, numBytes - offset))
+		offset += SCAN_CHUNK_BYTES
+		nextTokenPosition = byteArray.find(binaryToken, searchStart)
+	if nextTokenPosition <= 0:
+		utils.log('ERROR: the binary stream does not end with the expected {} token'.format(utils.FORMAT_TOKEN))
+		return None
+
+	# Discard the token at the end.
+	return bytes(byteArray[0:nextTokenPosition])
+
+
 # Receives the list of pixels inside the suspected image and extracts the binary values
 # of the least significant bits of each value of each pixel, into a string.
 def extractBinaryMessageFromPixels(pixels):
@@ -77,40 +529,4 @@ def extractBinaryMessageFromPixels(pixels):
 # Returns the char corresponding to the Least Significant Bit of the 
 # provided value, i.e., a '0' or a '1'.
 def leastSignificantBit(value):
-	return '0' if value % 2 == 0 else '1'
-
-
-# Looks for the format tokens at the beginning and end of a suspected message. If found, returns the string
-# representing the message itself.
-def extractSecretMessage(binaryString):
-
-	# First convert the binary string into a byte array.
-	byteArray = bytes(int(binaryString[i : i + 8], 2) for i in range(0, len(binaryString), 8))
-
-	# Create the binary representation of the format tokens.
-	binaryToken = utils.FORMAT_TOKEN.encode('utf-8')
-
-	# Try to find the format token at the beginning of the byte array.
-	if not byteArray[0:len(binaryToken)] == binaryToken:
-		utils.log('ERROR: the binary stream does not start with the expected {} token'.format(utils.FORMAT_TOKEN))
-		return None
-	
-	# Discard the beginning.
-	byteArray = byteArray[len(binaryToken):]
-
-	# Try to find again the same sequence that marks the end of the message.
-	nextTokenPosition = byteArray.find(binaryToken)
-	if nextTokenPosition <= 0:
-		utils.log('ERROR: the binary stream does not end with the expected {} token'.format(utils.FORMAT_TOKEN))
-		return None
-	
-	# Discard the token at the end.
-	byteArray = byteArray[0:nextTokenPosition]
-	
-	# Finally, try to decode the byte array into a string using utf-8 as the encoder.
-	try:
-		return byteArray.decode('utf-8')
-	except Exception as exception:
-		utils.log(exception)
-		utils.log('ERROR: could not decode the byte stream of the secret message')
-		return None
+	return '0' if value % 2 == 0 else '1'
\ No newline at end of file
@@ -1,69 +1,356 @@
 import os
 import math
+import tempfile
 
+import carriers
+import cipher
+import compression
+import container
+import fec
+import instrument
+import pngwriter
+import scatter
+import strips
 import utils
 
+numpy = utils.lazyImport('numpy')
+
 # Reads an image from imgFilename and a text from msgFilename and encodes
 # the text inside the image using Least Significant Bit Steganography.
-# The output image is called outputFilename.
-def encodeAlgorithm(imgFilename, msgFilename, outputFilename):
-
-	# If the image is not JPEG or PNG, return with error.
-	fileRoot, fileExtension = os.path.splitext(imgFilename)
-	if not utils.isJPEG(fileExtension) and not utils.isPNG(fileExtension):
-		utils.log('ERROR: the extension of the image is not supported')
-		utils.log('ERROR: please provide a PNG or JPEG image')
-		return utils.ERROR_NOT_SUPPORTED
+# The output image is called outputFilename. Each of them can also be given
+# as a binary file object, so that everything happens in memory. The message is hidden in the
+# bitsPerChannel least significant bits of each value (from 1 to 4, or to 8 in 16-bit
+# images, which are read and written at their native depth).
+# The image can be PNG, JPEG, BMP, WebP or TIFF, or a WAV sound, whose samples hold the
+# message like the channel values of an image (see carriers.py). The output is written in
+# the format of its extension, or in the format of the input when it has none (PNG for JPEG).
+# If compress is given ('auto' or the name of a codec in compression.CODEC_NAMES),
+# the message is compressed before it is hidden. Big PNG images, or any PNG image
+# that allows it when stream is set, are encoded in strips of rows with bounded memory.
+# If maxSize (width, height) is given, the image is first reduced to fit inside it.
+# The encoded image is written with the options returned by pngwriter.writerOptions,
+# if given, or as PIL writes it by default.
+# If a key is given, the message is scattered across the whole image in the order given by
+# the key (see scatter.py), and the same key is needed to decode it. If a passphrase is
+# given, the message is encrypted after it is compressed (see cipher.py). If parity is given,
+# the payload is protected by an error correcting code with that many parity bytes in each
+# codeword of 255 bytes, so that the message survives some wrong bits (see fec.py).
+@instrument.spanned('encode')
+def encodeAlgorithm(imgFilename, msgFilename, outputFilename, bitsPerChannel=1, compress=None, stream=False, maxSize=None, pngOptions=None, key=None, passphrase=None, parity=None):
 
-	# If a JPEG image was provided, first convert it to PNG (a lossless 
-	# format is needed not to lose the information of the message).
-	filename = fileRoot + '.png'
-	if utils.isJPEG(fileExtension):
-		if utils.convertImage(imgFilename, filename) != 0:
-			utils.log('ERROR: could not convert image from JPEG to PNG')
-			return utils.ERROR_CONVERSION
-		utils.log('JPEG image has been converted to PNG')
-	else:
-		utils.log('PNG image, no conversion needed')
-	
-	# Open the image.
-	image = utils.openImage(filename)
-	if image == None:
+	# Check the encoding options.
+	if checkOptions(bitsPerChannel, compress, maxSize, pngOptions, key, passphrase, parity) != utils.ERROR_OK:
+		return utils.ERROR_OPTIONS
+
+	# If the image is not of a supported format, return with error. Images given as file
+	# objects have no extension, and are checked by their content.
+	if not utils.isFileObject(imgFilename):
+		fileExtension = os.path.splitext(imgFilename)[1]
+		if not carriers.isSupportedExtension(fileExtension):
+			utils.log('ERROR: the extension of the image is not supported')
+			utils.log('ERROR: please provide a PNG, JPEG, BMP, WebP or TIFF image, or a WAV sound')
+			return utils.ERROR_NOT_SUPPORTED
+
+	# Open the image, and decide the format of the output.
+	with instrument.span('encode.open'):
+		carrier = carriers.openCarrier(imgFilename)
+	if carrier == None:
 		utils.log('ERROR: could not open the image')
 		return utils.ERROR_OPEN
+	output = carriers.outputBackend(outputFilename, carrier)
+	if carrier['output'] == None or not carriers.canWrite(carrier, output):
+		utils.log('ERROR: please provide a PNG, JPEG, BMP, WebP or TIFF image, or a WAV sound, and an output of the same kind')
+		return utils.ERROR_NOT_SUPPORTED
 	else:
 		utils.log('Image opened correctly')
 
-	# Get the string inside the provided message file.
-	stringMessage = utils.readStringFromFile(msgFilename)
-	if stringMessage == None:
+	# PNG images are encoded in strips when they are big, without decoding them whole.
+	# Strips are written in sequence, so a message scattered with a key cannot use them, and
+	# neither can a message protected by an error correcting code, whose header comes first.
+	numPixels = carrier['size'][0] * carrier['size'][1]
+	if carrier['format'] == utils.PNG_FORMAT and output == 'png' and maxSize == None and key == None and parity == None and (stream or numPixels >= strips.STREAM_MIN_PIXELS):
+		if strips.isStreamable(imgFilename):
+			utils.log('Encoding the image in strips of rows')
+			with instrument.span('encode.strips'):
+				return strips.encodeInStrips(imgFilename, msgFilename, outputFilename, bitsPerChannel, compress, pngOptions, passphrase)
+		utils.log('The image cannot be encoded in strips, decoding it whole')
+
+	# Decode the pixels once, reducing the image first if requested. A JPEG image is saved
+	# as PNG afterwards (a lossless format is needed not to lose the information of the
+	# message), but it does not need to be converted before. Images are converted to a mode
+	# that the format of the output stores.
+	with instrument.span('encode.decode'):
+		carrier = carriers.prepareCarrier(carrier, output, maxSize)
+	if carrier == None:
+		utils.log('ERROR: could not decode the image')
+		return utils.ERROR_CONVERSION
+	utils.log('Image decoded with size {}x{}', *carrier['size'])
+
+	# Get all the channel values in the image.
+	with instrument.span('encode.extract'):
+		array = carriers.readSamples(carrier)
+	if array is None:
+		utils.log('ERROR: could not extract pixels from image')
+		return utils.ERROR_EXTRACT_PIXELS
+	else:
+		utils.log('Pixels extracted from image')
+
+	# Open the message file in binary mode, so that any kind of file can be hidden.
+	# It is read in chunks while it is encoded, instead of being loaded at once.
+	messageFile = utils.openBinaryFile(msgFilename, 'rb')
+	if messageFile == None:
+		utils.log('ERROR: there was a problem reading the message from the provided file')
+		return utils.ERROR_READ_MSG
+
+	# Images whose values are not integers are encoded through the list of pixels.
+	try:
+		payload = preparePayload(messageFile, compress, passphrase)
+		if payload == None:
+			utils.log('ERROR: there was a problem reading the message from the provided file')
+			return utils.ERROR_READ_MSG
+		if not utils.isArrayEmbeddable(array):
+			if key != None:
+				utils.log('ERROR: the message cannot be scattered with a key inside this image')
+				return utils.ERROR_OPTIONS
+			if parity != None:
+				utils.log('ERROR: the message cannot be protected by an error correcting code inside this image')
+				return utils.ERROR_OPTIONS
+			with instrument.span('encode.pixels'):
+				return encodeWithPixelList(carrier['image'], payload, outputFilename, bitsPerChannel, pngOptions)
+		else:
+			with instrument.span('encode.key'):
+				order = scatter.keyedOrder(key, array.size)
+			return encodeWithArray(carrier, array, payload, outputFilename, bitsPerChannel, pngOptions, order, parity)
+	finally:
+		utils.closeBinaryFile(messageFile, msgFilename)
+
+
+# Checks that the encoding options are valid.
+def checkOptions(bitsPerChannel, compress, maxSize=None, pngOptions=None, key=None, passphrase=None, parity=None):
+	if bitsPerChannel not in range(1, container.MAX_BITS_PER_CHANNEL + 1):
+		utils.log('ERROR: the number of bits per channel must be between 1 and {}'.format(container.MAX_BITS_PER_CHANNEL))
+		return utils.ERROR_OPTIONS
+	if compress not in [None, compression.AUTO] + list(compression.CODEC_NAMES):
+		utils.log('ERROR: the compression codec {} is not supported'.format(compress))
+		return utils.ERROR_OPTIONS
+	if maxSize != None and (len(maxSize) != 2 or min(maxSize) < 1):
+		utils.log('ERROR: the maximum size of the image must be a positive width and height')
+		return utils.ERROR_OPTIONS
+	if not pngwriter.isValid(pngOptions):
+		utils.log('ERROR: the options of the PNG writer are not valid')
+		return utils.ERROR_OPTIONS
+	if key != None and (not isinstance(key, (str, bytes)) or len(key) == 0):
+		utils.log('ERROR: the key must be a non empty string')
+		return utils.ERROR_OPTIONS
+	if passphrase != None and (not isinstance(passphrase, (str, bytes)) or len(passphrase) == 0):
+		utils.log('ERROR: the passphrase must be a non empty string')
+		return utils.ERROR_OPTIONS
+	if passphrase != None and not cipher.isAvailable():
+		utils.log('ERROR: the cryptography package is needed to encrypt the message')
+		return utils.ERROR_OPTIONS
+	if parity != None and parity not in fec.PARITY_RANGE:
+		utils.log('ERROR: the number of parity bytes must be between {} and {}'.format(fec.PARITY_RANGE[0], fec.PARITY_RANGE[-1]))
+		return utils.ERROR_OPTIONS
+	return utils.ERROR_OK
+
+
+# Describes the payload hidden for the message read from messageFile: the chunks of
+# bytes to hide, which are only read while iterating, their length if it is known
+# in advance, and the header extensions that tell the decoder how to restore the message.
+# When compression is requested, the codec is chosen on a sample of the message.
+# When a passphrase is given, the payload is encrypted after it is compressed.
+def preparePayload(messageFile, compress=None, passphrase=None):
+	length = utils.fileLength(messageFile)
+	if length == None:
+		return None
+	payload = {'chunks': utils.readChunks(messageFile), 'length': length, 'extensions': {}}
+
+	# Decide the codec, and skip compression if it does not pay off.
+	if compress != None:
+		sample = utils.peekFile(messageFile, utils.CHUNK_SIZE)
+		if sample == None:
+			return None
+		codec = compression.selectCodec(compress, sample)
+		utils.log('Compression codec for the message: {}', compression.codecName(codec))
+		if codec != compression.CODEC_NONE:
+			payload = {
+				'chunks': compression.compressChunks(payload['chunks'], codec),
+				'length': None,
+				'extensions': container.codecExtensions(codec),
+			}
+
+	if passphrase != None:
+		payload = encryptPayload(payload, passphrase)
+	return payload
+
+
+# Returns the payload encrypted with a key derived from the passphrase. The chunks are
+# encrypted as they are read, and the header extensions record the parameters of the key
+# derivation. Encryption keeps the length of the payload known, if it was.
+def encryptPayload(payload, passphrase):
+	parameters = cipher.newParameters()
+	extensions = dict(payload['extensions'])
+	extensions.update(container.cipherExtensions(parameters))
+	return {
+		'chunks': cipher.encryptChunks(payload['chunks'], passphrase, parameters),
+		'length': None if payload['length'] == None else cipher.encryptedLength(payload['length'], parameters['recordSize']),
+		'extensions': extensions,
+	}
+
+
+# Returns a dictionary with a file holding the payload for the message, its length and the
+# header extensions that describe it. Returns None if the message cannot be read.
+# A payload that was not compressed nor encrypted (it has no extensions) is the message file itself.
+def spoolPayload(messageFile, compress, passphrase=None):
+	payload = preparePayload(messageFile, compress, passphrase)
+	if payload == None:
+		return None
+	if not payload['extensions']:
+		return {'file': messageFile, 'length': payload['length'], 'extensions': payload['extensions']}
+	try:
+		spool = tempfile.TemporaryFile()
+		for chunk in payload['chunks']:
+			spool.write(chunk)
+		length = spool.tell()
+		spool.seek(0)
+	except Exception as exception:
+		utils.log(exception)
+		return None
+	return {'file': spool, 'length': length, 'extensions': payload['extensions']}
+
+
+# Encodes the payload inside the array of channel values of the carrier (see carriers.py) and
+# saves the result into outputFilename, in the format of the output of the carrier. The payload
+# is streamed into the array in chunks, and the header is written last, once the length and
+# checksum are known.
+# The header takes one bit per channel and the payload bitsPerChannel bits per channel.
+# PNG images are written with the given options of the PNG writer. If an order returned by
+# scatter.keyedOrder is given, the header and the payload are written in that order.
+# If parity is given, the payload is protected by an error correcting code with that many
+# parity bytes per codeword, and the header is hidden in a codeword of its own.
+def encodeWithArray(carrier, array, payload, outputFilename, bitsPerChannel=1, pngOptions=None, order=None, parity=None):
+
+	# Check that the channels have enough bits: 16-bit images allow twice as many as 8-bit ones.
+	maxBitsPerChannel = container.maxBitsPerChannel(utils.arrayBitDepth(array))
+	if bitsPerChannel > maxBitsPerChannel:
+		utils.log('ERROR: this image only supports up to {} bits per channel', maxBitsPerChannel)
+		return utils.ERROR_OPTIONS
+
+	# Check that the header and the payload fit inside the image, when its length is known in advance.
+	extensions = dict(payload['extensions'])
+	extensions.update(container.layoutExtensions(bitsPerChannel))
+	flags = 0
+	hiddenLength = payload['length']
+	if parity != None:
+		extensions.update(container.errorCorrectionExtensions(parity, fec.DEFAULT_DEPTH))
+		flags = container.FLAG_ERROR_CORRECTION
+		if hiddenLength != None:
+			hiddenLength = fec.encodedLength(hiddenLength, parity)
+	headerLength = len(container.packHeader(0, 0, flags, extensions))
+	payloadChannel = (fec.CODEWORD_SIZE if parity != None else headerLength) * 8
+	capacity = numBitsInArray(array, bitsPerChannel, payloadChannel) // 8
+	if hiddenLength != None and capacity < hiddenLength:
+		utils.log('ERROR: the image is not big enough to fit the message')
+		return utils.ERROR_MSG_TOO_LARGE
+
+	# Overwrite the least significant bits after the header with the payload, chunk by chunk.
+	# Chunks are a multiple of bitsPerChannel bytes long, so that each one starts on a new channel.
+	# The time spent reading, packing and embedding the chunks is added up for each stage.
+	reading = instrument.Stopwatch('encode.read')
+	packing = instrument.Stopwatch('encode.pack')
+	embedding = instrument.Stopwatch('encode.embed')
+	protecting = instrument.Stopwatch('encode.fec')
+	summary = {'length': 0, 'checksum': 0}
+	offset = 0
+	try:
+		for chunk in reading.iterate(utils.rechunk(protectChunks(payload['chunks'], parity, summary, protecting), utils.CHUNK_SIZE - utils.CHUNK_SIZE % bitsPerChannel)):
+			if offset + len(chunk) > capacity:
+				utils.log('ERROR: the image is not big enough to fit the message')
+				return utils.ERROR_MSG_TOO_LARGE
+			with packing:
+				values = bytesToChannelValues(chunk, bitsPerChannel)
+			with embedding:
+				if writeChannelValues(array, values, payloadChannel + offset * 8 // bitsPerChannel, bitsPerChannel, order) is None:
+					utils.log('ERROR: there was a problem encoding the message inside the image')
+					return utils.ERROR_ENCODING
+			offset += len(chunk)
+	except Exception as exception:
+		utils.log(exception)
+		utils.log('ERROR: there was a problem reading the message from the provided file')
+		return utils.ERROR_READ_MSG
+
+	# Finally, write the header in front of the payload.
+	with packing:
+		header = container.packHeader(summary['length'], summary['checksum'], flags, extensions)
+		if parity != None:
+			header = fec.encodeHeader(header)
+		values = bytesToChannelValues(header)
+	with embedding:
+		if writeChannelValues(array, values, order=order) is None:
+			utils.log('ERROR: there was a problem encoding the message inside the image')
+			return utils.ERROR_ENCODING
+	reading.done(bytes=offset)
+	packing.done(bytes=offset)
+	embedding.done(bytes=offset)
+	if parity != None:
+		protecting.done(bytes=offset)
+	utils.log('Payload of {} bytes encoded correctly inside the image', offset)
+
+	# Export the modified array as the new image.
+	with instrument.span('encode.save'):
+		error = carriers.saveCarrier(outputFilename, carrier, array, pngOptions)
+	if error != 0:
+		utils.log('ERROR: there was a problem saving the new pixels into the new image')
+		return utils.ERROR_SAVE_IMG
+
+	return utils.ERROR_OK
+
+
+# Yields the chunks of the payload protected by an error correcting code with the given
+# number of parity bytes per codeword, or as they are if parity is None. The length and
+# checksum of the payload itself are added up in summary, and the time spent encoding in
+# the stopwatch.
+def protectChunks(chunks, parity, summary, stopwatch):
+	encoder = fec.Encoder(parity) if parity != None else None
+	for chunk in chunks:
+		summary['length'] += len(chunk)
+		summary['checksum'] = container.checksum(chunk, summary['checksum'])
+		if encoder != None:
+			with stopwatch:
+				chunk = encoder.encode(chunk)
+		yield chunk
+	if encoder != None:
+		with stopwatch:
+			chunk = encoder.flush()
+		yield chunk
+
+
+# Encodes the payload inside the list of pixels of the image and saves the result
+# into outputFilename. This is the slow path, only used for images whose values are
+# not integers, and it reads the whole payload at once.
+# Only one bit per channel is supported. PIL writes the image, with the compression level
+# and strategy of the options of the PNG writer, if given.
+def encodeWithPixelList(image, payload, outputFilename, bitsPerChannel=1, pngOptions=None):
+	if bitsPerChannel != 1:
+		utils.log('ERROR: this image only supports one bit per channel')
+		return utils.ERROR_OPTIONS
+
+	# Read the whole payload and put the container header in front of it.
+	try:
+		byteMessage = bytesToContainer(b''.join(payload['chunks']), payload['extensions'])
+	except Exception as exception:
+		utils.log(exception)
 		utils.log('ERROR: there was a problem reading the message from the provided file')
 		return utils.ERROR_READ_MSG
-	else:
-		utils.log('Message read from file:')
-		utils.log('{}'.format(stringMessage))
-
-	# Transform the secret message to binary format.
-	binaryMessage = stringToBinary(stringMessage)
-	if binaryMessage == None:
-		utils.log('ERROR: could not convert the message to binary format')
-		return utils.ERROR_STR_TO_BIN
-	else:
-		utils.log('Message converted to binary format:')
-		utils.log('{}'.format(binaryMessage))
 
 	# Get all the pixel values in the image.
 	pixels = utils.extractPixelsFromImage(image)
 	if pixels == None:
 		utils.log('ERROR: could not extract pixels from image')
 		return utils.ERROR_EXTRACT_PIXELS
-	else:
-		utils.log('Pixels extracted from image')
-	utils.log('First ten pixels in the input image:')
-	for i in range(10):
-		utils.log('\t{} -> {}'.format(i, pixels[i]))
 
 	# Calculate the number of bits that can be used and check if the message fits.
+	binaryMessage = bytesToBinary(byteMessage)
 	if numBitsInImage(pixels) < len(binaryMessage):
 		utils.log('ERROR: the image is not big enough to fit the message')
 		return utils.ERROR_MSG_TOO_LARGE
@@ -75,40 +362,67 @@ def encodeAlgorithm(imgFilename, msgFilename, outputFilename):
 		return utils.ERROR_ENCODING
 	else:
 		utils.log('Message encoded correctly inside the image')
-	utils.log('First ten pixels of the encoded image:')
-	for i in range(10):
-		utils.log('\t{} -> {}'.format(i, newPixels[i]))
-	
+
 	# Create the new image with the new pixel values and export it.
-	if utils.saveImage(outputFilename, image.mode, image.size, newPixels) != 0:
+	if utils.saveImage(outputFilename, image.mode, image.size, newPixels, pngwriter.saveOptions(pngOptions) if pngOptions != None else None) != 0:
 		utils.log('ERROR: there was a problem saving the new pixels into the new image')
 		return utils.ERROR_SAVE_IMG
 
-	# If a PNG image was created on the fly from a JPEG image, remove it from the filesystem.
-	if utils.isJPEG(fileExtension):
-		try:
-			os.remove(filename)
-		except Exception as exception:
-			utils.log(exception)
-			pass
-
 	return utils.ERROR_OK
 
 
-# Appends the format tokens to the beginning and end of the string, then gets
-# the binary representation of the string using utf-8 as the encoder. Returns a string
+# Returns the bytes to hide inside the image for the provided payload: the container
+# header, which records the length and checksum of the payload, followed by the payload.
+def bytesToContainer(payload, extensions={}):
+	return container.packHeader(len(payload), container.checksum(payload), extensions=extensions) + payload
+
+
+# Gets the binary representation of a byte array. Returns a string
 # of only '0' and '1' characters.
-def stringToBinary(string):
+def bytesToBinary(byteMessage):
+	return ''.join([format(byte, '08b') for byte in byteMessage])
 
-	# Add format tokens to the string and transform into a byte array.
-	try:
-		byteList = bytearray(utils.FORMAT_TOKEN + string + utils.FORMAT_TOKEN, encoding='utf-8')
-	except Exception as exception:
-		utils.log(exception)
+
+# Receives the array of channel values of the original image and the message
+# as a byte array. The bits of the message are unpacked once and written in a single
+# pass into the bitsPerChannel least significant bits of the channels starting at
+# channelOffset, in place. The rest of the channels are not touched.
+def encodeMessageInArray(array, byteMessage, channelOffset=0, bitsPerChannel=1):
+	return writeChannelValues(array, bytesToChannelValues(byteMessage, bitsPerChannel), channelOffset, bitsPerChannel)
+
+
+# Stores the values returned by bytesToChannelValues in the bitsPerChannel least significant
+# bits of the channels of the array starting at channelOffset, in place. The channels are
+# taken in sequence, or in the given order (see scatter.py). Returns the array, or None if
+# the values do not fit.
+def writeChannelValues(array, values, channelOffset=0, bitsPerChannel=1, order=None):
+
+	# Work on a flat view of the array, so that the writes land in the array itself.
+	channels = array.reshape(-1)
+	if channelOffset + len(values) > len(channels) or not numpy.shares_memory(channels, array):
+		utils.log('ERROR: the message cannot be written inside the array')
 		return None
 
-	# Join all those bytes in one big string of only 0 and 1 chars, like '0110101'.
-	return ''.join([format(byte, '08b') for byte in byteList])
+	# Clear the least significant bits of the needed channels and store the message bits.
+	mask = ~array.dtype.type((1 << bitsPerChannel) - 1)
+	if order == None:
+		target = channels[channelOffset : channelOffset + len(values)]
+		target &= mask
+		target |= values.astype(array.dtype)
+	else:
+		indices = scatter.channelIndices(order, channelOffset, channelOffset + len(values))
+		channels[indices] = (channels[indices] & mask) | values.astype(array.dtype)
+	return array
+
+
+# Unpacks the message into one bit per element, most significant bit first, and groups
+# those bits into the value stored by each channel. The last value is padded with zeros.
+def bytesToChannelValues(byteMessage, bitsPerChannel=1):
+	values = numpy.unpackbits(numpy.frombuffer(byteMessage, dtype=numpy.uint8))
+	if bitsPerChannel > 1:
+		values = numpy.append(values, numpy.zeros(-len(values) % bitsPerChannel, dtype=numpy.uint8))
+		values = numpy.packbits(values.reshape(-1, bitsPerChannel), axis=1).reshape(-1) >> (8 - bitsPerChannel)
+	return values
 
 
 # Receives the list of pixels, flattened, found in the original image,
@@ -170,4 +484,11 @@ def numBitsInImage(pixels):
 		elif type(pixels[0]) == int:
 			return len(pixels)
 	else:
-		return 0
\ No newline at end of file
+		return 0
+
+
+# Receives the array of channel values obtained from the image and calculates
+# the number of bits it can fit inside, bitsPerChannel per value, after skipping
+# the first channelOffset values.
+def numBitsInArray(array, bitsPerChannel=1, channelOffset=0):
+	return max(array.size - channelOffset, 0) * bitsPerChannel
\ No newline at end of file
@@ -0,0 +1,280 @@
+import functools
+
+import utils
+
+numpy = utils.lazyImport('numpy')
+
+# Reed-Solomon codes over GF(256) correct the bytes of the payload that were changed after
+# it was hidden. Each codeword holds CODEWORD_SIZE bytes: the bytes of the payload followed
+# by parity bytes, and it corrects up to half as many wrong bytes as it has parity bytes.
+# The codewords are interleaved in groups of up to depth codewords: the first byte of every
+# codeword of the group goes first, then the second one, and so on. A run of wrong bytes,
+# like the ones left by an edited region of the image, is then spread over many codewords.
+CODEWORD_SIZE = 255
+
+# Parity bytes of each codeword when none are requested (they correct 16 wrong bytes in
+# each 223 bytes of payload), and the numbers of parity bytes that can be requested.
+DEFAULT_PARITY = 32
+PARITY_RANGE = range(2, 129)
+
+# Number of codewords that are interleaved together.
+DEFAULT_DEPTH = 128
+
+# The header of a payload with error correction is hidden in a codeword of its own, so that it
+# can be found even with errors. It corrects up to 32 wrong bytes, and holds up to
+# HEADER_DATA_SIZE bytes of header and extensions.
+HEADER_PARITY = 64
+HEADER_DATA_SIZE = CODEWORD_SIZE - HEADER_PARITY
+
+# Irreducible polynomial that defines GF(256), whose powers of 2 give every nonzero element.
+PRIMITIVE_POLYNOMIAL = 0x11d
+
+# Tables of the powers of 2 (doubled, so that the sum of two logarithms needs no modulo)
+# and of the logarithms.
+def buildTables():
+	exponents = [0] * 510
+	logarithms = [0] * 256
+	value = 1
+	for power in range(255):
+		exponents[power] = exponents[power + 255] = value
+		logarithms[value] = power
+		value <<= 1
+		if value & 0x100:
+			value ^= PRIMITIVE_POLYNOMIAL
+	return exponents, logarithms
+
+EXPONENTS, LOGARITHMS = buildTables()
+
+
+# Returns the length of a payload of dataLength bytes once it is encoded with the given
+# number of parity bytes per codeword.
+def encodedLength(dataLength, parity):
+	return dataLength + -(-dataLength // (CODEWORD_SIZE - parity)) * parity
+
+# Encodes a stream of bytes in interleaved groups of codewords. Like the compressors of
+# zlib, encode returns the encoded bytes of the groups completed so far, and flush returns
+# the rest once the whole payload was given.
+class Encoder:
+
+	def __init__(self, parity=DEFAULT_PARITY, depth=DEFAULT_DEPTH):
+		self.parity = parity
+		self.groupSize = (CODEWORD_SIZE - parity) * depth
+		self.pending = bytearray()
+
+	def encode(self, data):
+		self.pending += data
+		numBytes = len(self.pending) - len(self.pending) % self.groupSize
+		encoded = b''.join(encodeGroup(self.pending[offset : offset + self.groupSize], self.parity) for offset in range(0, numBytes, self.groupSize))
+		del self.pending[:numBytes]
+		return encoded
+
+	def flush(self):
+		encoded = encodeGroup(self.pending, self.parity)
+		self.pending = bytearray()
+		return encoded
+
+
+# Decodes the chunks of a payload of dataLength bytes encoded by Encoder, yielding the
+# corrected payload one group at a time. The number of bits corrected is added up in
+# corrections['bits'], if corrections is a dictionary. Raises ValueError if a codeword has more errors than it can correct.
+def decodeChunks(chunks, dataLength, parity=DEFAULT_PARITY, depth=DEFAULT_DEPTH, corrections=None):
+	groupSize = (CODEWORD_SIZE - parity) * depth
+	remaining = dataLength
+	for group in utils.rechunk(chunks, encodedLength(groupSize, parity)):
+		numBytes = min(groupSize, remaining)
+		if len(group) != encodedLength(numBytes, parity):
+			raise ValueError('the message protected by the error correcting code is truncated')
+		data, bits = decodeGroup(group, numBytes, parity)
+		if corrections != None:
+			corrections['bits'] = corrections.get('bits', 0) + bits
+		remaining -= numBytes
+		yield data
+
+# Returns the header and its extensions (up to HEADER_DATA_SIZE bytes) in a codeword of their own.
+def encodeHeader(header):
+	return encodeGroup(bytes(header).ljust(HEADER_DATA_SIZE, b'\x00'), HEADER_PARITY)
+
+# Returns the header and extensions held by the codeword of a header, and the number of bits
+# corrected in it, or None if it has more errors than it can correct.
+def decodeHeader(block):
+	try:
+		return decodeGroup(block, HEADER_DATA_SIZE, HEADER_PARITY)
+	except ValueError:
+		return None
+
+
+# Encodes the data in as many codewords as needed, and returns them interleaved. The last
+# codeword may hold less data: the rest of it is filled with zeros that are not stored.
+def encodeGroup(data, parity):
+	if len(data) == 0:
+		return b''
+	codewords, stored = layout(len(data), parity)
+	codewords[:, :CODEWORD_SIZE - parity][stored[:, :CODEWORD_SIZE - parity]] = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+	codewords[:, CODEWORD_SIZE - parity:] = multiply(codewords[:, :CODEWORD_SIZE - parity], parityMatrix(parity))
+	return codewords.T[stored.T].tobytes()
+
+# Decodes the interleaved codewords of numBytes bytes of data, correcting their errors.
+# Returns the data and the number of bits that were corrected.
+def decodeGroup(encoded, numBytes, parity):
+	if numBytes == 0:
+		return b'', 0
+	codewords, stored = layout(numBytes, parity)
+	codewords.T[stored.T] = numpy.frombuffer(bytes(encoded), dtype=numpy.uint8)
+
+	# Only the codewords whose syndromes are not all zero have errors.
+	bits = 0
+	syndromes = multiply(codewords, syndromeMatrix(parity))
+	for index in numpy.flatnonzero(syndromes.any(axis=1)):
+		corrected = correctCodeword(codewords[index].tolist(), syndromes[index].tolist(), parity)
+		if corrected is None or corrected[~stored[index]].any():
+			raise ValueError('the message has more errors than the error correcting code can correct')
+		bits += int(numpy.unpackbits(codewords[index] ^ corrected).sum())
+		codewords[index] = corrected
+	return codewords[:, :CODEWORD_SIZE - parity][stored[:, :CODEWORD_SIZE - parity]].tobytes(), bits
+
+# Returns an array of zeros with a codeword of CODEWORD_SIZE bytes on each row, enough for
+# numBytes bytes of data, and the mask of the bytes that are stored: the data and the parity.
+def layout(numBytes, parity):
+	dataSize = CODEWORD_SIZE - parity
+	numCodewords = -(-numBytes // dataSize)
+	stored = numpy.ones((numCodewords, CODEWORD_SIZE), dtype=bool)
+	stored[-1, numBytes - (numCodewords - 1) * dataSize : dataSize] = False
+	return numpy.zeros((numCodewords, CODEWORD_SIZE), dtype=numpy.uint8), stored
+
+# Multiplies each row of values by the matrix, in GF(256): every product comes from the
+# table, and they are added up with exclusive or.
+def multiply(values, matrix):
+	return numpy.bitwise_xor.reduce(productTable()[values[:, :, None], matrix[None, :, :]], axis=1)
+
+# Returns the table of the products of every pair of elements, built the first time it is needed.
+@functools.lru_cache(maxsize=None)
+def productTable():
+	products = numpy.array(EXPONENTS, dtype=numpy.uint8)[numpy.add.outer(LOGARITHMS, LOGARITHMS)]
+	products[0, :] = 0
+	products[:, 0] = 0
+	return products
+
+
+# Returns the matrix that gives the parity of a codeword out of its data: its row i is
+# x^(CODEWORD_SIZE - 1 - i) modulo the generator polynomial, highest coefficient first.
+@functools.lru_cache(maxsize=None)
+def parityMatrix(parity):
+	generator = generatorPolynomial(parity)
+	rows = [generator[1:]]
+	for _ in range(CODEWORD_SIZE - parity - 1):
+		leading = rows[-1][0]
+		rows.append([value ^ gfMultiply(leading, coefficient) for value, coefficient in zip(rows[-1][1:] + [0], generator[1:])])
+	return numpy.array(rows[::-1], dtype=numpy.uint8)
+
+# Returns the matrix that gives the syndromes of a codeword: the codeword evaluated at
+# each root of the generator polynomial, 2^j for j below parity.
+@functools.lru_cache(maxsize=None)
+def syndromeMatrix(parity):
+	powers = numpy.outer(CODEWORD_SIZE - 1 - numpy.arange(CODEWORD_SIZE), numpy.arange(parity)) % 255
+	return numpy.array(EXPONENTS, dtype=numpy.uint8)[powers]
+
+# Returns the generator polynomial of the code, the product of (x - 2^j) for j below parity.
+def generatorPolynomial(parity):
+	generator = [1]
+	for power in range(parity):
+		generator = polynomialMultiply(generator, [1, EXPONENTS[power]])
+	return generator
+
+
+# Corrects a codeword, given as a list, with its syndromes: Berlekamp-Massey finds the
+# polynomial whose roots locate the errors, the Chien search finds those roots, and the
+# Forney algorithm gives the value of each error. Returns the corrected codeword as an
+# array, or None if it has more errors than the code can correct.
+def correctCodeword(codeword, syndromes, parity):
+
+	# Berlekamp-Massey, with the syndromes after a leading zero.
+	syndromes = [0] + syndromes
+	locator = [1]
+	previous = [1]
+	for step in range(1, parity + 1):
+		discrepancy = syndromes[step]
+		for index in range(1, len(locator)):
+			discrepancy ^= gfMultiply(locator[-(index + 1)], syndromes[step - index])
+		previous = previous + [0]
+		if discrepancy != 0:
+			if len(previous) > len(locator):
+				newLocator = polynomialScale(previous, discrepancy)
+				previous = polynomialScale(locator, gfInverse(discrepancy))
+				locator = newLocator
+			locator = polynomialAdd(locator, polynomialScale(previous, discrepancy))
+	while len(locator) > 0 and locator[0] == 0:
+		del locator[0]
+	numErrors = len(locator) - 1
+	if numErrors * 2 > parity:
+		return None
+
+	# Chien search: the error at position p is a root at 2^-(CODEWORD_SIZE - 1 - p).
+	reversedLocator = locator[::-1]
+	positions = [CODEWORD_SIZE - 1 - power for power in range(CODEWORD_SIZE) if polynomialEvaluate(reversedLocator, EXPONENTS[power]) == 0]
+	if len(positions) != numErrors:
+		return None
+
+	# Forney: the value of each error out of the error evaluator polynomial.
+	coefficientPositions = [CODEWORD_SIZE - 1 - position for position in positions]
+	errataLocator = [1]
+	for power in coefficientPositions:
+		errataLocator = polynomialMultiply(errataLocator, [EXPONENTS[power], 1])
+	evaluator = polynomialMultiply(syndromes[::-1], errataLocator)[-len(errataLocator):]
+	locations = [EXPONENTS[power] for power in coefficientPositions]
+	corrected = list(codeword)
+	for index, location in enumerate(locations):
+		inverse = gfInverse(location)
+		derivative = 1
+		for other, otherLocation in enumerate(locations):
+			if other != index:
+				derivative = gfMultiply(derivative, 1 ^ gfMultiply(inverse, otherLocation))
+		if derivative == 0:
+			return None
+		value = gfMultiply(location, polynomialEvaluate(evaluator, inverse))
+		corrected[positions[index]] ^= gfDivide(value, derivative)
+
+	# The correction must give a codeword, or there were too many errors.
+	corrected = numpy.array(corrected, dtype=numpy.uint8)
+	if multiply(corrected[None, :], syndromeMatrix(parity)).any():
+		return None
+	return corrected
+
+
+# Arithmetic of GF(256) and of polynomials over it, given as lists of coefficients,
+# highest first.
+def gfMultiply(a, b):
+	if a == 0 or b == 0:
+		return 0
+	return EXPONENTS[LOGARITHMS[a] + LOGARITHMS[b]]
+
+def gfDivide(a, b):
+	if a == 0:
+		return 0
+	return EXPONENTS[(LOGARITHMS[a] - LOGARITHMS[b]) % 255]
+
+def gfInverse(a):
+	return EXPONENTS[255 - LOGARITHMS[a]]
+
+def polynomialScale(polynomial, factor):
+	return [gfMultiply(coefficient, factor) for coefficient in polynomial]
+
+def polynomialAdd(p, q):
+	result = [0] * max(len(p), len(q))
+	for index, coefficient in enumerate(p):
+		result[index + len(result) - len(p)] = coefficient
+	for index, coefficient in enumerate(q):
+		result[index + len(result) - len(q)] ^= coefficient
+	return result
+
+def polynomialMultiply(p, q):
+	result = [0] * (len(p) + len(q) - 1)
+	for i, a in enumerate(p):
+		for j, b in enumerate(q):
+			result[i + j] ^= gfMultiply(a, b)
+	return result
+
+def polynomialEvaluate(polynomial, x):
+	value = polynomial[0]
+	for coefficient in polynomial[1:]:
+		value = gfMultiply(value, x) ^ coefficient
+	return value
@@ -0,0 +1,169 @@
+import contextlib
+import functools
+import io
+import json
+import sys
+import threading
+import time
+
+# Sinks that receive the spans as they finish. When there are none, the spans
+# are not timed at all.
+sinks = []
+
+# Number of functions listed in the reports of the profiler.
+PROFILE_LINES = 30
+
+# Upper bounds in seconds of the buckets of the histogram of each span, for the Prometheus sink.
+PROMETHEUS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+# Marks the end of an iterator.
+END = object()
+
+# Decides if the spans are being recorded.
+def isRecording():
+	return len(sinks) > 0
+
+# Sends a span that took the given seconds to every sink. The attributes describe
+# the span, like the number of bytes it processed.
+def record(name, seconds, attributes={}):
+	for sink in sinks:
+		sink.record(name, seconds, attributes)
+
+# Times the code inside the block as a span with the given name.
+@contextlib.contextmanager
+def span(name, **attributes):
+	if not sinks:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		record(name, time.perf_counter() - start, attributes)
+
+# Decorates a function so that every call to it is timed as a span with the given name.
+def spanned(name):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*arguments, **options):
+			with span(name):
+				return function(*arguments, **options)
+		return wrapper
+	return decorator
+
+
+# Adds up the time spent in a stage that runs many times, like each chunk of a message,
+# and records it as a single span when it is done. Use it as a context manager around
+# each run of the stage.
+class Stopwatch:
+
+	def __init__(self, name):
+		self.name = name
+		self.seconds = 0
+		self.recording = isRecording()
+
+	def __enter__(self):
+		if self.recording:
+			self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exception):
+		if self.recording:
+			self.seconds += time.perf_counter() - self.start
+
+	# Yields the items of the iterable, adding up the time spent getting each one.
+	def iterate(self, iterable):
+		iterator = iter(iterable)
+		while True:
+			with self:
+				item = next(iterator, END)
+			if item is END:
+				return
+			yield item
+
+	# Records the time added up so far as a span.
+	def done(self, **attributes):
+		if self.recording:
+			record(self.name, self.seconds, attributes)
+
+
+# Writes each span as a line of JSON into a stream (by default, the standard error).
+class JsonSink:
+
+	def __init__(self, stream=None):
+		self.stream = stream
+
+	def record(self, name, seconds, attributes):
+		line = dict(attributes, span=name, seconds=seconds)
+		print(json.dumps(line), file=self.stream or sys.stderr)
+
+
+# Keeps every span in a list, as a dictionary with its name, seconds and attributes.
+class MemorySink:
+
+	def __init__(self):
+		self.records = []
+
+	def record(self, name, seconds, attributes):
+		self.records.append({'span': name, 'seconds': seconds, 'attributes': attributes})
+
+	# Returns a dictionary from the name of each span to its total seconds.
+	def totals(self):
+		totals = {}
+		for entry in self.records:
+			totals[entry['span']] = totals.get(entry['span'], 0) + entry['seconds']
+		return totals
+
+
+# Keeps a histogram of the seconds of each span, and renders them in the text format
+# of Prometheus.
+class PrometheusSink:
+
+	def __init__(self, prefix='lsb'):
+		self.prefix = prefix
+		self.histograms = {}
+		self.lock = threading.Lock()
+
+	def record(self, name, seconds, attributes):
+		with self.lock:
+			histogram = self.histograms.setdefault(name, {'buckets': [0] * len(PROMETHEUS_BUCKETS), 'count': 0, 'sum': 0})
+			for index, bound in enumerate(PROMETHEUS_BUCKETS):
+				if seconds <= bound:
+					histogram['buckets'][index] += 1
+			histogram['count'] += 1
+			histogram['sum'] += seconds
+
+	# Returns the histograms in the text format of Prometheus.
+	def render(self):
+		metric = self.prefix + '_span_seconds'
+		lines = ['# HELP {} Time spent in each stage.'.format(metric), '# TYPE {} histogram'.format(metric)]
+		with self.lock:
+			for name, histogram in sorted(self.histograms.items()):
+				for bound, count in zip(PROMETHEUS_BUCKETS, histogram['buckets']):
+					lines.append('{}_bucket{{span="{}",le="{}"}} {}'.format(metric, name, bound, count))
+				lines.append('{}_bucket{{span="{}",le="+Inf"}} {}'.format(metric, name, histogram['count']))
+				lines.append('{}_sum{{span="{}"}} {}'.format(metric, name, histogram['sum']))
+				lines.append('{}_count{{span="{}"}} {}'.format(metric, name, histogram['count']))
+		return '\n'.join(lines) + '\n'
+
+
+# Adds a sink for the spans recorded inside the block.
+@contextlib.contextmanager
+def recording(sink):
+	sinks.append(sink)
+	try:
+		yield sink
+	finally:
+		sinks.remove(sink)
+
+# Calls function(*arguments) under cProfile. Returns what the function returns and a
+# report of the functions where most time was spent. The profiler is only
+# loaded when it is used.
+def profileCall(function, *arguments):
+	import cProfile
+	import pstats
+	profiler = cProfile.Profile()
+	result = profiler.runcall(function, *arguments)
+	report = io.StringIO()
+	pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+	return result, report.getvalue()
@@ -0,0 +1,171 @@
+import collections
+import multiprocessing
+import threading
+import uuid
+
+import instrument
+import pool
+import utils
+
+# States of a job. A job is queued until a worker process takes it.
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+# Number of jobs waiting for a free worker process when none is requested.
+DEFAULT_QUEUE_DEPTH = 8
+
+# Number of finished jobs whose results are kept until they are fetched. When there are
+# more, the oldest ones are dropped.
+MAX_FINISHED_JOBS = 32
+
+# Queue where the worker processes report the jobs they start. It is set in each worker by initWorker.
+progressQueue = None
+
+# Runs jobs in a pool of processes. A job is a function that returns an error code and a
+# result, like master.encodeBytes. At most queueDepth jobs wait for a free process:
+# submitting more is rejected, so that the caller can ask the client to come back later.
+# Every time a job changes its state, onEvent is called with the status of the job
+# (from a background thread). The spans recorded by each job in its worker are sent to
+# the sinks of this process when the job finishes.
+class JobPool:
+
+	def __init__(self, processes=None, queueDepth=DEFAULT_QUEUE_DEPTH, onEvent=None):
+		self.processes = processes or pool.defaultProcesses()
+		self.queueDepth = queueDepth
+		self.onEvent = onEvent
+		self.jobs = collections.OrderedDict()
+		self.numActive = 0
+		self.lock = threading.Lock()
+		self.progressQueue = multiprocessing.Queue()
+
+		# concurrent.futures is only imported once a pool of jobs is created, to keep the start-up cheap.
+		from concurrent.futures import ProcessPoolExecutor
+		self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=initWorker, initargs=(self.progressQueue,))
+		threading.Thread(target=self.listen, daemon=True).start()
+
+	# Submits a job that calls function(*arguments) in a worker process. The name tells
+	# what kind of job it is. A job may be given its ID, like a hash of what it does:
+	# submitting it again while it is queued or running does not start another one.
+	# With profile, the job runs under cProfile and keeps its report. A job that cannot be
+	# handed to the worker processes, like after shutdown, fails right away.
+	# Returns the ID of the job, or None if the queue is full.
+	def submit(self, name, function, *arguments, jobId=None, profile=False):
+		with self.lock:
+			job = self.jobs.get(jobId)
+			if job != None and job['state'] in [STATE_QUEUED, STATE_RUNNING]:
+				return jobId
+			if self.numActive >= self.processes + self.queueDepth:
+				return None
+			jobId = jobId or uuid.uuid4().hex
+			self.jobs.pop(jobId, None)
+			self.jobs[jobId] = {'id': jobId, 'name': name, 'state': STATE_QUEUED, 'error': None, 'result': None, 'profile': None}
+			self.numActive += 1
+		self.emit(jobId)
+		try:
+			future = self.executor.submit(runJob, jobId, function, arguments, profile)
+		except Exception as exception:
+			utils.log(exception)
+			self.store(jobId, utils.ERROR_JOB, None, None)
+			return jobId
+		future.add_done_callback(lambda future: self.finish(jobId, future))
+		return jobId
+
+	# Returns a dictionary with the ID, name, state and error code of the job,
+	# or None if the job is not known.
+	def status(self, jobId):
+		with self.lock:
+			job = self.jobs.get(jobId)
+			if job == None:
+				return None
+			return {'id': job['id'], 'name': job['name'], 'state': job['state'], 'error': job['error']}
+
+	# Returns a dictionary with the number of known jobs in each state, and the number of
+	# jobs that can be active at once, for monitoring.
+	def counts(self):
+		with self.lock:
+			counts = {state: 0 for state in [STATE_QUEUED, STATE_RUNNING, STATE_DONE, STATE_FAILED]}
+			for job in self.jobs.values():
+				counts[job['state']] += 1
+			counts['capacity'] = self.processes + self.queueDepth
+			return counts
+
+	# Returns the result of a finished job, or None if there is none.
+	def result(self, jobId):
+		with self.lock:
+			job = self.jobs.get(jobId)
+			return None if job == None else job['result']
+
+	# Returns the report of the profiler for a finished job, or None if there is none.
+	def profile(self, jobId):
+		with self.lock:
+			job = self.jobs.get(jobId)
+			return None if job == None else job['profile']
+
+	# Stops the worker processes once the jobs submitted are finished.
+	def shutdown(self):
+		self.executor.shutdown()
+
+	# Stores the result of a job when its worker returns it.
+	def finish(self, jobId, future):
+		try:
+			(error, result), spans, report = future.result()
+		except Exception as exception:
+			utils.log(exception)
+			(error, result), spans, report = (utils.ERROR_JOB, None), [], None
+		for entry in spans:
+			instrument.record(entry['span'], entry['seconds'], entry['attributes'])
+		self.store(jobId, error, result, report)
+
+	# Stores the error code, the result and the report of the profiler of a job that ended,
+	# and makes room for another job.
+	def store(self, jobId, error, result, report):
+		with self.lock:
+			job = self.jobs[jobId]
+			job['state'] = STATE_DONE if error == utils.ERROR_OK else STATE_FAILED
+			job['error'] = error
+			job['result'] = result
+			job['profile'] = report
+			self.numActive -= 1
+
+			# Drop the oldest finished jobs.
+			finished = [key for key, value in self.jobs.items() if value['state'] in [STATE_DONE, STATE_FAILED]]
+			for key in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+				del self.jobs[key]
+		self.emit(jobId)
+
+	# Marks the jobs as running as the worker processes report them.
+	def listen(self):
+		while True:
+			jobId = self.progressQueue.get()
+			with self.lock:
+				job = self.jobs.get(jobId)
+				if job == None or job['state'] != STATE_QUEUED:
+					continue
+				job['state'] = STATE_RUNNING
+			self.emit(jobId)
+
+	# Sends the status of the job to onEvent.
+	def emit(self, jobId):
+		status = self.status(jobId)
+		if self.onEvent != None and status != None:
+			self.onEvent(status)
+
+
+# Keeps the queue where the worker process reports the jobs it starts.
+def initWorker(queue):
+	global progressQueue
+	progressQueue = queue
+	utils.silent = True
+
+# Runs a job inside a worker process, after reporting that it started. Returns what the
+# function returns, the spans it recorded and the report of the profiler, if requested.
+def runJob(jobId, function, arguments, profile=False):
+	progressQueue.put(jobId)
+	with instrument.recording(instrument.MemorySink()) as sink:
+		if profile:
+			result, report = instrument.profileCall(function, *arguments)
+		else:
+			result, report = function(*arguments), None
+	return result, sink.records, report
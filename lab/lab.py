@@ -1,8 +1,27 @@
+import argparse
+import os
 import sys
 
 from encode import encodeAlgorithm
-from decode import decodeAlgorithm
+from decode import decodeAlgorithm, decodeRangeAlgorithm
+from shard import encodeShardsAlgorithm, decodeShardsAlgorithm
+import batch
+import capacity
+import compression
+import container
+import fec
+import instrument
+import pngwriter
+import strips
 import utils
+import worker
+
+# Default directory where the images of a split message are stored.
+DEFAULT_SHARDS_OUTPUT = 'shards'
+
+# Default directories where the outputs of a batch are stored.
+DEFAULT_BATCH_ENCODE_OUTPUT = 'encoded'
+DEFAULT_BATCH_DECODE_OUTPUT = 'decoded'
 
 
 # The main function basically checks the command line arguments
@@ -10,42 +29,237 @@ import utils
 def main():
 
 	# Check that the necessary command line arguments were provided.
-	if len(sys.argv) != 4:
+	parser = createParser()
+	try:
+		arguments = parser.parse_args()
+	except SystemExit as exit:
+		if exit.code != 0:
+			utils.log('ERROR: incorrect syntax')
+			return -1
+		return 0
+
+	# Set how much is logged, and where the time spent in each stage is reported.
+	utils.logLevel = utils.LOG_LEVELS[arguments.log_level]
+	if arguments.trace:
+		instrument.sinks.append(instrument.JsonSink())
+	if arguments.profile:
+		error, report = instrument.profileCall(runMode, parser, arguments)
+		try:
+			with open(arguments.profile, 'w') as profileFile:
+				profileFile.write(report)
+		except OSError as exception:
+			utils.log(exception)
+			return -1
+		return error
+	return runMode(parser, arguments)
+
+
+# Runs the mode requested in the command line arguments.
+def runMode(parser, arguments):
+
+	# Batches of images, capacity reports and workers are handled on their own.
+	if arguments.worker:
+		return worker.serve(sys.stdin, sys.stdout)
+	if arguments.batch or arguments.manifest:
+		return runBatch(parser, arguments)
+	if arguments.capacity:
+		return runCapacity(parser, arguments)
+
+	# Every other mode takes one or more images followed by the message file.
+	if len(arguments.files) < 2 or (len(arguments.files) != 2 and (arguments.encode or arguments.decode)):
 		utils.log('ERROR: incorrect syntax')
-		printUsage()
+		parser.print_usage()
+		return -1
+	imgFilenames = arguments.files[:-1]
+	msgFilename = arguments.files[-1]
+
+	# Messages split across several images are always written in sequence, never encrypted
+	# and never protected by an error correcting code.
+	if (arguments.key != None or arguments.passphrase != None) and (arguments.split or arguments.join):
+		utils.log('ERROR: a key or a passphrase cannot be used to split or join a message')
+		return -1
+	if arguments.fec != None and (arguments.split or arguments.join):
+		utils.log('ERROR: an error correcting code cannot be used to split or join a message')
+		return -1
+	if arguments.range != None and not arguments.decode:
+		utils.log('ERROR: a range of the message can only be read when decoding (-d)')
 		return -1
 
-	# Store command line arguments for later.
-	imgFilename = sys.argv[2]
-	msgFilename = sys.argv[3]
+	# A single directory stands for all the images inside it.
+	if len(imgFilenames) == 1 and (arguments.split or arguments.join):
+		imgFilenames = imgFilenames[0]
 
 	# Decide if we have to encode or decode:
-	if sys.argv[1] == '-e':
+	if arguments.encode:
 		utils.log('Encoding...')
-		if encodeAlgorithm(imgFilename, msgFilename, utils.DEFAULT_ENCODE_OUTPUT) != utils.ERROR_OK:
-			utils.log('ERROR: there was a problem encoding the message')
-			return -1
-		else:
-			utils.log('Encoding executed correctly')
-			return 0
-	elif sys.argv[1] == '-d':
+		error = encodeAlgorithm(imgFilenames[0], msgFilename, arguments.output or utils.DEFAULT_ENCODE_OUTPUT, arguments.bits, arguments.compress, arguments.stream, arguments.max_size, pngOptions(arguments), arguments.key, arguments.passphrase, arguments.fec)
+	elif arguments.decode and arguments.range != None:
+		utils.log('Decoding a range of the message...')
+		error = decodeRangeAlgorithm(imgFilenames[0], msgFilename, arguments.range[0], arguments.range[1], arguments.key, arguments.passphrase)
+	elif arguments.decode:
 		utils.log('Decoding...')
-		if decodeAlgorithm(imgFilename, msgFilename) != utils.ERROR_OK:
-			utils.log('ERROR: there was a problem decoding the message')
+		error = decodeAlgorithm(imgFilenames[0], msgFilename, arguments.key, arguments.passphrase)
+	elif arguments.split:
+		utils.log('Encoding across several images...')
+		error = encodeShardsAlgorithm(imgFilenames, msgFilename, arguments.output or DEFAULT_SHARDS_OUTPUT, arguments.bits, arguments.compress, arguments.processes)
+	else:
+		utils.log('Decoding from several images...')
+		error = decodeShardsAlgorithm(imgFilenames, msgFilename, arguments.processes)
+
+	if error != utils.ERROR_OK:
+		utils.log('ERROR: there was a problem {} the message'.format('encoding' if arguments.encode or arguments.split else 'decoding'))
+		return -1
+	else:
+		utils.log('{} executed correctly'.format('Encoding' if arguments.encode or arguments.split else 'Decoding'))
+		return 0
+
+
+# Encodes or decodes a batch of images, given as a directory or as a manifest file.
+def runBatch(parser, arguments):
+	if not (arguments.encode or arguments.decode):
+		utils.log('ERROR: batches can only be encoded (-e) or decoded (-d)')
+		return -1
+	mode = batch.MODE_ENCODE if arguments.encode else batch.MODE_DECODE
+
+	# Build the list of items of the batch.
+	if arguments.manifest:
+		if len(arguments.files) != 0:
+			utils.log('ERROR: no files are expected with a manifest')
+			parser.print_usage()
+			return -1
+		items = batch.itemsFromManifest(mode, arguments.manifest)
+		if items == None:
 			return -1
-		else:
-			utils.log('Decoding executed correctly')
-			return 0
 	else:
-		utils.log('ERROR: option "{}" not recognized'.format(sys.argv[1]))
-		printUsage()
+		if len(arguments.files) != (2 if arguments.encode else 1):
+			utils.log('ERROR: incorrect syntax')
+			parser.print_usage()
+			return -1
+		msgFilename = arguments.files[1] if arguments.encode else None
+		outputDirectory = arguments.output or (DEFAULT_BATCH_ENCODE_OUTPUT if arguments.encode else DEFAULT_BATCH_DECODE_OUTPUT)
+		items = batch.itemsFromDirectory(mode, arguments.files[0], msgFilename, outputDirectory)
+		if items == None:
+			return -1
+
+	# Run the batch; it goes well only if every item does.
+	options = {'bitsPerChannel': arguments.bits, 'compress': arguments.compress, 'stream': arguments.stream, 'maxSize': arguments.max_size, 'pngOptions': pngOptions(arguments), 'parity': arguments.fec} if arguments.encode else {}
+	options.update(key=arguments.key, passphrase=arguments.passphrase)
+	results = batch.batchAlgorithm(mode, items, arguments.processes, arguments.resume, **options)
+	return 0 if set(results) <= {utils.ERROR_OK} else -1
+
+
+# Prints the number of bits of payload that fit inside each image, for each number of bits
+# per channel, reading only the headers of the images. Directories are read through their
+# index of carriers, which is updated as needed.
+def runCapacity(parser, arguments):
+	if len(arguments.files) == 0:
+		utils.log('ERROR: incorrect syntax')
+		parser.print_usage()
 		return -1
 
+	# Find the images and their sizes.
+	rows = []
+	for filename in arguments.files:
+		if os.path.isdir(filename):
+			index = capacity.loadIndex(filename)
+			if index == None:
+				return -1
+			rows += [(os.path.join(filename, entry['path']), entry) for entry in index['carriers']]
+		else:
+			info = capacity.readImageInfo(filename)
+			if info == None:
+				utils.log('ERROR: could not open the image {}'.format(filename))
+				return -1
+			rows.append((filename, info))
+
+	# Print a line for each image.
+	modes = range(1, container.MAX_BITS_PER_CHANNEL + 1)
+	print('\t'.join(['image', 'size', 'mode'] + ['{} bit{}/channel'.format(bitsPerChannel, 's' if bitsPerChannel > 1 else '') for bitsPerChannel in modes]))
+	for filename, info in rows:
+		bits = [str(capacity.capacityBits(info['channels'], bitsPerChannel)) if bitsPerChannel in capacity.supportedBitsPerChannel(info) else '-' for bitsPerChannel in modes]
+		print('\t'.join([filename, '{}x{}'.format(info['width'], info['height']), info['mode']] + bits))
+	return 0
+
+
+# Creates the parser of the command line arguments of the application.
+def createParser():
+	parser = argparse.ArgumentParser(prog='lab.py', description='Hide a message inside an image, or find it.',
+		usage='%(prog)s (-e | -d) <img_filename> <msg_filename> [options]\n'
+			'       %(prog)s (-s | -j) <img_filename>... <msg_filename> [options]\n'
+			'       %(prog)s -e --batch <img_directory> <msg_filename> [options]\n'
+			'       %(prog)s -d --batch <img_directory> [options]\n'
+			'       %(prog)s (-e | -d) --manifest <manifest_filename> [options]\n'
+			'       %(prog)s --capacity <img_filename>...')
+	mode = parser.add_mutually_exclusive_group(required=True)
+	mode.add_argument('-e', dest='encode', action='store_true', help='hide the message file inside the image')
+	mode.add_argument('-d', dest='decode', action='store_true', help='find the message inside the image and store it in the message file')
+	mode.add_argument('-s', '--split', action='store_true',
+		help='split the message file across the images (or all the images inside a directory), using as many as needed')
+	mode.add_argument('-j', '--join', action='store_true',
+		help='reassemble the message split across the images (or all the images inside a directory), in any order')
+	mode.add_argument('--capacity', action='store_true',
+		help='print the bits of message that fit inside the images (or all the images inside a directory) for each number of bits per channel, reading only their headers')
+	mode.add_argument('--worker', action='store_true',
+		help='serve encode and decode requests read as JSON lines from the standard input in one long-lived process, and write their results as JSON lines to the standard output (see worker.py)')
+	parser.add_argument('files', nargs='*', metavar='file', help='images followed by the message file')
+	parser.add_argument('-b', '--bits', type=int, default=1, choices=range(1, container.MAX_BITS_PER_CHANNEL + 1),
+		help='number of least significant bits of each channel used to hide the message (default: 1), up to 4 in 8-bit images and 8 in 16-bit images. Decoding detects it.')
+	parser.add_argument('-c', '--compress', nargs='?', const=compression.AUTO, choices=[compression.AUTO] + list(compression.CODEC_NAMES),
+		help='compress the message before hiding it, with the given codec or the best one for the message (auto, the default when no codec is given). Decoding detects it.')
+	parser.add_argument('--stream', action='store_true',
+		help='encode PNG images in strips of rows with bounded memory, whatever their size (images of {} pixels or more always are)'.format(strips.STREAM_MIN_PIXELS))
+	parser.add_argument('--max-size', type=parseSize, metavar='WIDTHxHEIGHT',
+		help='reduce the image to fit inside the given size before hiding the message (JPEG images are decoded straight at a reduced scale)')
+	parser.add_argument('--png-preset', choices=list(pngwriter.PRESETS),
+		help='write the encoded image for speed (faster, bigger) or size (slower, smaller), or as by default')
+	parser.add_argument('--png-level', type=int, choices=pngwriter.LEVELS, help='zlib compression level of the encoded image (default: from the preset)')
+	parser.add_argument('--png-filter', choices=pngwriter.FILTER_NAMES, help='filter of the rows of the encoded image (default: from the preset)')
+	parser.add_argument('-k', '--key',
+		help='scatter the message across the whole image in an order given by the key, instead of from the first pixel on. The same key is needed to decode it (not supported when splitting or joining a message).')
+	parser.add_argument('--passphrase',
+		help='encrypt the message with a key derived from the passphrase before hiding it. The same passphrase is needed to decode it (not supported when splitting or joining a message).')
+	parser.add_argument('--fec', nargs='?', type=int, const=fec.DEFAULT_PARITY, metavar='PARITY',
+		help='protect the message with an error correcting code, so that it survives some wrong bits: each codeword of 255 bytes gets PARITY parity bytes (from {} to {}, {} when none is given) and corrects half as many wrong bytes. Decoding detects it and reports the corrected bits (not supported when splitting or joining a message).'.format(fec.PARITY_RANGE[0], fec.PARITY_RANGE[-1], fec.DEFAULT_PARITY))
+	parser.add_argument('--range', type=parseRange, metavar='OFFSET:LENGTH',
+		help='only read LENGTH bytes of the message from byte OFFSET on, decoding only the rows of the image that hold them when the message was hidden without a key')
+	parser.add_argument('-o', '--output',
+		help='encoded image, whose extension picks its format: .png, .bmp, .webp, .tif or .wav (default: {}), or directory where the images of a split message (default: {}) or the outputs of a batch (default: {} or {}) are stored'.format(
+			utils.DEFAULT_ENCODE_OUTPUT, DEFAULT_SHARDS_OUTPUT, DEFAULT_BATCH_ENCODE_OUTPUT, DEFAULT_BATCH_DECODE_OUTPUT))
+	parser.add_argument('-p', '--processes', type=int, help='number of processes used to split or join a message, or to run a batch (default: one per CPU)')
+	parser.add_argument('--batch', action='store_true', help='encode or decode every image inside the directory, storing each output in the output directory')
+	parser.add_argument('--manifest', help='encode or decode the items listed in the manifest, one per line: image, message and output when encoding, or image and message when decoding, separated by tabs')
+	parser.add_argument('--resume', action='store_true', help='skip the items of a batch whose output already exists')
+	parser.add_argument('--log-level', default='info', choices=list(utils.LOG_LEVELS), help='least important messages that are printed (default: info)')
+	parser.add_argument('--trace', action='store_true', help='print the time spent in each stage to the standard error, as lines of JSON')
+	parser.add_argument('--profile', metavar='FILE', help='run under cProfile and write the functions where most time was spent to the file')
+	return parser
+
+
+# Returns the options of the PNG writer requested in the command line arguments.
+def pngOptions(arguments):
+	return pngwriter.writerOptions(arguments.png_preset, arguments.png_level, arguments.png_filter)
+
+# Parses a size given as WIDTHxHEIGHT in the command line.
+def parseSize(text):
+	try:
+		width, height = [int(value) for value in text.lower().split('x')]
+	except ValueError:
+		raise argparse.ArgumentTypeError('the size must be given as WIDTHxHEIGHT')
+	if width < 1 or height < 1:
+		raise argparse.ArgumentTypeError('the width and height must be positive')
+	return width, height
+
+
+# Parses a range of the message given as OFFSET:LENGTH, in bytes.
+def parseRange(text):
+	try:
+		offset, length = [int(value) for value in text.split(':')]
+	except ValueError:
+		raise argparse.ArgumentTypeError('the range must be given as OFFSET:LENGTH')
+	if offset < 0 or length < 0:
+		raise argparse.ArgumentTypeError('the offset and length must not be negative')
+	return offset, length
 
-# Prints the correct usage of the application to the screen.
-def printUsage():
-	utils.log('\nUsage:')
-	utils.log('\tpython3 lab.py -[e/d] <img_filename> <msg_filename>\n')
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	sys.exit(main())
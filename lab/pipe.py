@@ -0,0 +1,102 @@
+import queue
+import threading
+
+import utils
+
+# Size in bytes of the pieces handed from the writer to the reader. Smaller writes, like
+# the header and checksum of each PNG chunk, are gathered until they add up to this.
+PIECE_BYTES = utils.CHUNK_SIZE
+
+# Number of pieces that can wait for the reader before the writer blocks, so that a slow
+# reader bounds the memory taken by a fast writer.
+MAX_PENDING_PIECES = 16
+
+# Seconds that a blocked writer waits before checking again if the reader is gone.
+WRITE_POLL_SECONDS = 0.5
+
+# A binary file object written by one thread and read as pieces by another one, like the
+# encoded image written by the encoder while the web server sends it. The writer runs
+# function(pipe) in its own thread (see start), and the reader iterates the pipe.
+class Pipe:
+
+	def __init__(self):
+		self.pieces = queue.Queue(MAX_PENDING_PIECES)
+		self.buffer = bytearray()
+		self.cancelled = threading.Event()
+		self.result = None
+		self.exception = None
+		self.thread = None
+
+	# Runs function(pipe) in a new thread, which writes into the pipe. Its return value is
+	# kept as the result of the pipe, and any exception it raises, as its exception. A reader
+	# that is gone is not an error of the thread: its BrokenPipeError is kept like the others.
+	def start(self, function):
+		def run():
+			try:
+				self.result = function(self)
+			except Exception as exception:
+				self.exception = exception
+			finally:
+				try:
+					self.close()
+				except BrokenPipeError as exception:
+					self.exception = self.exception or exception
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+		return self
+
+	# Writes the bytes, which are handed to the reader in pieces of PIECE_BYTES.
+	def write(self, data):
+		self.buffer.extend(data)
+		if len(self.buffer) >= PIECE_BYTES:
+			self.put(bytes(self.buffer))
+			self.buffer.clear()
+		return len(data)
+
+	# Nothing to do: pieces are handed as they fill, and the rest once the pipe is closed.
+	def flush(self):
+		pass
+
+	# Hands the bytes written and not yet handed to the reader, and tells it that there
+	# are no more. Once the reader is gone, the bytes are dropped and nothing is handed.
+	def close(self):
+		if self.cancelled.is_set():
+			self.buffer.clear()
+			return
+		if len(self.buffer) > 0:
+			piece = bytes(self.buffer)
+			self.buffer.clear()
+			self.put(piece)
+		self.put(None)
+
+	# Hands a piece to the reader, waiting while too many are pending. Raises an error once
+	# the reader is gone, so that the writer does not wait forever.
+	def put(self, piece):
+		while not self.cancelled.is_set():
+			try:
+				self.pieces.put(piece, timeout=WRITE_POLL_SECONDS)
+				return
+			except queue.Full:
+				pass
+		if piece != None:
+			raise BrokenPipeError('the reader of the pipe is gone')
+
+	# Returns the next piece written, waiting for it, or None once the writer is done.
+	def read(self):
+		if self.cancelled.is_set():
+			return None
+		piece = self.pieces.get()
+		if piece == None:
+			self.cancelled.set()
+		return piece
+
+	# Yields the pieces written, as they are.
+	def __iter__(self):
+		piece = self.read()
+		while piece != None:
+			yield piece
+			piece = self.read()
+
+	# Tells the writer that nothing else will be read.
+	def cancel(self):
+		self.cancelled.set()
@@ -0,0 +1,30 @@
+import os
+
+# Maximum number of tasks waiting in the pool for each worker process.
+# The arguments and results of the pending tasks are kept in memory.
+PENDING_PER_PROCESS = 2
+
+# Returns the number of worker processes to use when none is requested.
+def defaultProcesses():
+	return os.cpu_count() or 1
+
+# Calls function(*arguments) for each tuple of arguments in a pool of processes, and
+# yields the results as they finish, in any order. The arguments are taken from the
+# iterable lazily, so that at most PENDING_PER_PROCESS tasks per process are in flight.
+def imapUnordered(function, argumentsIterable, processes=None):
+	import concurrent.futures
+	processes = processes or defaultProcesses()
+	with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+		pending = set()
+		for arguments in argumentsIterable:
+
+			# Wait for some task to finish when too many are in flight.
+			if len(pending) >= processes * PENDING_PER_PROCESS:
+				done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					yield future.result()
+			pending.add(executor.submit(function, *arguments))
+
+		# Wait for the rest.
+		for future in concurrent.futures.wait(pending).done:
+			yield future.result()
@@ -0,0 +1,74 @@
+import hashlib
+import math
+
+import utils
+
+numpy = utils.lazyImport('numpy')
+
+# A key scatters the hidden data across the whole image: the header and the payload are
+# written into the channels in a pseudo-random order, instead of from the first one on.
+# The order is a permutation of the channels, computed with a Feistel network whose
+# round keys are drawn from a NumPy generator seeded with the key. The position of any
+# channel in the order is computed on its own, so only the channels that hold the data
+# are ever computed, in chunks, instead of permuting every channel of the image.
+
+# The key is stretched with PBKDF2 into the seed of the generator, so that guessing it is slow.
+KEY_SALT = b'lsb-scatter'
+KEY_ITERATIONS = 100000
+
+# Number of rounds of the Feistel network.
+ROUNDS = 4
+
+# Odd constant that mixes the bits of each half in the round function, and shift that keeps
+# the high half of the product.
+MIX_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_SHIFT = 32
+
+# Returns the order in which the data is scattered across numChannels channels for the key
+# (a string or bytes), or None if there is no key and the data is written in sequence.
+def keyedOrder(key, numChannels):
+	if key == None:
+		return None
+	if isinstance(key, str):
+		key = key.encode('utf-8')
+	seed = hashlib.pbkdf2_hmac('sha256', key, KEY_SALT, KEY_ITERATIONS)
+	generator = numpy.random.default_rng(int.from_bytes(seed, 'big'))
+
+	# The network permutes the pairs of halves (high, low) with both halves below the same
+	# modulus, the smallest one whose square covers every channel.
+	return {
+		'numChannels': numChannels,
+		'modulus': math.isqrt(max(numChannels - 1, 0)) + 1,
+		'roundKeys': generator.integers(0, 1 << 64, ROUNDS, dtype=numpy.uint64, endpoint=False),
+	}
+
+# Returns the channels at the positions [start, stop) of the order, as an array of indices.
+# Like a slice, the positions past the last channel are left out.
+def channelIndices(order, start, stop):
+	if order == None:
+		return numpy.arange(start, stop)
+	stop = max(min(stop, order['numChannels']), start)
+
+	# Values outside the channels are permuted again until they land inside them (cycle walking).
+	# This keeps the permutation one to one, and it is rare, since the network permutes
+	# less than 2 * sqrt(numChannels) values more than there are channels.
+	indices = permute(order, numpy.arange(start, stop, dtype=numpy.uint64))
+	outside = numpy.flatnonzero(indices >= order['numChannels'])
+	while len(outside) > 0:
+		indices[outside] = permute(order, indices[outside])
+		outside = outside[indices[outside] >= order['numChannels']]
+	return indices.astype(numpy.int64)
+
+# Runs the values through the rounds of the Feistel network. Each round swaps the halves of
+# the values and adds a keyed hash of one of them to the other, which can always be undone.
+def permute(order, values):
+	modulus = numpy.uint64(order['modulus'])
+	high, low = values // modulus, values % modulus
+	for roundKey in order['roundKeys']:
+		high, low = low, (high + roundHash(low, roundKey)) % modulus
+	return high * modulus + low
+
+# Hashes the values with the key of a round: the high bits of a multiplication by an odd
+# constant depend on every bit of the value.
+def roundHash(values, roundKey):
+	return ((values ^ roundKey) * numpy.uint64(MIX_MULTIPLIER)) >> numpy.uint64(HASH_SHIFT)
@@ -0,0 +1,267 @@
+import os
+import tempfile
+
+import carriers
+import compression
+import container
+import encode
+import decode
+import pool
+import utils
+
+# Reads the message in msgFilename and splits it across the images in carrierFilenames
+# (a list of filenames, or a directory), using the capacity of each image in order
+# until the whole message fits. Each shard is encoded in a pool of processes and stored
+# in outputDirectory. Every shard records the ID of the transfer, its index and the
+# number of shards, so that they can be decoded in any order with decodeShardsAlgorithm.
+# All the shards are written by the same backend: the one that writes the first carrier,
+# and the carriers that it cannot write are skipped.
+def encodeShardsAlgorithm(carrierFilenames, msgFilename, outputDirectory, bitsPerChannel=1, compress=None, processes=None):
+
+	# Check the encoding options and find the carriers.
+	if encode.checkOptions(bitsPerChannel, compress) != utils.ERROR_OK:
+		return utils.ERROR_OPTIONS
+	if isinstance(carrierFilenames, str):
+		try:
+			carrierFilenames = carriers.listFiles(carrierFilenames)
+		except OSError as exception:
+			utils.log(exception)
+			return utils.ERROR_OPEN
+
+	# Open the message file in binary mode.
+	messageFile = utils.openBinaryFile(msgFilename, 'rb')
+	if messageFile == None:
+		utils.log('ERROR: there was a problem reading the message from the provided file')
+		return utils.ERROR_READ_MSG
+
+	with messageFile:
+
+		# Get the payload as a file, so that each shard can be read from it. A compressed
+		# payload is spooled to a temporary file first, to know its length.
+		payloadFile = encode.spoolPayload(messageFile, compress)
+		if payloadFile == None:
+			utils.log('ERROR: there was a problem reading the message from the provided file')
+			return utils.ERROR_READ_MSG
+
+		# Decide which part of the payload goes inside each carrier.
+		extensions = payloadFile['extensions']
+		extensions.update(container.layoutExtensions(bitsPerChannel))
+		output = shardBackend(carrierFilenames)
+		shards = planShards(carrierFilenames, output, payloadFile['length'], extensions, bitsPerChannel)
+		if shards == None:
+			utils.log('ERROR: the images are not big enough to fit the message')
+			return utils.ERROR_MSG_TOO_LARGE
+		utils.log('The message is split across {} images'.format(len(shards)))
+
+		# Encode the shards in parallel.
+		transferId = os.urandom(16)
+		try:
+			os.makedirs(outputDirectory, exist_ok=True)
+			return runShards(shards, output, payloadFile['file'], transferId, extensions, outputDirectory, bitsPerChannel, processes)
+		finally:
+			if payloadFile['file'] is not messageFile:
+				payloadFile['file'].close()
+
+
+# Returns the name of the backend that writes the shards: the one of the first carrier that
+# can be opened, or None if there is none.
+def shardBackend(carrierFilenames):
+	for carrierFilename in carrierFilenames:
+		carrier = carriers.openCarrier(carrierFilename)
+		if carrier != None:
+			carriers.closeCarrier(carrier)
+			return carrier['output']
+	return None
+
+
+# Assigns consecutive parts of a payload of payloadLength bytes to the carriers, in order,
+# reading only the header of each carrier to get its capacity once written by the output
+# backend. Returns a list with the carrier, offset and length of each shard, or None if the
+# carriers are not big enough.
+def planShards(carrierFilenames, output, payloadLength, extensions, bitsPerChannel):
+	headerExtensions = dict(extensions)
+	headerExtensions.update(container.shardExtensions(bytes(16), 0, 0, 0))
+	payloadChannel = len(container.packHeader(0, 0, extensions=headerExtensions)) * 8
+
+	shards = []
+	offset = 0
+	for carrierFilename in carrierFilenames:
+		if offset >= payloadLength and len(shards) > 0:
+			break
+		carrier = carriers.openCarrier(carrierFilename)
+		if carrier == None or not carriers.canWrite(carrier, output):
+			utils.log('Skipping carrier {}, it cannot be written as {}'.format(carrierFilename, output))
+			continue
+		carriers.closeCarrier(carrier)
+		numChannels = carriers.outputChannels(carrier, output)
+		if numChannels <= payloadChannel:
+			utils.log('Skipping image {}, it cannot hold a shard'.format(carrierFilename))
+			continue
+		length = min((numChannels - payloadChannel) * bitsPerChannel // 8, payloadLength - offset)
+		shards.append({'carrier': carrierFilename, 'offset': offset, 'length': length})
+		offset += length
+	if offset < payloadLength or len(shards) == 0:
+		return None
+	return shards
+
+
+# Encodes the shards in a pool of processes, reading the payload of each one from
+# payloadFile right before it is submitted, so that only a bounded number of shards
+# are held in memory. Returns the first error found, or ERROR_OK.
+def runShards(shards, output, payloadFile, transferId, extensions, outputDirectory, bitsPerChannel, processes):
+
+	# Build the arguments of each shard, with its own header extensions, as they are needed.
+	def shardArguments():
+		for index, shard in enumerate(shards):
+			shardExtensions = dict(extensions)
+			shardExtensions.update(container.shardExtensions(transferId, index, len(shards), shard['offset']))
+			outputFilename = os.path.join(outputDirectory, shardFilename(transferId, index, output))
+			yield shard['carrier'], output, outputFilename, payloadFile.read(shard['length']), shardExtensions, bitsPerChannel, utils.silent
+
+	error = utils.ERROR_OK
+	for shardError in pool.imapUnordered(encodeShard, shardArguments(), processes):
+		if error == utils.ERROR_OK:
+			error = shardError
+	return error
+
+
+# Returns the name of the carrier that holds a shard of the transfer, written by the output backend.
+def shardFilename(transferId, index, output):
+	return '{}_{:04d}{}'.format(transferId.hex()[:12], index, carriers.BACKENDS[output]['extensions'][0])
+
+
+# Encodes one shard inside the carrier, prepared for the output backend, and saves it into
+# outputFilename. This runs inside a worker process of the pool.
+def encodeShard(carrierFilename, output, outputFilename, data, extensions, bitsPerChannel, silent):
+	utils.silent = silent
+
+	# Open the carrier and get its samples.
+	carrier = carriers.openCarrier(carrierFilename)
+	if carrier == None:
+		utils.log('ERROR: could not open the image {}'.format(carrierFilename))
+		return utils.ERROR_OPEN
+	carrier = carriers.prepareCarrier(carrier, output)
+	if carrier == None:
+		utils.log('ERROR: could not decode the image {}'.format(carrierFilename))
+		return utils.ERROR_CONVERSION
+	array = carriers.readSamples(carrier)
+	if array is None or not utils.isArrayEmbeddable(array):
+		utils.log('ERROR: could not extract pixels from image {}'.format(carrierFilename))
+		return utils.ERROR_EXTRACT_PIXELS
+
+	payload = {'chunks': [data], 'length': len(data), 'extensions': extensions}
+	return encode.encodeWithArray(carrier, array, payload, outputFilename, bitsPerChannel)
+
+
+# Decodes the shards hidden in imgFilenames (a list of filenames, or a directory), in any
+# order, in a pool of processes, and writes the reassembled message into msgFilename.
+# If some shards of the transfer are missing, they are reported and nothing is written.
+def decodeShardsAlgorithm(imgFilenames, msgFilename, processes=None):
+	if isinstance(imgFilenames, str):
+		try:
+			imgFilenames = carriers.listFiles(imgFilenames)
+		except OSError as exception:
+			utils.log(exception)
+			return utils.ERROR_OPEN
+
+	# The payload is written at the offset of each shard as soon as it arrives.
+	# A compressed payload goes to a temporary file, and is decompressed at the end.
+	payloadFile = None
+	transfer = None
+	received = set()
+	error = utils.ERROR_OK
+	try:
+		for shardError, shard in pool.imapUnordered(decodeShard, [(imgFilename, utils.silent) for imgFilename in imgFilenames], processes):
+			if error != utils.ERROR_OK:
+				continue
+			if shardError != utils.ERROR_OK:
+				error = shardError
+				continue
+
+			# All the shards must belong to the same transfer.
+			if transfer == None:
+				transfer = shard
+				payloadFile = openPayloadFile(shard['codec'], msgFilename)
+				if payloadFile == None:
+					error = utils.ERROR_SAVE_MSG
+					continue
+			elif (shard['transferId'], shard['count'], shard['codec']) != (transfer['transferId'], transfer['count'], transfer['codec']):
+				utils.log('ERROR: the images belong to different messages')
+				error = utils.ERROR_EXTRACT_MSG
+				continue
+
+			# Write the payload of the shard at its position, once.
+			if shard['index'] not in received:
+				payloadFile.seek(shard['offset'])
+				payloadFile.write(shard['data'])
+				received.add(shard['index'])
+
+		# Check that no shard is missing.
+		if error == utils.ERROR_OK and transfer == None:
+			utils.log('ERROR: no images were provided')
+			error = utils.ERROR_EXTRACT_MSG
+		if error == utils.ERROR_OK:
+			missing = sorted(set(range(transfer['count'])) - received)
+			if len(missing) > 0:
+				utils.log('ERROR: missing {} of {} shards: {}'.format(len(missing), transfer['count'], ', '.join(str(index) for index in missing)))
+				error = utils.ERROR_MISSING_SHARDS
+
+		# Decompress the payload into the message file when needed.
+		if error == utils.ERROR_OK and transfer['codec'] != compression.CODEC_NONE:
+			payloadFile.seek(0)
+			secretMessage = {'chunks': utils.readChunks(payloadFile), 'checksum': None, 'codec': transfer['codec']}
+			error = decode.writeSecretMessage(secretMessage, msgFilename)
+	except Exception as exception:
+		utils.log(exception)
+		error = utils.ERROR_SAVE_MSG
+	finally:
+		if payloadFile != None:
+			payloadFile.close()
+
+	# Do not leave a partial message behind.
+	if error != utils.ERROR_OK and transfer != None and transfer['codec'] == compression.CODEC_NONE:
+		try:
+			os.remove(msgFilename)
+		except OSError:
+			pass
+	return error
+
+
+# Opens the file where the payload of the shards is reassembled: the message file
+# itself, or a temporary file if the payload has to be decompressed afterwards.
+def openPayloadFile(codec, msgFilename):
+	if codec != compression.CODEC_NONE:
+		return tempfile.TemporaryFile()
+	return utils.openBinaryFile(msgFilename, 'wb')
+
+
+# Finds the shard hidden inside the carrier and returns an error code and a dictionary
+# with the position of the shard, the codec of the payload and the verified payload.
+# This runs inside a worker process of the pool.
+def decodeShard(imgFilename, silent):
+	utils.silent = silent
+
+	# Open the carrier and get its samples.
+	carrier = carriers.openCarrier(imgFilename)
+	if carrier == None:
+		utils.log('ERROR: could not open the image {}'.format(imgFilename))
+		return utils.ERROR_OPEN, None
+	array = carriers.readSamples(carrier)
+	carriers.closeCarrier(carrier)
+	if array is None or not utils.isArrayEmbeddable(array):
+		utils.log('ERROR: could not extract pixels from image {}'.format(imgFilename))
+		return utils.ERROR_EXTRACT_PIXELS, None
+
+	# Find the shard and verify its payload.
+	secretMessage = decode.findSecretMessageInArray(array)
+	shard = None if secretMessage == None else container.shard(secretMessage['extensions'])
+	if shard == None:
+		utils.log('ERROR: no shard was found inside the image {}'.format(imgFilename))
+		return utils.ERROR_EXTRACT_MSG, None
+	try:
+		shard['data'] = b''.join(container.verifyChunks(secretMessage['chunks'], secretMessage['checksum']))
+	except ValueError as exception:
+		utils.log('ERROR: {} in image {}'.format(exception, imgFilename))
+		return utils.ERROR_EXTRACT_MSG, None
+	shard['codec'] = secretMessage['codec']
+	return utils.ERROR_OK, shard
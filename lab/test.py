@@ -1,18 +1,47 @@
 import unittest
 from filecmp import cmp
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import wave
 
-from encode import encodeAlgorithm
-from decode import decodeAlgorithm
+import numpy
+
+from encode import encodeAlgorithm, encodeWithArray, encodeWithPixelList, encodeMessageInArray, bytesToContainer, preparePayload
+from shard import encodeShardsAlgorithm, decodeShardsAlgorithm
+import batch
+import cache
+import capacity
+import carriers
+import cipher
+import fec
+import instrument
+import jobs
+import pipe
+import pngwriter
+import scatter
+import strips
+import worker
+from decode import decodeAlgorithm, decodeRangeAlgorithm, extractSecretMessageFromArray, findSecretMessage, findSecretMessageInArray, RowChannels, SCAN_CHUNK_BYTES
+import container
 import utils
 
 
+# Job that encodes an image and returns the error code and the name of the output.
+def encodeJob(imgFilename, msgFilename, outputFilename):
+	return encodeAlgorithm(imgFilename, msgFilename, outputFilename), outputFilename
+
+
 class TestImages(unittest.TestCase):
 
 	# This function will perform compression, then decompression.
 	# If compression or decompression fails, it will fail.
 	# If both go well, it will assert equality between the initial and the decoded messages.
-	def runCompleteTest(self, imageFile, msgFile):
+	def runCompleteTest(self, imageFile, msgFile, bitsPerChannel=1, compress=None):
 
 		# Remove garbage files if they are present
 		try:
@@ -25,7 +54,7 @@ class TestImages(unittest.TestCase):
 			pass
 		
 		# Execute the tests.
-		self.assertEqual(encodeAlgorithm(imageFile, msgFile, utils.DEFAULT_ENCODE_OUTPUT), utils.ERROR_OK)
+		self.assertEqual(encodeAlgorithm(imageFile, msgFile, utils.DEFAULT_ENCODE_OUTPUT, bitsPerChannel, compress), utils.ERROR_OK)
 		self.assertEqual(decodeAlgorithm(utils.DEFAULT_ENCODE_OUTPUT, utils.DEFAULT_DECODE_OUTPUT), utils.ERROR_OK)
 		self.assertTrue(cmp(msgFile, utils.DEFAULT_DECODE_OUTPUT))
 
@@ -78,9 +107,592 @@ class TestImages(unittest.TestCase):
 		utils.silent = True
 		self.assertEqual(encodeAlgorithm('test_files/png_8l.png', 'test_files/txt_utf8.txt', utils.DEFAULT_ENCODE_OUTPUT), utils.ERROR_MSG_TOO_LARGE)
 
+	# Test that several bits per channel raise the capacity of the image.
+	def test_MULTI_BIT(self):
+		utils.silent = True
+		self.assertEqual(encodeAlgorithm('test_files/png_8l.png', 'test_files/txt_utf8.txt', utils.DEFAULT_ENCODE_OUTPUT, 3), utils.ERROR_MSG_TOO_LARGE)
+		self.runCompleteTest('test_files/png_8l.png', 'test_files/txt_utf8.txt', 4)
+		for bitsPerChannel in [2, 3]:
+			self.runCompleteTest('test_files/png_8rgb.png', 'test_files/txt_utf8.txt', bitsPerChannel)
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', utils.DEFAULT_ENCODE_OUTPUT, 5), utils.ERROR_OPTIONS)
+
+	# Test that the array engine writes exactly the same PNG as the list of pixels, which
+	# only sees the 8 high bits of 16-bit images.
+	def test_ENGINES_IDENTICAL(self):
+		utils.silent = True
+		for imageFile in ['test_files/png_8l.png', 'test_files/png_8rgb.png', 'test_files/png_16rgba.png']:
+			image = utils.openImage(imageFile)
+			array = numpy.array(image) if utils.isDeepImage(image) else utils.extractArrayFromImage(image)
+			with open('test_files/txt_ascii.txt', 'rb') as messageFile:
+				self.assertEqual(encodeWithArray(carriers.imageCarrier(image), array, preparePayload(messageFile), 'array.png'), utils.ERROR_OK)
+			with open('test_files/txt_ascii.txt', 'rb') as messageFile:
+				self.assertEqual(encodeWithPixelList(image, preparePayload(messageFile), 'pixels.png'), utils.ERROR_OK)
+			self.assertTrue(cmp('array.png', 'pixels.png', shallow=False))
+			os.remove('array.png')
+			os.remove('pixels.png')
+
+	# Test that the pool of jobs runs a job, and rejects jobs when its queue is full.
+	def test_JOB_POOL(self):
+		utils.silent = True
+		events = []
+		jobPool = jobs.JobPool(1, 0, events.append)
+		jobId = jobPool.submit('encode', encodeJob, 'test_files/png_8rgb.png', 'test_files/txt_ascii.txt', 'job.png')
+		self.assertIsNone(jobPool.submit('encode', encodeJob, 'test_files/png_8rgb.png', 'test_files/txt_ascii.txt', 'job.png'))
+		jobPool.shutdown()
+		self.assertEqual(jobPool.status(jobId)['state'], jobs.STATE_DONE)
+		self.assertEqual(events[0]['state'], jobs.STATE_QUEUED)
+		self.assertEqual(events[-1]['state'], jobs.STATE_DONE)
+		os.remove('job.png')
+
+		# A job that cannot be handed to the worker processes fails, and frees its place in the queue.
+		jobId = jobPool.submit('encode', encodeJob, 'test_files/png_8rgb.png', 'test_files/txt_ascii.txt', 'job.png')
+		self.assertEqual(jobPool.status(jobId), {'id': jobId, 'name': 'encode', 'state': jobs.STATE_FAILED, 'error': utils.ERROR_JOB})
+		self.assertEqual(jobPool.numActive, 0)
+		self.assertFalse(os.path.exists('job.png'))
+
+	# Test that the images encoded in strips of rows hold the same values as the ones encoded whole.
+	def test_STRIPS(self):
+		utils.silent = True
+		for imageFile, bitsPerChannel in [('test_files/png_8rgb.png', 1), ('test_files/png_8rgb.png', 3), ('test_files/png_8l.png', 4)]:
+			self.assertEqual(encodeAlgorithm(imageFile, 'test_files/txt_utf8.txt', 'whole.png', bitsPerChannel), utils.ERROR_OK)
+			self.assertEqual(encodeAlgorithm(imageFile, 'test_files/txt_utf8.txt', 'strips.png', bitsPerChannel, stream=True), utils.ERROR_OK)
+			self.assertTrue(numpy.array_equal(numpy.array(utils.openImage('whole.png')), numpy.array(utils.openImage('strips.png'))))
+			self.assertEqual(decodeAlgorithm('strips.png', utils.DEFAULT_DECODE_OUTPUT), utils.ERROR_OK)
+			self.assertTrue(cmp('test_files/txt_utf8.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+		self.assertEqual(encodeAlgorithm('test_files/png_8l.png', 'test_files/txt_utf8.txt', 'strips.png', stream=True), utils.ERROR_MSG_TOO_LARGE)
+		os.remove('whole.png')
+		os.remove('strips.png')
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+
+		# The rows of a strip are unfiltered the same along the diagonals of their pixels as one by one.
+		generator = numpy.random.default_rng(0)
+		filters = ([pngwriter.FILTER_PAETH] * 35 + [pngwriter.FILTER_AVERAGE, pngwriter.FILTER_PAETH] * 20 + [pngwriter.FILTER_SUB, pngwriter.FILTER_UP, pngwriter.FILTER_NONE, pngwriter.FILTER_AVERAGE]) * 2
+		for width, bytesPerPixel in [(40, 1), (100, 3), (50, 4), (10, 2)]:
+			data = generator.integers(0, 256, (len(filters), width * bytesPerPixel), dtype=numpy.uint8)
+			previous = generator.integers(0, 256, width * bytesPerPixel, dtype=numpy.uint8)
+			rows = strips.unfilterRows(filters, data, previous, bytesPerPixel)
+			for index in range(len(filters)):
+				previous = strips.unfilterRow(filters[index], data[index].tobytes(), previous, bytesPerPixel)
+				self.assertTrue(numpy.array_equal(rows[index], previous))
+		self.assertRaises(ValueError, strips.unfilterRows, [5], data[:1], previous, bytesPerPixel)
+
+	# Test that the capacity read from the header of an image is exactly what fits inside it,
+	# and that the index of a directory picks the smallest image where a message fits.
+	def test_CAPACITY(self):
+		utils.silent = True
+		bits = capacity.imageCapacity('test_files/png_8l.png')
+		for bitsPerChannel in [1, 3]:
+			for length, error in [(bits[bitsPerChannel] // 8, utils.ERROR_OK), (bits[bitsPerChannel] // 8 + 1, utils.ERROR_MSG_TOO_LARGE)]:
+				self.assertEqual(encodeAlgorithm('test_files/png_8l.png', io.BytesIO(bytes(length)), io.BytesIO(), bitsPerChannel), error)
+
+		shutil.rmtree('carriers', ignore_errors=True)
+		os.mkdir('carriers')
+		for name in ['png_8l.png', 'png_8rgb.png', 'jpg_small.jpg']:
+			shutil.copy('test_files/' + name, 'carriers')
+		index = capacity.loadIndex('carriers')
+		self.assertTrue(os.path.exists(os.path.join('carriers', capacity.INDEX_FILENAME)))
+		self.assertEqual(capacity.smallestCarrier(index, 100), os.path.join('carriers', 'png_8l.png'))
+		self.assertEqual(capacity.smallestCarrier(index, bits[1] // 8 + 1), os.path.join('carriers', 'png_8rgb.png'))
+		self.assertEqual(capacity.smallestCarrier(capacity.loadIndex('carriers'), 10 ** 6, 4), os.path.join('carriers', 'jpg_small.jpg'))
+		self.assertIsNone(capacity.smallestCarrier(index, 10 ** 7))
+		shutil.rmtree('carriers')
+
+	# Test that the cache of results counts hits and misses, and removes the least recently used results.
+	# Its keys depend on its secret, which survives restarts.
+	def test_RESULT_CACHE(self):
+		utils.silent = True
+		shutil.rmtree('results', ignore_errors=True)
+		resultCache = cache.ResultCache('results', 10)
+		keys = [resultCache.key('encode', bytes([index]), b'message', 1, None) for index in range(3)]
+		self.assertEqual(len(set(keys)), 3)
+		self.assertNotEqual(resultCache.key('encode', b'ab', b'c'), resultCache.key('encode', b'a', b'bc'))
+		self.assertNotEqual(keys[0], cache.resultKey(bytes(cache.SECRET_BYTES), 'encode', bytes([0]), b'message', 1, None))
+		self.assertEqual(cache.ResultCache('results', 10).key('encode', bytes([0]), b'message', 1, None), keys[0])
+		self.assertEqual(os.stat(os.path.join('results', cache.SECRET_NAME)).st_mode & 0o777, 0o600)
+		self.assertIsNone(resultCache.lookup(keys[0]))
+		resultCache.put(keys[0], b'0000', '.png')
+		resultCache.put(keys[1], b'1111', '.png')
+		self.assertEqual(resultCache.lookup(keys[0]), keys[0] + '.png')
+		resultCache.put(keys[2], b'2222', '.png')
+		self.assertIsNone(resultCache.lookup(keys[1]))
+		self.assertEqual(resultCache.stats()['hits'], 1)
+		self.assertEqual(resultCache.stats()['misses'], 2)
+		self.assertEqual(resultCache.stats()['evictions'], 1)
+		self.assertEqual(sorted(os.listdir('results')), sorted([cache.SECRET_NAME, keys[0] + '.png', keys[2] + '.png']))
+		for name in ['stale', 'live']:
+			with open(os.path.join('results', cache.PARTIAL_PREFIX + name), 'wb') as partialFile:
+				partialFile.write(b'3')
+		staleTime = os.stat(os.path.join('results', cache.PARTIAL_PREFIX + 'stale')).st_mtime - cache.STALE_PARTIAL_SECONDS
+		os.utime(os.path.join('results', cache.PARTIAL_PREFIX + 'stale'), (staleTime, staleTime))
+		self.assertEqual(cache.ResultCache('results', 10).stats()['bytes'], 8)
+		self.assertEqual(sorted(os.listdir('results')), sorted([cache.SECRET_NAME, cache.PARTIAL_PREFIX + 'live', keys[0] + '.png', keys[2] + '.png']))
+		os.remove(os.path.join('results', cache.PARTIAL_PREFIX + 'live'))
+
+		# Results can be stored as they are produced, and file objects give the key of their bytes.
+		self.assertEqual(resultCache.key('decode', io.BytesIO(b'0000'), None), resultCache.key('decode', b'0000', None))
+		partial = resultCache.begin(keys[1], '.png')
+		self.assertTrue(partial.write(b'11') and partial.write(b'11'))
+		self.assertIsNone(resultCache.filename(keys[1]))
+		self.assertEqual(partial.commit(), keys[1] + '.png')
+		self.assertEqual(resultCache.lookup(keys[1]), keys[1] + '.png')
+		partial = resultCache.begin(keys[0], '.bin')
+		self.assertFalse(partial.write(bytes(11)))
+		self.assertIsNone(partial.commit())
+		self.assertEqual(len(os.listdir('results')), 3)
+		shutil.rmtree('results')
+
+	# Test that JPEG images are decoded into the same pixels as through a PNG, and that they
+	# can be reduced to fit inside a maximum size.
+	def test_JPEG_DECODE(self):
+		utils.silent = True
+		image = utils.openImage('test_files/jpg_small.jpg')
+		buffer = io.BytesIO()
+		image.save(buffer, format=utils.PNG_FORMAT)
+		self.assertTrue(numpy.array_equal(numpy.array(utils.decodeImage(image)), numpy.array(utils.openImage(buffer))))
+		encoded = io.BytesIO()
+		self.assertEqual(encodeAlgorithm('test_files/jpg_big.jpg', 'test_files/txt_ascii.txt', encoded, maxSize=(300, 200)), utils.ERROR_OK)
+		width, height = utils.openImage(encoded).size
+		self.assertTrue(width <= 300 and height <= 200)
+		decoded = io.BytesIO()
+		self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded), utils.ERROR_OK)
+		with open('test_files/txt_ascii.txt', 'rb') as messageFile:
+			self.assertEqual(decoded.getvalue(), messageFile.read())
+		self.assertEqual(encodeAlgorithm('test_files/jpg_big.jpg', 'test_files/txt_ascii.txt', io.BytesIO(), maxSize=(0, 200)), utils.ERROR_OPTIONS)
+
+	# Test that the PNG writer keeps the values with every filter, that its default preset
+	# writes the same image as PIL, and that the encoded images decode with every preset.
+	def test_PNG_WRITER(self):
+		utils.silent = True
+		generator = numpy.random.default_rng(0)
+		for mode, array in [('L', generator.integers(0, 256, (31, 17), dtype=numpy.uint8)), ('RGBA', generator.integers(0, 256, (9, 40, 4), dtype=numpy.uint8)), ('I;16', generator.integers(0, 65536, (12, 7), dtype=numpy.uint16))]:
+			for filter in pngwriter.FILTER_NAMES:
+				output = io.BytesIO()
+				self.assertEqual(pngwriter.saveArray(output, mode, (array.shape[1], array.shape[0]), array, pngwriter.writerOptions(level=3, filter=filter)), 0)
+				self.assertTrue(numpy.array_equal(numpy.array(utils.openImage(output)), array))
+		for preset in pngwriter.PRESETS:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', encoded, pngOptions=pngwriter.writerOptions(preset)), utils.ERROR_OK)
+			self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), utils.DEFAULT_DECODE_OUTPUT), utils.ERROR_OK)
+			self.assertTrue(cmp('test_files/txt_ascii.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+			if preset == pngwriter.DEFAULT_PRESET:
+				default = io.BytesIO()
+				encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', default)
+				self.assertEqual(encoded.getvalue(), default.getvalue())
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', io.BytesIO(), pngOptions=pngwriter.writerOptions('fastest')), utils.ERROR_OPTIONS)
+
+	# Test that 16-bit images keep their depth, and hide up to 8 bits in each channel.
+	def test_DEEP_CARRIER(self):
+		utils.silent = True
+		image = utils.openImage('test_files/png_16rgba.png')
+		self.assertEqual(utils.bitDepth(image), 16)
+		original = utils.extractArrayFromImage(image)
+		self.assertEqual(original.dtype, numpy.uint16)
+		for bitsPerChannel in [1, 8]:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm('test_files/png_16rgba.png', 'test_files/txt_utf8.txt', encoded, bitsPerChannel), utils.ERROR_OK)
+			array = utils.extractArrayFromImage(utils.openImage(io.BytesIO(encoded.getvalue())))
+			self.assertEqual(array.dtype, numpy.uint16)
+			self.assertTrue(numpy.array_equal(array >> bitsPerChannel, original >> bitsPerChannel))
+			self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), utils.DEFAULT_DECODE_OUTPUT), utils.ERROR_OK)
+			self.assertTrue(cmp('test_files/txt_utf8.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+		self.assertEqual(list(capacity.imageCapacity('test_files/png_16rgb.png')), list(range(1, 9)))
+		self.assertEqual(list(capacity.imageCapacity('test_files/png_8rgb.png')), list(range(1, 5)))
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', io.BytesIO(), 5), utils.ERROR_OPTIONS)
+
+	# Test that a key scatters the message across the whole image, in an order that is a
+	# permutation of the channels, and that the message is only found with the same key.
+	def test_SCATTERED_KEY(self):
+		utils.silent = True
+		order = scatter.keyedOrder('key', 1000)
+		indices = scatter.channelIndices(order, 0, 1000)
+		self.assertTrue(numpy.array_equal(numpy.sort(indices), numpy.arange(1000)))
+		self.assertTrue(numpy.array_equal(scatter.channelIndices(order, 100, 200), indices[100:200]))
+		for imageFile, bitsPerChannel in [('test_files/png_8rgb.png', 1), ('test_files/png_16rgb.png', 6)]:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm(imageFile, 'test_files/txt_utf8.txt', encoded, bitsPerChannel, key='key'), utils.ERROR_OK)
+			for key, error in [('key', utils.ERROR_OK), ('other key', utils.ERROR_EXTRACT_MSG), (None, utils.ERROR_EXTRACT_MSG)]:
+				decoded = io.BytesIO()
+				self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, key), error)
+			with open('test_files/txt_utf8.txt', 'rb') as messageFile:
+				self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, 'key'), utils.ERROR_OK)
+				self.assertEqual(decoded.getvalue(), messageFile.read())
+
+		# The channels that changed are spread over every part of the image.
+		original = utils.extractArrayFromImage(utils.openImage(imageFile)).reshape(-1)
+		changed = numpy.flatnonzero(original != utils.extractArrayFromImage(utils.openImage(io.BytesIO(encoded.getvalue()))).reshape(-1))
+		self.assertTrue(numpy.all(numpy.histogram(changed, bins=100, range=(0, original.size))[0] > 0))
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', io.BytesIO(), key=''), utils.ERROR_OPTIONS)
+
+	# Test that an encrypted message records the parameters of its key in the header, is only
+	# decoded with its passphrase, and fails on the first record that does not match its tag.
+	@unittest.skipUnless(cipher.isAvailable(), 'the cryptography package is not installed')
+	def test_ENCRYPTION(self):
+		utils.silent = True
+		for compress in [None, 'auto']:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm('test_files/png_HDrgba.png', 'test_files/txt_ascii_huge.txt', encoded, compress=compress, passphrase='passphrase'), utils.ERROR_OK)
+			for passphrase, error in [('passphrase', utils.ERROR_OK), ('other passphrase', utils.ERROR_EXTRACT_MSG), (None, utils.ERROR_EXTRACT_MSG)]:
+				decoded = io.BytesIO()
+				self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, passphrase=passphrase), error)
+			with open('test_files/txt_ascii_huge.txt', 'rb') as messageFile:
+				self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, passphrase='passphrase'), utils.ERROR_OK)
+				self.assertEqual(decoded.getvalue(), messageFile.read())
+		secretMessage = findSecretMessageInArray(utils.extractArrayFromImage(utils.openImage(io.BytesIO(encoded.getvalue()))))
+		self.assertEqual(secretMessage['cipher']['log2Cost'], cipher.KDF_LOG2_COST)
+
+		# Records that are changed or dropped are detected.
+		parameters = cipher.newParameters()
+		message = os.urandom(cipher.RECORD_SIZE * 2 + 10)
+		records = list(cipher.encryptChunks([message], 'passphrase', parameters))
+		self.assertEqual(sum(len(record) for record in records), cipher.encryptedLength(len(message)))
+		self.assertEqual(b''.join(cipher.decryptChunks(records, 'passphrase', parameters)), message)
+		tampered = bytearray(records[0])
+		tampered[100] ^= 1
+		decrypted = cipher.decryptChunks([bytes(tampered)] + records[1:], 'passphrase', parameters)
+		self.assertRaises(ValueError, next, decrypted)
+		self.assertRaises(ValueError, b''.join, cipher.decryptChunks(records[:2], 'passphrase', parameters))
+
+	# Test that a message protected by an error correcting code is decoded even after bits of
+	# the image are flipped, in runs and anywhere, and that the corrected bits are reported.
+	def test_ERROR_CORRECTION(self):
+		utils.silent = True
+		with open('test_files/txt_utf8.txt', 'rb') as messageFile:
+			message = messageFile.read()
+		for parity, key in [(32, None), (16, 'key')]:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_utf8.txt', encoded, 2, key=key, parity=parity), utils.ERROR_OK)
+			image = utils.openImage(io.BytesIO(encoded.getvalue()))
+			array = utils.extractArrayFromImage(image)
+
+			# Flip bits of the header and of the payload: the payload starts after the codeword of the header.
+			channels = array.reshape(-1)
+			hiddenChannels = fec.CODEWORD_SIZE * 8 + fec.encodedLength(len(message), parity) * 4
+			flipped = numpy.concatenate([numpy.arange(0, fec.CODEWORD_SIZE * 8, 80), numpy.arange(5000, 5100), numpy.random.default_rng(0).choice(numpy.arange(5100, hiddenChannels), 200, replace=False)])
+			order = scatter.keyedOrder(key, channels.size)
+			channels[scatter.channelIndices(order, 0, hiddenChannels)[flipped] if key != None else flipped] ^= 1
+			damaged = io.BytesIO()
+			self.assertEqual(pngwriter.saveArray(damaged, image.mode, image.size, array), 0)
+			decoded = io.BytesIO()
+			stats = {}
+			self.assertEqual(decodeAlgorithm(io.BytesIO(damaged.getvalue()), decoded, key, stats=stats), utils.ERROR_OK)
+			self.assertEqual(decoded.getvalue(), message)
+			self.assertEqual(stats['correctedBits'], len(flipped))
+
+		# Without the code, the same damage fails the checksum.
+		encoded = io.BytesIO()
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_utf8.txt', encoded, 2), utils.ERROR_OK)
+		array = utils.extractArrayFromImage(utils.openImage(io.BytesIO(encoded.getvalue())))
+		array.reshape(-1)[5000:5100] ^= 1
+		self.assertIsNone(extractSecretMessageFromArray(array))
+
+		# Codewords with up to half as many wrong bytes as parity bytes are corrected, and more are detected.
+		data = os.urandom(fec.DEFAULT_DEPTH * 300)
+		encoder = fec.Encoder(fec.DEFAULT_PARITY)
+		codewords = bytearray(encoder.encode(data) + encoder.flush())
+		self.assertEqual(len(codewords), fec.encodedLength(len(data), fec.DEFAULT_PARITY))
+		codewords[:fec.DEFAULT_DEPTH * fec.DEFAULT_PARITY // 2] = bytes(fec.DEFAULT_DEPTH * fec.DEFAULT_PARITY // 2)
+		corrections = {}
+		self.assertEqual(b''.join(fec.decodeChunks([bytes(codewords)], len(data), corrections=corrections)), data)
+		self.assertGreater(corrections['bits'], 0)
+		codewords[:fec.DEFAULT_DEPTH * (fec.DEFAULT_PARITY // 2 + 1)] = bytes(fec.DEFAULT_DEPTH * (fec.DEFAULT_PARITY // 2 + 1))
+		self.assertRaises(ValueError, b''.join, fec.decodeChunks([bytes(codewords)], len(data)))
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', io.BytesIO(), parity=255), utils.ERROR_OPTIONS)
+
+	# Test that an image encoded into a pipe is read as it is written, whole, and that the
+	# encoder stops once the reader is gone.
+	def test_PIPE(self):
+		utils.silent = True
+		encoded = io.BytesIO()
+		self.assertEqual(encodeAlgorithm('test_files/png_HDrgba.png', 'test_files/txt_utf8.txt', encoded), utils.ERROR_OK)
+		imagePipe = pipe.Pipe().start(lambda output: encodeAlgorithm('test_files/png_HDrgba.png', 'test_files/txt_utf8.txt', output))
+		self.assertEqual(b''.join(imagePipe), encoded.getvalue())
+		self.assertEqual(imagePipe.result, utils.ERROR_OK)
+
+		# A reader that goes away stops the writer, without exceptions escaping its thread,
+		# even when bytes are still waiting to be handed.
+		unhandled = []
+		previousHook = threading.excepthook
+		threading.excepthook = unhandled.append
+		try:
+			for pieceBytes in [pipe.PIECE_BYTES, pipe.PIECE_BYTES // 3]:
+				def writeForever(output):
+					while True:
+						output.write(bytes(pieceBytes))
+				imagePipe = pipe.Pipe().start(writeForever)
+				self.assertGreater(len(imagePipe.read()), 0)
+				imagePipe.cancel()
+				imagePipe.thread.join(10)
+				self.assertFalse(imagePipe.thread.is_alive())
+				self.assertIsInstance(imagePipe.exception, BrokenPipeError)
+				self.assertIsNone(imagePipe.read())
+		finally:
+			threading.excepthook = previousHook
+		self.assertEqual(unhandled, [])
+
+	# Test that ranges of the message are read without decoding it whole, whatever the way it was hidden.
+	def test_RANGE(self):
+		utils.silent = True
+		message = os.urandom(100000)
+		for options in [{}, {'bitsPerChannel': 3}, {'compress': 'zlib'}, {'passphrase': 'passphrase'}, {'key': 'key'}, {'parity': 16}]:
+			encoded = io.BytesIO()
+			self.assertEqual(encodeAlgorithm('test_files/png_16rgb.png', io.BytesIO(message), encoded, options.get('bitsPerChannel', 1), options.get('compress'),
+				key=options.get('key'), passphrase=options.get('passphrase'), parity=options.get('parity')), utils.ERROR_OK)
+			for offset, length in [(0, 100), (40000, 40000), (99990, 100), (150000, 10)]:
+				decoded = io.BytesIO()
+				stats = {}
+				self.assertEqual(decodeRangeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, offset, length, options.get('key'), options.get('passphrase'), stats), utils.ERROR_OK)
+				self.assertEqual(decoded.getvalue(), message[offset : offset + length])
+				self.assertIn(stats['length'], [len(message), None])
+
+		# Finding the header of a message hidden in sequence only decodes the first rows.
+		encoded = io.BytesIO()
+		self.assertEqual(encodeAlgorithm('test_files/png_HDrgba.png', io.BytesIO(message), encoded), utils.ERROR_OK)
+		channels = RowChannels(encoded, utils.openImage(encoded))
+		secretMessage = findSecretMessage(channels)
+		self.assertEqual(secretMessage['length'], len(message))
+		self.assertLess(len(channels.values), len(channels) // 4)
+		self.assertEqual(secretMessage['read'](50000, 100), message[50000:50100])
+		self.assertEqual(decodeRangeAlgorithm(encoded, io.BytesIO(), 0, 10, passphrase='passphrase'), utils.ERROR_OK)
+		self.assertEqual(decodeRangeAlgorithm(encoded, io.BytesIO(), -1, 10), utils.ERROR_OPTIONS)
+
+	# Test that a message survives each backend of the carriers: images written in the format of
+	# the extension of the output, and 16-bit sounds, which keep the format of the input.
+	def test_CARRIERS(self):
+		utils.silent = True
+		message = os.urandom(2000)
+		for imageFile in ['test_files/png_8l.png', 'test_files/png_16rgba.png', 'test_files/jpg_small.jpg']:
+			for name, backend in carriers.BACKENDS.items():
+				if name == 'wav':
+					continue
+				outputFile = 'carrier' + backend['extensions'][0]
+				self.assertEqual(encodeAlgorithm(imageFile, io.BytesIO(message), outputFile, 2), utils.ERROR_OK)
+				self.assertEqual(utils.openImage(outputFile).format, backend['format'])
+				decoded = io.BytesIO()
+				self.assertEqual(decodeAlgorithm(outputFile, decoded), utils.ERROR_OK)
+				self.assertEqual(decoded.getvalue(), message)
+				os.remove(outputFile)
+
+		# The carriers inside a directory are listed whatever their backend.
+		os.makedirs('listed', exist_ok=True)
+		for extension in ['.bmp', '.JPG', '.tiff', '.txt', '.wav', '.webp', '.png']:
+			open(os.path.join('listed', 'carrier' + extension), 'wb').close()
+		self.assertEqual(carriers.listFiles('listed'), [os.path.join('listed', 'carrier' + extension) for extension in ['.JPG', '.bmp', '.png', '.tiff', '.wav', '.webp']])
+		shutil.rmtree('listed')
+
+		# A stereo sound holds up to 8 bits of each sample, and is not written as an image.
+		sound = io.BytesIO()
+		with wave.open(sound, 'wb') as writer:
+			writer.setnchannels(2)
+			writer.setsampwidth(2)
+			writer.setframerate(8000)
+			writer.writeframes(numpy.random.default_rng(0).integers(-32768, 32768, (4000, 2)).astype('<i2').tobytes())
+		sound.seek(0)
+		self.assertEqual(capacity.readImageInfo(sound)['channels'], 8000)
+		encoded = io.BytesIO()
+		self.assertEqual(encodeAlgorithm(sound, io.BytesIO(message), encoded, 8, key='key'), utils.ERROR_OK)
+		self.assertEqual(carriers.extensionOfBytes(encoded.getvalue()), '.wav')
+		decoded = io.BytesIO()
+		self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded, 'key'), utils.ERROR_OK)
+		self.assertEqual(decoded.getvalue(), message)
+		self.assertEqual(encodeAlgorithm(sound, io.BytesIO(message), 'carrier.png'), utils.ERROR_NOT_SUPPORTED)
+		self.assertFalse(os.path.exists('carrier.png'))
+
+	# Test that the stages of a round trip are recorded as spans only while there is a sink.
+	def test_INSTRUMENT(self):
+		utils.silent = True
+		with instrument.recording(instrument.MemorySink()) as sink:
+			self.runCompleteTest('test_files/png_8rgb.png', 'test_files/txt_utf8.txt', 2)
+		spans = sink.totals()
+		for name in ['encode', 'encode.open', 'encode.read', 'encode.pack', 'encode.embed', 'encode.save', 'decode', 'decode.find', 'decode.write']:
+			self.assertIn(name, spans)
+		self.assertGreaterEqual(spans['encode'], spans['encode.save'])
+		prometheus = instrument.PrometheusSink()
+		for entry in sink.records:
+			prometheus.record(entry['span'], entry['seconds'], entry['attributes'])
+		self.assertIn('lsb_span_seconds_count{span="encode"} 1', prometheus.render())
+		self.runCompleteTest('test_files/png_8rgb.png', 'test_files/txt_utf8.txt', 2)
+		self.assertEqual(len(sink.records), sum(prometheus.histograms[name]['count'] for name in spans))
+
 	# TODO: test a non JPEG and non PNG image.
 
-	# TODO: test decode with an image that does not contain a message hidden.
+	# Test that images and messages given as file objects are encoded and decoded in memory.
+	def test_IN_MEMORY(self):
+		utils.silent = True
+		with open('test_files/txt_utf8.txt', 'rb') as messageFile:
+			message = messageFile.read()
+		for imageFile in ['test_files/jpg_small.jpg', 'test_files/png_8rgb.png']:
+			with open(imageFile, 'rb') as image:
+				encoded = io.BytesIO()
+				self.assertEqual(encodeAlgorithm(io.BytesIO(image.read()), io.BytesIO(message), encoded, 2), utils.ERROR_OK)
+			self.assertTrue(encoded.getvalue().startswith(b'\x89PNG'))
+			decoded = io.BytesIO()
+			self.assertEqual(decodeAlgorithm(io.BytesIO(encoded.getvalue()), decoded), utils.ERROR_OK)
+			self.assertEqual(decoded.getvalue(), message)
+		self.assertEqual(encodeAlgorithm(io.BytesIO(message), io.BytesIO(message), io.BytesIO()), utils.ERROR_OPEN)
+
+	# Test that a message containing the format token survives the round trip.
+	def test_TOKEN_IN_MESSAGE(self):
+		utils.silent = True
+		message = ('before ' + utils.FORMAT_TOKEN + ' after').encode('utf-8')
+		array = numpy.zeros((100, 100), dtype=numpy.uint8)
+		encodeMessageInArray(array, bytesToContainer(message))
+		self.assertEqual(extractSecretMessageFromArray(array), message)
+
+	# Test that a message whose checksum does not match is rejected.
+	def test_CORRUPTED_MESSAGE(self):
+		utils.silent = True
+		array = numpy.zeros((100, 100), dtype=numpy.uint8)
+		encodeMessageInArray(array, bytesToContainer(b'some secret message'))
+		array[-1, 0:1000] ^= 1
+		self.assertEqual(extractSecretMessageFromArray(array), b'some secret message')
+		array.reshape(-1)[container.HEADER_SIZE * 8 + 3] ^= 1
+		self.assertEqual(extractSecretMessageFromArray(array), None)
+
+	# Test that images framed with the legacy format tokens can still be decoded,
+	# including an end token split between two scanned chunks.
+	def test_LEGACY_TOKENS(self):
+		utils.silent = True
+		binaryToken = utils.FORMAT_TOKEN.encode('utf-8')
+		for message in [b'legacy message', b'a' * (SCAN_CHUNK_BYTES - 2)]:
+			array = numpy.zeros((SCAN_CHUNK_BYTES * 3, 8), dtype=numpy.uint8)
+			encodeMessageInArray(array, binaryToken + message + binaryToken)
+			self.assertEqual(extractSecretMessageFromArray(array), message)
+
+	# Test that compression fits messages that would not fit otherwise, with every codec.
+	def test_COMPRESSION(self):
+		utils.silent = True
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii_huge.txt', utils.DEFAULT_ENCODE_OUTPUT), utils.ERROR_MSG_TOO_LARGE)
+		for compress in ['auto', 'zlib', 'lzma', 'bz2']:
+			self.runCompleteTest('test_files/png_8rgb.png', 'test_files/txt_ascii_huge.txt', 1, compress)
+		self.runCompleteTest('test_files/png_8l.png', 'test_files/txt_utf8.txt', 3, 'auto')
+		self.assertEqual(encodeAlgorithm('test_files/png_8rgb.png', 'test_files/txt_ascii.txt', utils.DEFAULT_ENCODE_OUTPUT, 1, 'zip'), utils.ERROR_OPTIONS)
+
+	# Test a message split across several images, decoded in any order.
+	def test_SHARDS(self):
+		utils.silent = True
+		carrierFiles = ['test_files/png_8l.png', 'test_files/png_8rgb.png', 'test_files/png_16rgba.png', 'test_files/png_HDrgba.png']
+		self.assertEqual(encodeShardsAlgorithm(carrierFiles[:2], 'test_files/txt_ascii_huge.txt', 'shards', processes=2), utils.ERROR_MSG_TOO_LARGE)
+		self.assertEqual(encodeShardsAlgorithm('test_files/missing', 'test_files/txt_ascii.txt', 'shards', processes=2), utils.ERROR_OPEN)
+		self.assertEqual(decodeShardsAlgorithm('test_files/missing', utils.DEFAULT_DECODE_OUTPUT, processes=2), utils.ERROR_OPEN)
+		for compress in [None, 'auto']:
+			shutil.rmtree('shards', ignore_errors=True)
+			self.assertEqual(encodeShardsAlgorithm(carrierFiles, 'test_files/txt_ascii_huge.txt', 'shards', compress=compress, processes=2), utils.ERROR_OK)
+			shards = carriers.listFiles('shards')
+			self.assertEqual(len(shards), 3 if compress == None else 2)
+			self.assertEqual(decodeShardsAlgorithm(list(reversed(shards)), utils.DEFAULT_DECODE_OUTPUT, processes=2), utils.ERROR_OK)
+			self.assertTrue(cmp('test_files/txt_ascii_huge.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+			os.remove(utils.DEFAULT_DECODE_OUTPUT)
+			self.assertEqual(decodeShardsAlgorithm(shards[1:], utils.DEFAULT_DECODE_OUTPUT, processes=2), utils.ERROR_MISSING_SHARDS)
+			self.assertFalse(os.path.exists(utils.DEFAULT_DECODE_OUTPUT))
+		shutil.rmtree('shards')
+
+		# The shards are all written by the backend of the first carrier, whatever the others,
+		# which are converted to a mode it stores.
+		os.makedirs('shards')
+		utils.openImage('test_files/png_8rgb.png').save('shards/carrier.bmp')
+		carrierFiles = ['shards/carrier.bmp', 'test_files/png_8rgb.png', 'test_files/png_16rgba.png']
+		self.assertEqual(encodeShardsAlgorithm(carrierFiles, 'test_files/txt_ascii_huge.txt', 'shards/encoded', processes=2), utils.ERROR_OK)
+		shards = carriers.listFiles('shards/encoded')
+		self.assertEqual(len(shards), 3)
+		for shard in shards:
+			self.assertEqual(os.path.splitext(shard)[1], '.bmp')
+			self.assertEqual(utils.openImage(shard).format, 'BMP')
+		self.assertEqual(decodeShardsAlgorithm(shards, utils.DEFAULT_DECODE_OUTPUT, processes=2), utils.ERROR_OK)
+		self.assertTrue(cmp('test_files/txt_ascii_huge.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+		shutil.rmtree('shards')
+
+		# Sounds are split into shards and decoded back like images.
+		os.makedirs('shards')
+		generator = numpy.random.default_rng(0)
+		for index in range(2):
+			with wave.open('shards/carrier{}.wav'.format(index), 'wb') as writer:
+				writer.setnchannels(2)
+				writer.setsampwidth(2)
+				writer.setframerate(8000)
+				writer.writeframes(generator.integers(-32768, 32768, (4000, 2)).astype('<i2').tobytes())
+		with open('shards/message.bin', 'wb') as messageFile:
+			messageFile.write(os.urandom(15000))
+		self.assertEqual(encodeShardsAlgorithm('shards', 'shards/message.bin', 'shards/encoded', 8, processes=2), utils.ERROR_OK)
+		shards = carriers.listFiles('shards/encoded')
+		self.assertEqual([os.path.splitext(shard)[1] for shard in shards], ['.wav', '.wav'])
+		self.assertEqual(decodeShardsAlgorithm('shards/encoded', utils.DEFAULT_DECODE_OUTPUT, processes=2), utils.ERROR_OK)
+		self.assertTrue(cmp('shards/message.bin', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+		shutil.rmtree('shards')
+
+	# Test a batch of images encoded and decoded in a pool, and resumed.
+	def test_BATCH(self):
+		utils.silent = True
+		shutil.rmtree('batch', ignore_errors=True)
+		self.assertIsNone(batch.itemsFromDirectory(batch.MODE_ENCODE, 'test_files/missing', 'test_files/txt_utf8.txt', 'batch/encoded'))
+		items = batch.itemsFromDirectory(batch.MODE_ENCODE, 'test_files', 'test_files/txt_utf8.txt', 'batch/encoded')
+		results = batch.batchAlgorithm(batch.MODE_ENCODE, items, processes=2, compress='auto')
+		self.assertEqual(results, {utils.ERROR_OK: 7, utils.ERROR_MSG_TOO_LARGE: 1})
+		self.assertFalse(os.path.exists('batch/encoded/png_8l.png'))
+		self.assertEqual(batch.batchAlgorithm(batch.MODE_ENCODE, items, processes=2, resume=True, compress='auto'), {utils.ERROR_MSG_TOO_LARGE: 1})
+		items = batch.itemsFromDirectory(batch.MODE_DECODE, 'batch/encoded', None, 'batch/decoded')
+		self.assertEqual(batch.batchAlgorithm(batch.MODE_DECODE, items, processes=2), {utils.ERROR_OK: 7})
+		for imgFilename, msgFilename in items:
+			self.assertTrue(cmp('test_files/txt_utf8.txt', msgFilename, shallow=False))
+		shutil.rmtree('batch')
+
+		# Each carrier of a directory is encoded in its own format, and JPEG images as PNG.
+		os.makedirs('batch/carriers')
+		utils.openImage('test_files/png_8rgb.png').save('batch/carriers/image.bmp')
+		shutil.copy('test_files/jpg_small.jpg', 'batch/carriers/photo.jpg')
+		with wave.open('batch/carriers/sound.wav', 'wb') as writer:
+			writer.setnchannels(1)
+			writer.setsampwidth(2)
+			writer.setframerate(8000)
+			writer.writeframes(numpy.random.default_rng(0).integers(-32768, 32768, 20000).astype('<i2').tobytes())
+		items = batch.itemsFromDirectory(batch.MODE_ENCODE, 'batch/carriers', 'test_files/txt_ascii.txt', 'batch/encoded')
+		self.assertEqual([os.path.basename(outputFilename) for imgFilename, msgFilename, outputFilename in items], ['image.bmp', 'photo.png', 'sound.wav'])
+		self.assertEqual(batch.batchAlgorithm(batch.MODE_ENCODE, items, processes=2), {utils.ERROR_OK: 3})
+		items = batch.itemsFromDirectory(batch.MODE_DECODE, 'batch/encoded', None, 'batch/decoded')
+		self.assertEqual(batch.batchAlgorithm(batch.MODE_DECODE, items, processes=2), {utils.ERROR_OK: 3})
+		for imgFilename, msgFilename in items:
+			self.assertTrue(cmp('test_files/txt_ascii.txt', msgFilename, shallow=False))
+		shutil.rmtree('batch')
+
+	# Test that a worker serves requests read as JSON lines in order, and rejects the ones that are not valid.
+	def test_WORKER(self):
+		utils.silent = True
+		requests = [
+			{'id': 1, 'mode': 'encode', 'image': 'test_files/png_8rgb.png', 'message': 'test_files/txt_utf8.txt', 'output': 'worker.png', 'options': {'bitsPerChannel': 2, 'parity': 16}},
+			{'id': 2, 'mode': 'decode', 'image': 'worker.png', 'output': utils.DEFAULT_DECODE_OUTPUT},
+			{'id': 3, 'mode': 'decode', 'image': 'worker.png', 'output': utils.DEFAULT_DECODE_OUTPUT, 'options': {'bitsPerChannel': 2}},
+		]
+		output = io.StringIO()
+		self.assertEqual(worker.serve(io.StringIO('\n'.join(json.dumps(request) for request in requests) + '\nnot json\n'), output), 0)
+		responses = [json.loads(line) for line in output.getvalue().splitlines()]
+		self.assertEqual([(response['id'], response['error']) for response in responses], [(1, utils.ERROR_OK), (2, utils.ERROR_OK), (3, utils.ERROR_OPTIONS), (None, utils.ERROR_OPTIONS)])
+		self.assertEqual(responses[1]['correctedBits'], 0)
+		self.assertTrue(cmp('test_files/txt_utf8.txt', utils.DEFAULT_DECODE_OUTPUT, shallow=False))
+		os.remove('worker.png')
+		os.remove(utils.DEFAULT_DECODE_OUTPUT)
+
+	# Test that the command line prints its help without loading NumPy nor PIL.
+	def test_LAZY_IMPORTS(self):
+		script = 'import sys; sys.argv = ["lab.py", "--help"]; import lab; lab.main(); print("numpy._core" in sys.modules or "numpy.core" in sys.modules, "PIL.PngImagePlugin" in sys.modules)'
+		result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+		self.assertEqual(result.stdout.split()[-2:], ['False', 'False'])
+
+	# Test a binary message, bigger than one chunk, with every byte value.
+	def test_PNG_BINARY(self):
+		utils.silent = True
+		with open('binary.bin', 'wb') as file:
+			file.write(bytes(range(256)) * 1000 + os.urandom(utils.CHUNK_SIZE))
+		self.runCompleteTest('test_files/png_HDrgba.png', 'binary.bin')
+		os.remove('binary.bin')
+
+	# Test decode with an image that does not contain a message hidden.
+	def test_NO_MESSAGE(self):
+		utils.silent = True
+		self.assertEqual(decodeAlgorithm('test_files/png_8rgb.png', utils.DEFAULT_DECODE_OUTPUT), utils.ERROR_EXTRACT_MSG)
+		self.assertFalse(os.path.exists(utils.DEFAULT_DECODE_OUTPUT))
 
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
@@ -1,18 +1,48 @@
-from PIL import Image
+import importlib
+import sys
+
+# Returns the module with the given name, which is only loaded the first time one of its
+# attributes is used. NumPy and PIL take most of the time needed to start, and they are
+# not needed to parse the command line, print the help or report a wrong argument.
+def lazyImport(name):
+	if name in sys.modules:
+		return sys.modules[name]
+	return LazyModule(name)
+
+# Stands for a module until one of its attributes is used, and then imports it and hands
+# out its attributes. The import goes through the import lock of Python, so that threads
+# using the module at once for the first time all wait for it to be complete (the
+# LazyLoader of importlib hands half-loaded modules to the other threads before 3.12).
+class LazyModule:
+
+	def __init__(self, name):
+		self.name = name
+		self.module = None
+
+	def __getattr__(self, attribute):
+		if self.module == None:
+			self.module = importlib.import_module(self.name)
+		return getattr(self.module, attribute)
+
+numpy = lazyImport('numpy')
+Image = lazyImport('PIL.Image')
 
 # Error codes of the module.
 ERROR_OK = 0 # Everything went well.
-ERROR_NOT_SUPPORTED = 1 # The image file type is not supported (not PNG nor JPEG).
-ERROR_CONVERSION = 2 # Could not convert from JPEG to PNG.
+ERROR_NOT_SUPPORTED = 1 # The image file type is not supported (see carriers.py).
+ERROR_CONVERSION = 2 # Could not decode the image to store it as PNG.
 ERROR_OPEN = 3 # Could not open the image.
 ERROR_READ_MSG = 4 # Could not read message from the provided file.
-ERROR_STR_TO_BIN = 5 # Could not convert the message string to binary format.
+ERROR_STR_TO_BIN = 5 # Could not convert the message to binary format.
 ERROR_EXTRACT_PIXELS = 6 # Could not extract the pixels from the image.
 ERROR_ENCODING = 7 # Could not encode the message inside the list of pixels.
 ERROR_SAVE_IMG = 8 # Could not save pixels to the new image.
 ERROR_EXTRACT_MSG = 9 # Could not extract a valid message from the pixels of the image.
 ERROR_SAVE_MSG = 10 # Could not save the extracted secret message to a file.
 ERROR_MSG_TOO_LARGE = 11 # Could not encode the message inside the image. The message is too long.
+ERROR_OPTIONS = 12 # The encoding options provided are not valid.
+ERROR_MISSING_SHARDS = 13 # Some of the images of a message split across several images are missing.
+ERROR_JOB = 14 # The worker process running a job failed.
 
 # Some default filenames for testing purposes.
 DEFAULT_ENCODE_OUTPUT = 'encoded.png'
@@ -22,31 +52,103 @@ DEFAULT_DECODE_OUTPUT = 'secret.txt'
 JPEG_EXTENSIONS = ['.jpg', '.jpeg', '.jpe', '.JPG', '.JPEG', '.JPE']
 PNG_EXTENSIONS = ['.png', '.PNG']
 
+# Formats of the images as reported by PIL.
+JPEG_FORMAT = 'JPEG'
+PNG_FORMAT = 'PNG'
+
+# Modes of PIL that PNG images can store without converting them.
+PNG_MODES = ['1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA']
+
+# PIL opens 16-bit RGB and RGBA PNG images as 8-bit, keeping the most significant byte of
+# each value through these raw modes. The raw modes paired with them keep the least
+# significant byte instead, so that decoding the image twice gives its 16-bit values.
+DEEP_RAW_MODES = {'RGB;16B': 'RGB;16L', 'RGBA;16B': 'RGBA;16L'}
+
+# Number of bits of each channel of the modes of PIL that do not have 8 bits.
+MODE_BIT_DEPTHS = {'1': 1, 'I': 32, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'F': 32}
+
+# Number of bytes of a message that are read, written or processed at a time.
+CHUNK_SIZE = 1 << 16
+
 # Decides if the program outputs logs to the terminal (normal mode)
 # or is silent (unit testing mode).
 silent = False
 
-# Define the beginning and end format tokens.
+# Levels of the logs. Only the logs at logLevel or above are output. Errors (the logs
+# that start with 'ERROR' and the exceptions) are at LOG_ERROR unless a level is given.
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_ERROR = 40
+LOG_LEVELS = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'error': LOG_ERROR}
+logLevel = LOG_INFO
+
+# Define the beginning and end format tokens used by images encoded before
+# the container header (see container.py). They are only read, never written.
 FORMAT_TOKEN = '$$$$$'
 
-# Reads data from a file and returns it as a string.
-def readStringFromFile(filename):
+# Decides if a file was given as a file object instead of a filename.
+def isFileObject(file):
+	return hasattr(file, 'read') or hasattr(file, 'write')
+
+# Opens a file in the binary mode provided and returns the file object.
+# A file object is returned as it is.
+def openBinaryFile(filename, mode):
+	if isFileObject(filename):
+		return filename
 	try:
-		with open(filename, 'r') as file:
-			return file.read()
+		return open(filename, mode)
 	except Exception as exception:
 		log(exception)
 		return None
 
-# Writes a string into a file.
-def writeStringToFile(string, filename):
+# Closes a file opened with openBinaryFile, unless it was given as a file object.
+def closeBinaryFile(file, filename):
+	if file is not filename:
+		file.close()
+
+# Returns the number of bytes left to read in a binary file object.
+def fileLength(file):
 	try:
-		with open(filename, 'w') as file:
-			file.write(string)
-			return 0
+		position = file.tell()
+		length = file.seek(0, 2) - position
+		file.seek(position)
+		return length
 	except Exception as exception:
 		log(exception)
-		return -1
+		return None
+
+# Reads a binary file object in chunks of at most chunkSize bytes.
+def readChunks(file, chunkSize=None):
+	chunkSize = chunkSize or CHUNK_SIZE
+	while True:
+		chunk = file.read(chunkSize)
+		if not chunk:
+			return
+		yield chunk
+
+# Regroups an iterable of chunks of any size into chunks of exactly chunkSize bytes,
+# except the last one, which may be shorter.
+def rechunk(chunks, chunkSize):
+	buffer = bytearray()
+	for chunk in chunks:
+		buffer += chunk
+		while len(buffer) >= chunkSize:
+			yield bytes(buffer[:chunkSize])
+			del buffer[:chunkSize]
+	if buffer:
+		yield bytes(buffer)
+
+# Reads up to size bytes from the current position of a binary file object
+# without consuming them. Returns None if the file cannot be read.
+def peekFile(file, size):
+	try:
+		position = file.tell()
+		sample = file.read(size)
+		file.seek(position)
+		return sample
+	except Exception as exception:
+		log(exception)
+		return None
 
 # Opens an image object from file and returns it.
 def openImage(filename):
@@ -56,26 +158,49 @@ def openImage(filename):
 		log(exception)
 		return None
 
-# Saves the pixels provided into a new image.
-def saveImage(filename, mode, size, pixels):
+# Saves the pixels provided into a new image. Images saved into file objects are PNG.
+# The options, if given, are the keyword arguments of PIL that save the image.
+def saveImage(filename, mode, size, pixels, options=None):
 	try:
 		image = Image.new(mode, size)
 		image.putdata(pixels)
-		image.save(filename)
+		image.save(filename, **(options or {'format': PNG_FORMAT if isFileObject(filename) else None}))
 	except Exception as exception:
 		log(exception)
 		return -1
 	return 0
 
-# Converts an image from a file format to another.
-def convertImage(filenameFrom, filenameTo):
+# Saves the array of channel values provided into a new image. The array must have
+# the layout returned by extractArrayFromImage. Images saved into file objects are PNG.
+def saveArray(filename, mode, size, array):
 	try:
-		Image.open(filenameFrom).save(filenameTo)
+		image = Image.frombytes(mode, size, array.tobytes())
+		image.save(filename, format=PNG_FORMAT if isFileObject(filename) else None)
 	except Exception as exception:
 		log(exception)
 		return -1
 	return 0
 
+# Decodes the pixels of an image once, in memory, so that they can be stored losslessly as PNG.
+# When maxSize (width, height) is given, the image is reduced to fit inside it, keeping its
+# aspect ratio; JPEG images are then decoded straight at a reduced scale. Modes that PNG
+# cannot store, like CMYK, are converted to RGB. Returns the decoded image.
+# 16-bit RGB and RGBA PNG images are left for extractArrayFromImage, which decodes them
+# at their native depth, unless they are reduced.
+def decodeImage(image, maxSize=None):
+	try:
+		if maxSize == None and isDeepImage(image):
+			return image
+		if maxSize != None:
+			image.thumbnail(maxSize)
+		image.load()
+		if image.mode not in PNG_MODES:
+			image = image.convert('RGB')
+		return image
+	except Exception as exception:
+		log(exception)
+		return None
+
 # Extracts pixels from the provided image.
 def extractPixelsFromImage(image):
 	try:
@@ -84,10 +209,92 @@ def extractPixelsFromImage(image):
 		log(exception)
 		return None
 
-# Logs something to the terminal.
-def log(element):
-	if not silent:
-		print(element)
+# Extracts the channel values of the provided image as a NumPy array.
+# The array has shape (height, width) or (height, width, channels). The values of
+# 16-bit images are 16-bit, as long as the image was not loaded before.
+def extractArrayFromImage(image):
+	try:
+		if isDeepImage(image):
+			return extractDeepArray(image)
+		return numpy.array(image)
+	except Exception as exception:
+		log(exception)
+		return None
+
+# Decides if the image is a 16-bit RGB or RGBA PNG image that has not been loaded yet,
+# so that its 16-bit values can still be decoded.
+def isDeepImage(image):
+	return image.format == PNG_FORMAT and len(image.tile) == 1 and image.tile[0][3] in DEEP_RAW_MODES
+
+# Decodes a 16-bit image as an array of 16-bit values. PIL decodes the image twice from
+# its file: once for the least significant byte of each value, and once for the most
+# significant one. Both decodes run in C, with the filters of the 16-bit rows.
+def extractDeepArray(image):
+	codec, extents, offset, rawMode = image.tile[0][:4]
+	image.fp.seek(0)
+	low = Image.open(image.fp)
+	low.tile = [(codec, extents, offset, DEEP_RAW_MODES[rawMode])]
+	array = numpy.array(low).astype(numpy.uint16)
+	array |= numpy.array(image).astype(numpy.uint16) << 8
+	return array
+
+# Decides if the first rows of the image can be decoded without the others: PNG images that
+# are not interlaced and have 8 or 16 bits per channel, which PIL decodes row after row.
+def isRowDecodable(image):
+	return (image.format == PNG_FORMAT and len(image.tile) == 1 and image.tile[0][0] == 'zip'
+		and not image.info.get('interlace') and bitDepth(image) in (8, 16))
+
+# Decodes the rows [top, bottom) of a row decodable image that has not been loaded yet, as an
+# array like extractArrayFromImage. Rows are decoded in order and the decoder stops after the
+# last one: the rows below are never decoded. Returns None if the rows could not be decoded.
+def extractRowsFromImage(image, top, bottom):
+	try:
+		codec, extents, offset, rawMode = image.tile[0][:4]
+		region = (0, top, image.size[0], bottom)
+		image.tile = [(codec, (0, 0, image.size[0], bottom), offset, rawMode)]
+		if rawMode not in DEEP_RAW_MODES:
+			return numpy.array(image.crop(region))
+
+		# 16-bit values are decoded twice, like extractDeepArray.
+		image.fp.seek(0)
+		low = Image.open(image.fp)
+		low.tile = [(codec, (0, 0, image.size[0], bottom), offset, DEEP_RAW_MODES[rawMode])]
+		array = numpy.array(low.crop(region)).astype(numpy.uint16)
+		array |= numpy.array(image.crop(region)).astype(numpy.uint16) << 8
+		return array
+	except Exception as exception:
+		log(exception)
+		return None
+
+# Returns the number of bits of each channel of the image, reading only its header.
+def bitDepth(image):
+	if isDeepImage(image):
+		return 16
+	return MODE_BIT_DEPTHS.get(image.mode, 8)
+
+# Returns the number of bits of each channel of the values of the array.
+def arrayBitDepth(array):
+	return array.dtype.itemsize * 8
+
+# Decides if the array engine can embed in the provided array, i.e., if its
+# values are integers. Other arrays (bilevel or float images) use the pixel list.
+def isArrayEmbeddable(array):
+	return array.dtype.kind in ('u', 'i')
+
+# Logs something to the terminal. When arguments are given, the element is a format
+# string that is only formatted if the log is output, so that logs cost nothing when off.
+def log(element, *arguments, level=None):
+	if silent:
+		return
+	if level == None:
+		level = LOG_ERROR if isinstance(element, Exception) or str(element).startswith('ERROR') else LOG_INFO
+	if level < logLevel:
+		return
+	print(element.format(*arguments) if arguments else element)
+
+# Decides if the logs at the given level are output.
+def isLogging(level):
+	return not silent and level >= logLevel
 
 # Decides if the file extension corresponds to a JPEG image.
 def isJPEG(extension):
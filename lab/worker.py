@@ -0,0 +1,78 @@
+import json
+import time
+
+import batch
+import fec
+import utils
+
+# A worker serves many requests in one long-lived process, so that the modules, NumPy, PIL
+# and its codecs are loaded once instead of once per image. Each request is a JSON object
+# on its own line of the input, like:
+#	{"id": 1, "mode": "encode", "image": "in.png", "message": "msg.txt", "output": "out.png", "options": {"bitsPerChannel": 2}}
+#	{"id": 2, "mode": "decode", "image": "out.png", "output": "msg.txt", "options": {"key": "key"}}
+# and its result is written as a JSON object on its own line of the output, in the same order:
+#	{"id": 1, "error": 0, "seconds": 0.01}
+# The id is optional, and is only echoed back. Decoding also reports the correctedBits of a
+# message protected by an error correcting code.
+
+# Files of the requests of each mode, in the order of the items of a batch.
+REQUEST_FILES = {
+	batch.MODE_ENCODE: ['image', 'message', 'output'],
+	batch.MODE_DECODE: ['image', 'output'],
+}
+
+# Options of the encode and decode algorithms that a request may give.
+REQUEST_OPTIONS = {
+	batch.MODE_ENCODE: {'bitsPerChannel', 'compress', 'stream', 'maxSize', 'pngOptions', 'key', 'passphrase', 'parity'},
+	batch.MODE_DECODE: {'key', 'passphrase'},
+}
+
+# Serves the requests read from inputStream until it ends, writing their results into
+# outputStream as each one finishes. Nothing is logged, since the output holds the results.
+def serve(inputStream, outputStream):
+	utils.silent = True
+	warmUp()
+	for line in inputStream:
+		if line.strip() == '':
+			continue
+		start = time.perf_counter()
+		response = handleRequest(line)
+		response['seconds'] = time.perf_counter() - start
+		outputStream.write(json.dumps(response) + '\n')
+		outputStream.flush()
+	return 0
+
+# Runs the request held in a line of the input, and returns its result.
+def handleRequest(line):
+	try:
+		request = json.loads(line)
+	except ValueError:
+		request = None
+	if not isinstance(request, dict):
+		return {'id': None, 'error': utils.ERROR_OPTIONS}
+
+	# Check the files and options of the request.
+	mode = request.get('mode')
+	options = request.get('options', {})
+	response = {'id': request.get('id')}
+	if mode not in REQUEST_FILES or any(not isinstance(request.get(name), str) for name in REQUEST_FILES[mode]) or not isinstance(options, dict) or not set(options) <= REQUEST_OPTIONS[mode]:
+		response['error'] = utils.ERROR_OPTIONS
+		return response
+
+	# Run it as an item of a batch, so that its output only shows up once complete.
+	stats = {}
+	if mode == batch.MODE_DECODE:
+		options = dict(options, stats=stats)
+	try:
+		response['error'] = batch.runItem(mode, tuple(request[name] for name in REQUEST_FILES[mode]), options)[0]
+	except Exception:
+		response['error'] = utils.ERROR_JOB
+	response.update(stats)
+	return response
+
+# Loads what the first request would otherwise pay for: NumPy, the plugins of PIL and the
+# tables of the error correcting code.
+def warmUp():
+	utils.numpy.zeros(1)
+	utils.Image.init()
+	fec.productTable()
@@ -0,0 +1,295 @@
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+# Sends encode or decode requests to a running server, several at a time, and measures the
+# time to the first byte of each result, the time to the whole result, and the memory taken
+# by the server while they run. Start the server first (python application.py), then:
+#	python loadtest.py --mode encode-stream --requests 20 --concurrency 4 --pid <server pid>
+# The memory is sampled from /proc, for the server process and its children (the workers of
+# the jobs), so --pid only works with a server on the same Linux machine.
+
+# Address of the server when none is given.
+DEFAULT_URL = 'http://127.0.0.1:8081'
+
+# Image sent when none is given.
+DEFAULT_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lab', 'test_files', 'png_8rgb.png')
+
+# Ways of requesting a result: an encode job, an encoded image sent as it is written, and a
+# decode job. Decoding needs an image that holds a message, so its image is encoded first.
+MODES = ['encode', 'encode-stream', 'decode']
+
+# Seconds between two checks of the status of a job, and between two samples of the memory.
+POLL_SECONDS = 0.05
+SAMPLE_SECONDS = 0.05
+
+# Seconds without an answer from the server before a request fails.
+TIMEOUT_SECONDS = 120
+
+# Size in bytes of the pieces of an upload sent in chunks, and of the pieces of the result read.
+UPLOAD_CHUNK_BYTES = 64 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+
+
+# Runs the load test requested in the command line and prints its results as JSON.
+def main():
+	arguments = createParser().parse_args()
+	with open(arguments.image, 'rb') as imageFile:
+		imageData = imageFile.read()
+	if arguments.mode == 'decode':
+		imageData = encodeOnce(arguments.url, imageData, arguments.message_bytes)
+		if imageData == None:
+			print('ERROR: could not encode the image to decode', file=sys.stderr)
+			return 1
+
+	# Sample the memory of the server while the requests run.
+	sampler = MemorySampler(arguments.pid) if arguments.pid else None
+	if sampler != None:
+		sampler.start()
+	start = time.perf_counter()
+	runs = runRequests(arguments, imageData)
+	wall = time.perf_counter() - start
+	if sampler != None:
+		sampler.stop()
+
+	results = summarize(runs, wall, arguments)
+	if sampler != None:
+		results['memory'] = sampler.summary(arguments.concurrency)
+	json.dump(results, sys.stdout, indent=1)
+	print()
+	return 0 if results['errors'] == 0 else 1
+
+
+# Creates the parser of the command line arguments of the load test.
+def createParser():
+	parser = argparse.ArgumentParser(prog='loadtest.py', description='Measure the time to first byte and the memory of the server under concurrent encode and decode requests.')
+	parser.add_argument('--url', default=DEFAULT_URL, help='address of the server (default: {})'.format(DEFAULT_URL))
+	parser.add_argument('--mode', choices=MODES, default='encode-stream', help='kind of request (default: encode-stream)')
+	parser.add_argument('--image', default=DEFAULT_IMAGE, help='image sent with each request (default: a test image)')
+	parser.add_argument('--message-bytes', type=int, default=1024, help='length of the message of each encode request (default: 1024)')
+	parser.add_argument('--requests', type=int, default=20, help='number of requests (default: 20)')
+	parser.add_argument('--concurrency', type=int, default=4, help='number of requests sent at once (default: 4)')
+	parser.add_argument('--chunked', action='store_true', help='send the uploads in chunks, without their length')
+	parser.add_argument('--cached', action='store_true', help='send the same request each time, so that the server answers from its cache after the first one')
+	parser.add_argument('--pid', type=int, help='process of the server, whose memory and that of its children is sampled')
+	return parser
+
+
+# Sends the requests, concurrency at a time, and returns the measures of each one.
+def runRequests(arguments, imageData):
+	runs = []
+	lock = threading.Lock()
+	counter = iter(range(arguments.requests))
+	def work():
+		while True:
+			with lock:
+				index = next(counter, None)
+			if index == None:
+				return
+			run = runRequest(arguments, imageData, index)
+			with lock:
+				runs.append(run)
+	threads = [threading.Thread(target=work) for _ in range(arguments.concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return runs
+
+
+# Sends one request and reads its whole result. Returns the seconds to the first byte of the
+# result and to its end, its length and the HTTP status that failed it, if any.
+def runRequest(arguments, imageData, index):
+	fields = {}
+	if arguments.mode != 'decode':
+		# Each message differs, unless asked otherwise, so that the cache never answers.
+		suffix = '' if arguments.cached else ' {} {}'.format(index, uuid.uuid4().hex)
+		fields['message'] = ('x' * max(arguments.message_bytes - len(suffix), 0)) + suffix
+	path = '/encode?stream=1' if arguments.mode == 'encode-stream' else '/' + arguments.mode.split('-')[0]
+
+	start = time.perf_counter()
+	try:
+		status, response, connection = postForm(arguments.url, path, fields, imageData, arguments.chunked)
+
+		# A job answers with where to follow it: wait for it and then fetch its result.
+		if status == 202:
+			job = json.loads(response.read())
+			connection.close()
+			status = waitForJob(arguments.url, job['status'])
+			if status == 200:
+				status, response, connection = getUrl(arguments.url, job['result'])
+		if status != 200:
+			connection.close()
+			return {'error': status}
+		firstByte, length = readBody(response, start)
+		connection.close()
+	except (OSError, http.client.HTTPException, ValueError) as exception:
+		return {'error': str(exception)}
+	return {'error': None, 'ttfb': firstByte, 'total': time.perf_counter() - start, 'bytes': length}
+
+
+# Waits until the job whose status is at the path finishes. Returns 200 if it finished well.
+def waitForJob(url, path):
+	while True:
+		status, response, connection = getUrl(url, path)
+		job = json.loads(response.read())
+		connection.close()
+		if status != 200 or job['state'] == 'failed':
+			return status if status != 200 else 422
+		if job['state'] == 'done':
+			return 200
+		time.sleep(POLL_SECONDS)
+
+
+# Reads the body of a response in pieces. Returns the seconds from start to its first byte,
+# and its length.
+def readBody(response, start):
+	firstByte = None
+	length = 0
+	piece = response.read1(READ_CHUNK_BYTES)
+	while piece:
+		if firstByte == None:
+			firstByte = time.perf_counter() - start
+		length += len(piece)
+		piece = response.read1(READ_CHUNK_BYTES)
+	return firstByte, length
+
+
+# Posts a multipart form with the image as its file and the given fields, in chunks if
+# asked. Returns the status, the response and the connection, which the caller closes.
+def postForm(url, path, fields, imageData, chunked=False):
+	boundary = uuid.uuid4().hex
+	head = b''
+	for name, value in fields.items():
+		head += '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value).encode('utf-8')
+	head += '--{}\r\nContent-Disposition: form-data; name="file"; filename="image.png"\r\nContent-Type: image/png\r\n\r\n'.format(boundary).encode('utf-8')
+	tail = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+	headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+
+	connection = connect(url)
+	if chunked:
+		def body():
+			yield head
+			for offset in range(0, len(imageData), UPLOAD_CHUNK_BYTES):
+				yield imageData[offset : offset + UPLOAD_CHUNK_BYTES]
+			yield tail
+		connection.request('POST', path, body=body(), headers=headers, encode_chunked=True)
+	else:
+		connection.request('POST', path, body=head + imageData + tail, headers=headers)
+	response = connection.getresponse()
+	return response.status, response, connection
+
+
+# Gets the path from the server. Returns the status, the response and the connection.
+def getUrl(url, path):
+	connection = connect(url)
+	connection.request('GET', path)
+	response = connection.getresponse()
+	return response.status, response, connection
+
+
+# Opens a connection to the server at the URL.
+def connect(url):
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme == 'https':
+		return http.client.HTTPSConnection(parts.hostname, parts.port, timeout=TIMEOUT_SECONDS)
+	return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=TIMEOUT_SECONDS)
+
+
+# Encodes a message into the image through the server, to get an image to decode.
+# Returns the encoded image, or None if it failed.
+def encodeOnce(url, imageData, messageBytes):
+	try:
+		status, response, connection = postForm(url, '/encode?stream=1', {'message': 'x' * messageBytes}, imageData)
+		data = response.read()
+		connection.close()
+	except (OSError, http.client.HTTPException) as exception:
+		print(exception, file=sys.stderr)
+		return None
+	return data if status == 200 else None
+
+
+# Returns the median, 90th percentile and maximum of the values.
+def percentiles(values):
+	if len(values) == 0:
+		return None
+	ordered = sorted(values)
+	return {'median': statistics.median(ordered), 'p90': ordered[min(int(len(ordered) * 0.9), len(ordered) - 1)], 'max': ordered[-1]}
+
+
+# Returns the results of the runs, ready to be stored as JSON.
+def summarize(runs, wall, arguments):
+	done = [run for run in runs if run['error'] == None]
+	errors = [run['error'] for run in runs if run['error'] != None]
+	return {
+		'mode': arguments.mode,
+		'requests': len(runs),
+		'concurrency': arguments.concurrency,
+		'chunked': arguments.chunked,
+		'errors': len(errors),
+		'errorExamples': [str(error) for error in errors[:5]],
+		'ttfb': percentiles([run['ttfb'] for run in done if run['ttfb'] != None]),
+		'total': percentiles([run['total'] for run in done]),
+		'bytes': percentiles([run['bytes'] for run in done]),
+		'requestsPerSecond': len(done) / wall if wall > 0 else None,
+	}
+
+
+# Samples the resident memory of a process and of its children in a thread, and keeps the
+# highest total. The memory they had before the requests is the baseline.
+class MemorySampler:
+
+	def __init__(self, pid):
+		self.pid = pid
+		self.baseline = treeRss(pid)
+		self.peak = self.baseline
+		self.stopping = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopping.set()
+		self.thread.join()
+
+	def run(self):
+		while not self.stopping.is_set():
+			self.peak = max(self.peak, treeRss(self.pid))
+			time.sleep(SAMPLE_SECONDS)
+
+	# Returns the baseline and peak memory in KB, and the growth for each request running at
+	# once: with a concurrency of 1, the peak memory that a request takes.
+	def summary(self, concurrency):
+		return {'baselineKb': self.baseline, 'peakKb': self.peak, 'peakPerRequestKb': (self.peak - self.baseline) / max(concurrency, 1)}
+
+
+# Returns the resident memory in KB of a process and of all its descendants, read from /proc.
+def treeRss(pid):
+	total = 0
+	pending = [pid]
+	while pending:
+		current = pending.pop()
+		try:
+			with open('/proc/{}/status'.format(current), 'r') as status:
+				for line in status:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1])
+			taskDirectory = '/proc/{}/task'.format(current)
+			for task in os.listdir(taskDirectory):
+				with open(os.path.join(taskDirectory, task, 'children'), 'r') as children:
+					pending += [int(child) for child in children.read().split()]
+		except (OSError, ValueError):
+			continue
+	return total
+
+
+if __name__ == '__main__':
+	sys.exit(main())
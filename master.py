@@ -1,10 +1,61 @@
+import io
+import os
 import sys
-sys.path.append('./lab')
+
+# The modules of the algorithms live in lab/, next to this file, whatever the current directory.
+# NumPy and PIL are only loaded once an image is encoded or decoded (see utils.lazyImport).
+LAB_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lab')
+if LAB_DIRECTORY not in sys.path:
+	sys.path.append(LAB_DIRECTORY)
 from encode import encodeAlgorithm
-from decode import decodeAlgorithm
+from decode import decodeAlgorithm, decodeRangeAlgorithm
+from shard import encodeShardsAlgorithm, decodeShardsAlgorithm
+from jobs import JobPool
+from cache import ResultCache
+from pngwriter import writerOptions
+from pipe import Pipe
+import carriers
+import instrument
+import jobs
+import pngwriter
+import utils
+
+def encode(imgFilename, msgFilename, outputFilename, bitsPerChannel=1, compress=None, stream=False, maxSize=None, pngPreset=None, pngLevel=None, pngFilter=None, key=None, passphrase=None, parity=None):
+	return encodeAlgorithm(imgFilename, msgFilename, outputFilename, bitsPerChannel, compress, stream, maxSize, writerOptions(pngPreset, pngLevel, pngFilter), key, passphrase, parity)
+
+def decode(imgFilename, outputFilename, key=None, passphrase=None, stats=None):
+	return decodeAlgorithm(imgFilename, outputFilename, key, passphrase, stats)
+
+def decodeRange(imgFilename, outputFilename, offset, length, key=None, passphrase=None, stats=None):
+	return decodeRangeAlgorithm(imgFilename, outputFilename, offset, length, key, passphrase, stats)
+
+def encodeShards(carrierFilenames, msgFilename, outputDirectory, bitsPerChannel=1, compress=None, processes=None):
+	return encodeShardsAlgorithm(carrierFilenames, msgFilename, outputDirectory, bitsPerChannel, compress, processes)
+
+def decodeShards(imgFilenames, outputFilename, processes=None):
+	return decodeShardsAlgorithm(imgFilenames, outputFilename, processes)
+
+def encodeBytes(imageData, messageData, bitsPerChannel=1, compress=None, pngPreset=None, pngLevel=None, pngFilter=None, key=None, passphrase=None, parity=None):
+	output = io.BytesIO()
+	error = encodeAlgorithm(toFileObject(imageData), toFileObject(messageData), output, bitsPerChannel, compress, pngOptions=writerOptions(pngPreset, pngLevel, pngFilter), key=key, passphrase=passphrase, parity=parity)
+	return error, output.getvalue() if error == 0 else None
+
+def decodeBytes(imageData, key=None, passphrase=None):
+	output = io.BytesIO()
+	error = decodeAlgorithm(toFileObject(imageData), output, key, passphrase)
+	return error, output.getvalue() if error == 0 else None
+
+def decodeRangeBytes(imageData, offset, length, key=None, passphrase=None):
+	output = io.BytesIO()
+	stats = {}
+	error = decodeRangeAlgorithm(toFileObject(imageData), output, offset, length, key, passphrase, stats)
+	return error, output.getvalue() if error == 0 else None, stats.get('length')
 
-def encode(imgFilename, msgFilename, outputFilename):
-	return encodeAlgorithm(imgFilename, msgFilename, outputFilename)
+def decodeRangeJob(imageData, offset, length, key=None, passphrase=None):
+	error, data, total = decodeRangeBytes(imageData, offset, length, key, passphrase)
+	return error, (data, total) if error == 0 else None
 
-def decode(imgFilename, outputFilename):
-	return decodeAlgorithm(imgFilename, outputFilename)
\ No newline at end of file
+def toFileObject(data):
+	if isinstance(data, (bytes, bytearray)):
+		return io.BytesIO(data)
+	return data
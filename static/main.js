@@ -6,4 +6,50 @@ document.addEventListener('DOMContentLoaded', () => {
 	socket.on('connect', () => {
 		console.log('Client connected to the server through web sockets');
 	});
-});
\ No newline at end of file
+
+	/* Job submitted by this page, and element where its progress is displayed. */
+	let job = null;
+	const status = document.getElementById('status-id');
+
+	/* Submit the form as a job, and follow its progress through the socket. */
+	const form = document.querySelector('form');
+	form.addEventListener('submit', event => {
+		event.preventDefault();
+		status.textContent = 'Uploading...';
+		fetch(location.pathname, { method: 'POST', body: new FormData(form) })
+			.then(response => response.json().then(body => ({ code: response.status, body: body })))
+			.then(({ code, body }) => {
+				if (code === 503) {
+					status.textContent = 'The server is busy, please try again in a few seconds';
+					return;
+				}
+				job = body;
+				if (job.state === 'done') {
+					status.textContent = 'Done!';
+					location.href = job.result;
+					return;
+				}
+				socket.emit('follow', job.id);
+			})
+			.catch(() => {
+				status.textContent = 'Please check the image and the options provided';
+			});
+	});
+
+	/* Show the progress of the job, and its result when it is done. */
+	socket.on('job', event => {
+		if (job === null || event.id !== job.id) {
+			return;
+		}
+		if (event.state === 'queued') {
+			status.textContent = 'Waiting for a free worker...';
+		} else if (event.state === 'running') {
+			status.textContent = 'Working...';
+		} else if (event.state === 'done') {
+			status.textContent = 'Done!';
+			location.href = job.result;
+		} else {
+			status.textContent = 'There was a problem (error ' + event.error + ')';
+		}
+	});
+});